@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
 import json
-from typing import Any, Dict, List
+import hashlib
+import argparse
+from typing import Any, Dict, List, Optional
 
 # =========================
 # 路徑設定
@@ -12,8 +14,12 @@ DATA_FILE = os.path.join(ROOT_DIR, "data", "merged_products_with_series.json")
 
 # 全域變數
 PRODUCTS: List[dict] = []
+INDEX: Optional[Dict[str, list]] = None   # 編譯好的欄位式索引（見 compile_index）
 LOAD_STATUS: str = "（尚未載入）"
 
+INDEX_FORMAT = 1
+NUMERIC_FIELDS = ("watt", "cct", "beam", "lumen", "price")
+
 # =========================
 # 工具：數字安全轉換
 # =========================
@@ -23,14 +29,83 @@ def _to_float(v: Any) -> float:
     except:
         return 0.0
 
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def index_path(data_file: str) -> str:
+    """編譯索引放在資料檔旁：xxx.json → xxx.index.json"""
+    return os.path.splitext(data_file)[0] + ".index.json"
+
+# =========================
+# 編譯搜尋索引
+# =========================
+def compile_index(products: List[dict]) -> Dict[str, list]:
+    """
+    把產品轉成欄位式索引：關鍵字比對用的小寫字串、篩選用的數值欄、以及回傳用的整理後資料。
+    數值轉換與字串正規化只做一次，查詢時不再逐筆處理。
+    """
+    cols: Dict[str, list] = {"series": [], "model": [], "items": []}
+    cols.update({k: [] for k in NUMERIC_FIELDS})
+    for p in products:
+        if not isinstance(p, dict):
+            continue
+        nums = {k: _to_float(p.get(k, 0)) for k in NUMERIC_FIELDS}
+        for k, v in nums.items():
+            cols[k].append(v)
+        cols["series"].append(str(p.get("series", "")).lower())
+        cols["model"].append(str(p.get("model", "")).lower())
+        cols["items"].append({
+            "series": p.get("series", ""),
+            "model": p.get("model", ""),
+            **nums,
+            # 保留原始字串
+            "price_from": str(p.get("price_from", nums["price"]) or nums["price"]),
+            "voltage": p.get("voltage", ""),
+            "ip": p.get("ip", ""),
+        })
+    return cols
+
+def write_index(data_file: str, out_file: Optional[str] = None) -> str:
+    """讀產品 JSON、編譯索引並寫出（含來源檔 sha256，來源變了索引就失效）"""
+    out_file = out_file or index_path(data_file)
+    with open(data_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError("檔案格式錯誤：JSON 最外層應為陣列(list)")
+    payload = {"format": INDEX_FORMAT, "source_sha256": _file_sha256(data_file), **compile_index(data)}
+    tmp = out_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp, out_file)
+    return out_file
+
+def _load_index(data_file: str) -> Optional[Dict[str, list]]:
+    """讀取與資料檔相符的編譯索引；不存在、格式或來源不符就回 None"""
+    path = index_path(data_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            payload = json.load(f)
+        if payload.get("format") != INDEX_FORMAT or payload.get("source_sha256") != _file_sha256(data_file):
+            return None
+        return payload
+    except Exception:
+        return None
+
 # =========================
 # 讀取資料
 # =========================
 def load_products(data_file: str = DATA_FILE) -> Dict[str, Any]:
     """
-    讀取 JSON 後寫入全域 PRODUCTS。
+    讀取 JSON 後寫入全域 PRODUCTS / INDEX。
+    資料檔旁有相符的 .index.json（build_catalog.py 產生）就直接載入，否則當場編譯。
     """
-    global PRODUCTS, LOAD_STATUS
+    global PRODUCTS, INDEX, LOAD_STATUS
 
     # 若預設路徑找不到，嘗試在當前目錄找
     if not os.path.exists(data_file):
@@ -40,10 +115,17 @@ def load_products(data_file: str = DATA_FILE) -> Dict[str, Any]:
 
     if not os.path.exists(data_file):
         LOAD_STATUS = f"找不到資料檔：{data_file}"
-        PRODUCTS = []
+        PRODUCTS, INDEX = [], None
         return {"ok": False, "message": LOAD_STATUS}
 
     try:
+        index = _load_index(data_file)
+        if index is not None:
+            INDEX = index
+            PRODUCTS = index["items"]
+            LOAD_STATUS = f"已載入 {len(PRODUCTS)} 筆資料（編譯索引）"
+            return {"ok": True, "message": LOAD_STATUS}
+
         with open(data_file, "r", encoding="utf-8") as f:
             data = json.load(f)
 
@@ -56,29 +138,15 @@ def load_products(data_file: str = DATA_FILE) -> Dict[str, Any]:
                 normalized.append(p)
 
         PRODUCTS = normalized
+        INDEX = compile_index(normalized)
         LOAD_STATUS = f"已載入 {len(PRODUCTS)} 筆資料"
         return {"ok": True, "message": LOAD_STATUS}
 
     except Exception as e:
         LOAD_STATUS = f"載入失敗：{str(e)}"
-        PRODUCTS = []
+        PRODUCTS, INDEX = [], None
         return {"ok": False, "message": LOAD_STATUS}
 
-# =========================
-# 關鍵字比對邏輯
-# =========================
-def _match_series_keyword(p: dict, series_keyword: str) -> bool:
-    q = (series_keyword or "").strip().lower()
-    if not q:
-        return True
-
-    tokens = [t for t in q.split() if t]
-    s = str(p.get("series", "")).lower()
-    m = str(p.get("model", "")).lower()
-
-    # 任一 token 命中就算
-    return any(t in s or t in m for t in tokens)
-
 # =========================
 # 核心篩選功能
 # =========================
@@ -99,38 +167,22 @@ def filter_products(
             return {"ok": False, "message": "尚未載入產品資料或資料檔遺失", "items": []}
 
     try:
-        # 1. 關鍵字過濾
-        base = [p for p in PRODUCTS if _match_series_keyword(p, series_keyword)]
-        
-        # 2. 屬性過濾
+        # 1. 關鍵字 + 屬性過濾（索引欄位已預先轉好小寫與數值）
+        tokens = [t for t in (series_keyword or "").strip().lower().split() if t]
+        idx = INDEX
         result = []
-        for p in base:
-            w  = _to_float(p.get("watt", 0))
-            c  = _to_float(p.get("cct", 0))
-            b  = _to_float(p.get("beam", 0))
-            l  = _to_float(p.get("lumen", 0))
-            pr = _to_float(p.get("price", 0))
-
+        for s, m, w, c, b, l, pr, item in zip(
+            idx["series"], idx["model"], idx["watt"], idx["cct"], idx["beam"], idx["lumen"], idx["price"], idx["items"]
+        ):
+            # 任一 token 命中就算
+            if tokens and not any(t in s or t in m for t in tokens):
+                continue
             if not (watt_lo  <= w  <= watt_hi):   continue
             if not (cct_lo   <= c  <= cct_hi):    continue
             if not (beam_lo  <= b  <= beam_hi):   continue
             if not (lumen_lo <= l  <= lumen_hi):  continue
             if not (price_lo <= pr <= price_hi):  continue
-
-            # 整理回傳格式
-            result.append({
-                "series": p.get("series", ""),
-                "model": p.get("model", ""),
-                "watt": w,
-                "cct": c,
-                "beam": b,
-                "lumen": l,
-                "price": pr,
-                # 保留原始字串
-                "price_from": str(p.get("price_from", pr) or pr), 
-                "voltage": p.get("voltage", ""),
-                "ip": p.get("ip", "")
-            })
+            result.append(dict(item))
 
         # 3. 數量截斷
         if not result:
@@ -141,4 +193,12 @@ def filter_products(
         return {"ok": True, "message": "success", "items": result}
 
     except Exception as e:
-        return {"ok": False, "message": f"篩選過程發生錯誤: {e}", "items": []}
\ No newline at end of file
+        return {"ok": False, "message": f"篩選過程發生錯誤: {e}", "items": []}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="編譯搜尋索引：產品 JSON → .index.json（load_products 會優先載入）")
+    ap.add_argument("--data", default=DATA_FILE, help=f"產品 JSON（預設 {DATA_FILE}）")
+    ap.add_argument("--out", help="索引輸出路徑（預設與資料檔同名 .index.json）")
+    args = ap.parse_args()
+    print(f"✅ 已寫出索引：{write_index(args.data, args.out)}")
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+build_catalog.py
+產品資料建置流程（DAG），取代手動逐支執行：
+
+  series       Excel（型號/品名）        → series.json + model_series   series-extract.py
+  attributes   型錄 PDF                  → products_attr.json           attribute.py --pdf
+  prices       價格截圖資料夾            → products_price.json          PriceSort.py
+  merge        屬性 + 價格               → merged_products.json         merge.py
+  series_join  merged + model_series     → merged_products_with_series  merged-products(model+series).py
+  index        最終 JSON                 → .index.json（finalBackend 載入用）
+
+每個階段的「指紋」= 腳本原始碼 + 參數 + 所有輸入檔內容的 sha256；
+指紋與上次相同且輸出檔沒被動過就略過。輸出內容沒變時，下游也不會重跑。
+互不相依的階段（series / attributes / prices）平行執行。
+各階段在 build 目錄下執行，attribute.py / PriceSort.py 的逐頁、逐張檢查點也留在那裡，
+重跑時只付新內容的 API 費用。
+
+用法：
+  python build_catalog.py --pdf "../2025舞光LED21st(單頁水印可搜尋).pdf"
+  python build_catalog.py --dry_run            # 只列出哪些階段會重跑
+  python build_catalog.py --force prices       # 強制重跑某階段（下游視輸出是否改變）
+"""
+
+import os, sys, json, time, hashlib, argparse, subprocess, threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(HERE)
+
+DEFAULT_BUILD_DIR = os.path.join(HERE, "build")
+DEFAULT_EXCEL = os.path.join(HERE, "屬性抽取", "excelRawDataProcess", "料號品名對照表.xlsx")
+DEFAULT_PDF = os.path.join(ROOT_DIR, "2025舞光LED21st(單頁水印可搜尋).pdf")
+DEFAULT_PRICE_FOLDER = os.path.join(HERE, "價格抽取")
+DEFAULT_FINAL = os.path.join(ROOT_DIR, "AttributeSearch", "merged_products_with_series.json")
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+@dataclass
+class Stage:
+    name: str
+    script: str                 # 要執行的 Python 腳本
+    args: list                  # 腳本參數（路徑已展開）
+    inputs: list                # 輸入檔（或資料夾）
+    outputs: list               # 輸出檔
+    deps: list = field(default_factory=list)   # 上游階段
+    code: list = field(default_factory=list)   # 腳本以外、會影響結果的程式碼
+
+
+# =========================
+# 內容 hash（以 size + mtime 快取，未變動的大檔不重算）
+# =========================
+class Hasher:
+    def __init__(self, cache: dict, lock: threading.Lock):
+        # cache 是 state["files"]；lock 也保護 save_state，避免寫檔時 dict 被其他執行緒改動
+        self.cache = cache
+        self._lock = lock
+
+    def file(self, path: str) -> str:
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            hit = self.cache.get(key)
+        if hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns:
+            return hit[2]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self._lock:
+            self.cache[key] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def path(self, path: str) -> str:
+        """檔案 → 內容 hash；資料夾 → 其中圖片（檔名 + 內容）的 hash"""
+        if not os.path.isdir(path):
+            return self.file(path)
+        h = hashlib.sha256()
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(IMAGE_EXTS):
+                h.update(name.encode("utf-8"))
+                h.update(self.file(os.path.join(path, name)).encode("ascii"))
+        return h.hexdigest()
+
+
+def fingerprint(stage: Stage, hasher: Hasher) -> str:
+    h = hashlib.sha256(stage.name.encode("utf-8"))
+    for path in [stage.script, *stage.code]:
+        h.update(hasher.file(path).encode("ascii"))
+    h.update(json.dumps(stage.args, ensure_ascii=False).encode("utf-8"))
+    for path in stage.inputs:
+        h.update(hasher.path(path).encode("ascii"))
+    return h.hexdigest()
+
+
+# =========================
+# 建置狀態（每階段完成就寫回，中斷後重跑可接續）
+# =========================
+def load_state(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if isinstance(state, dict):
+            state.setdefault("stages", {})
+            state.setdefault("files", {})
+            return state
+    except (OSError, ValueError):
+        pass
+    return {"stages": {}, "files": {}}
+
+
+def save_state(path: str, state: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def up_to_date(stage: Stage, fp: str, state: dict, hasher: Hasher) -> bool:
+    rec = state["stages"].get(stage.name)
+    if not rec or rec.get("fingerprint") != fp:
+        return False
+    for out in stage.outputs:
+        if not os.path.exists(out) or rec.get("outputs", {}).get(out) != hasher.file(out):
+            return False  # 輸出被刪或被手動改過
+    return True
+
+
+# =========================
+# 階段定義
+# =========================
+def make_stages(args) -> list:
+    b = lambda name: os.path.join(args.build_dir, name)
+    attr_dir = os.path.join(HERE, "屬性抽取")
+    final_index = os.path.splitext(args.final)[0] + ".index.json"
+    llm = os.path.join(ROOT_DIR, "llm_client.py")
+    return [
+        Stage("series", os.path.join(attr_dir, "excelRawDataProcess", "series-extract.py"),
+              ["--excel", args.excel, "--out", b("series.json"), "--model_out", b("model_series.json")],
+              inputs=[args.excel], outputs=[b("series.json"), b("model_series.json")]),
+        Stage("attributes", os.path.join(attr_dir, "attributeExtract", "attribute.py"),
+              ["--pdf", args.pdf, "--out", b("products_attr.json")],
+              inputs=[args.pdf], outputs=[b("products_attr.json")],
+              code=[os.path.join(ROOT_DIR, "page_store.py"), llm]),
+        Stage("prices", os.path.join(HERE, "價格抽取", "PriceSort.py"),
+              ["--folder", args.price_folder, "--out", b("products_price.json")],
+              inputs=[args.price_folder], outputs=[b("products_price.json")], code=[llm]),
+        Stage("merge", os.path.join(HERE, "merge.py"),
+              ["--attr", b("products_attr.json"), "--price", b("products_price.json"),
+               "--out", b("merged_products.json"), "--cutoff", str(args.cutoff)],
+              inputs=[b("products_attr.json"), b("products_price.json")], outputs=[b("merged_products.json")],
+              deps=["attributes", "prices"]),
+        Stage("series_join", os.path.join(attr_dir, "merged-products(model+series).py"),
+              ["--products", b("merged_products.json"), "--series", b("series.json"),
+               "--model_series", b("model_series.json"), "--out", args.final],
+              inputs=[b("merged_products.json"), b("model_series.json")], outputs=[args.final],
+              deps=["merge", "series"]),
+        Stage("index", os.path.join(ROOT_DIR, "AttributeSearch", "finalBackend.py"),
+              ["--data", args.final, "--out", final_index],
+              inputs=[args.final], outputs=[final_index], deps=["series_join"]),
+    ]
+
+
+def run_stage(stage: Stage, log_dir: str) -> bool:
+    """在 build 目錄下執行腳本，輸出寫入 logs/<階段>.log"""
+    log_path = os.path.join(log_dir, f"{stage.name}.log")
+    with open(log_path, "w", encoding="utf-8") as log:
+        proc = subprocess.run(
+            [sys.executable, stage.script, *stage.args],
+            cwd=os.path.dirname(log_dir), stdout=log, stderr=subprocess.STDOUT,
+            env={**os.environ, "PYTHONIOENCODING": "utf-8"},
+        )
+    return proc.returncode == 0 and all(os.path.exists(p) for p in stage.outputs)
+
+
+# =========================
+# 主程式
+# =========================
+def main():
+    ap = argparse.ArgumentParser(description="增量建置產品資料：只重跑輸入有變的階段，互不相依的階段平行執行。")
+    ap.add_argument("--pdf", default=DEFAULT_PDF, help="型錄 PDF")
+    ap.add_argument("--excel", default=DEFAULT_EXCEL, help="型號/品名對照 Excel")
+    ap.add_argument("--price_folder", default=DEFAULT_PRICE_FOLDER, help="價格截圖資料夾")
+    ap.add_argument("--final", default=DEFAULT_FINAL, help="最終產品 JSON（finalBackend 讀取）")
+    ap.add_argument("--build_dir", default=DEFAULT_BUILD_DIR, help="中間產物、檢查點與建置狀態的目錄")
+    ap.add_argument("--cutoff", type=float, default=0.87, help="merge.py 模糊比對門檻")
+    ap.add_argument("--jobs", type=int, default=3, help="同時執行的階段數（預設 3）")
+    ap.add_argument("--force", nargs="*", default=[], help="強制重跑的階段名稱")
+    ap.add_argument("--dry_run", action="store_true", help="只列出各階段是否需要重跑")
+    args = ap.parse_args()
+    for k in ("pdf", "excel", "price_folder", "final", "build_dir"):
+        setattr(args, k, os.path.abspath(getattr(args, k)))
+
+    log_dir = os.path.join(args.build_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(args.final), exist_ok=True)
+    state_path = os.path.join(args.build_dir, "build_state.json")
+    state = load_state(state_path)
+    state_lock = threading.Lock()  # state（含 hash 快取）的所有讀寫都在這把鎖下
+    hasher = Hasher(state["files"], state_lock)
+
+    stages = {s.name: s for s in make_stages(args)}
+    unknown = set(args.force) - set(stages)
+    if unknown:
+        raise SystemExit(f"❌ 沒有這些階段：{', '.join(sorted(unknown))}（可用：{', '.join(stages)}）")
+
+    status = {}  # name → "cached" / "built" / "failed" / "blocked"
+    t0 = time.perf_counter()
+    print(f"🏗️  建置目錄：{args.build_dir}\n")
+
+    def decide(stage: Stage):
+        """回傳 (是否要跑, 指紋, 說明)；缺少輸入但已有舊輸出時沿用"""
+        missing = [p for p in stage.inputs if not os.path.exists(p)]
+        if missing:
+            if all(os.path.exists(p) for p in stage.outputs):
+                return False, None, f"缺少輸入 {os.path.basename(missing[0])}，沿用現有輸出"
+            return None, None, f"缺少輸入：{missing[0]}"
+        fp = fingerprint(stage, hasher)
+        if stage.name in args.force:
+            return True, fp, "強制重跑"
+        if up_to_date(stage, fp, state, hasher):
+            return False, fp, "未變動"
+        rec = state["stages"].get(stage.name)
+        if rec is None:
+            return True, fp, "首次建置"
+        return True, fp, "輸入已變動" if rec.get("fingerprint") != fp else "輸出遺失或被修改"
+
+    def record(stage: Stage, fp: str):
+        outputs = {p: hasher.file(p) for p in stage.outputs}  # 先算好，hasher 自己會取鎖
+        with state_lock:
+            state["stages"][stage.name] = {
+                "fingerprint": fp,
+                "outputs": outputs,
+                "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            save_state(state_path, state)
+
+    def execute(stage: Stage, fp: str):
+        t = time.perf_counter()
+        ok = run_stage(stage, log_dir)
+        if ok:
+            record(stage, fp)
+        return ok, time.perf_counter() - t
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        while True:
+            # 排入所有上游已完成的階段
+            for name, stage in stages.items():
+                if name in status or name in running.values():
+                    continue
+                dep_status = [status.get(d) for d in stage.deps]
+                if any(s in ("failed", "blocked") for s in dep_status):
+                    status[name] = "blocked"
+                    print(f"⛔ {name}：上游失敗，略過")
+                    continue
+                if any(s is None for s in dep_status):
+                    continue
+                if args.dry_run and "built" in dep_status:
+                    status[name] = "built"  # 上游輸出尚未產生，無法算指紋
+                    print(f"🔧 {name}：上游將重跑（將重跑）")
+                    continue
+
+                run, fp, why = decide(stage)
+                if run is None:
+                    status[name] = "failed"
+                    print(f"❌ {name}：{why}")
+                elif not run or args.dry_run:
+                    status[name] = "cached" if not run else "built"
+                    print(f"{'✅' if not run else '🔧'} {name}：{why}{'（將重跑）' if run else ''}")
+                else:
+                    print(f"🚀 {name}：{why}，開始執行")
+                    running[pool.submit(execute, stage, fp)] = name
+
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = running.pop(fut)
+                try:
+                    ok, secs = fut.result()
+                except Exception as e:
+                    ok, secs = False, 0.0
+                    print(f"   {name} 執行錯誤：{e}")
+                status[name] = "built" if ok else "failed"
+                if ok:
+                    print(f"✅ {name}：完成（{secs:.1f} 秒）")
+                else:
+                    print(f"❌ {name}：失敗，詳見 {os.path.join(log_dir, name + '.log')}")
+
+    # 結束時再存一次（含 hash 快取）
+    with state_lock:
+        save_state(state_path, state)
+
+    counts = {k: sum(1 for v in status.values() if v == k) for k in ("built", "cached", "failed", "blocked")}
+    print(f"\n⏱️ 耗時 {time.perf_counter() - t0:.1f} 秒：重跑 {counts['built']} / 沿用 {counts['cached']} / "
+          f"失敗 {counts['failed']} / 略過 {counts['blocked']}")
+    if counts["failed"] or counts["blocked"]:
+        raise SystemExit(1)
+    if not args.dry_run:
+        print(f"💾 產品資料：{args.final}")
+        print(f"🔎 搜尋索引：{os.path.splitext(args.final)[0] + '.index.json'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,10 +14,17 @@ merge_prices_with_progress.py
 用法：
   python merge_prices_with_progress.py
   python merge_prices_with_progress.py --cutoff 0.87 --no_fuzzy
+  python merge_prices_with_progress.py --price data/price_tw.json data/price_cn.json --workers 4
+  python merge_prices_with_progress.py --check_baseline   # 與 difflib 逐筆比對結果
+
+模糊比對用「長度分桶 + 字元 bigram 倒排索引」先挑候選，只對候選算 SequenceMatcher.ratio()，
+結果（含同分取捨）與 difflib.get_close_matches(n=1) 完全相同；cutoff < 0.75 時索引無法剪枝，改回全表掃描。
 """
 
-import os, json, re, argparse, sys
-from difflib import get_close_matches
+import os, json, re, argparse, sys, math, time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher, get_close_matches
 
 DATA_DIR = "data"
 ATTR_FILE = os.path.join(DATA_DIR, "products_attr.json")
@@ -40,6 +47,135 @@ def load_json(path: str):
         raise ValueError(f"{path} 內容不是陣列。")
     return data
 
+def _bigrams(s: str) -> Counter:
+    return Counter(s[i:i + 2] for i in range(len(s) - 1))
+
+class FuzzyIndex:
+    """
+    price key 的模糊比對索引，best() 與 get_close_matches(word, keys, n=1, cutoff) 結果相同。
+
+    ratio = 2M / (la + lb)，M 為 SequenceMatcher 的匹配字元數，因此：
+    - 長度：ratio ≤ 2·min(la, lb) / (la + lb)，不可能達標的長度整桶略過
+    - bigram：匹配區塊共 B 塊時至少共用 M − B 個 bigram，且相鄰區塊之間至少隔一個未匹配字元，
+      B ≤ (la − M) + (lb − M) + 1 → 共用 bigram ≥ 3M − la − lb − 1。
+      cutoff 越高這個下界越有用（> 2/3 才開始剪枝）；下界 ≤ 0 的長度就整桶掃描
+    - 前綴過濾：共用 ≥ t 個 bigram 的 key，一定含有查詢中最稀有的 (q − t + 1) 個 bigram 之一，
+      只需查這幾條倒排（跳過 "D-" 這類幾乎每個型號都有的 bigram），再逐一核對共用數
+    cutoff < MIN_CUTOFF 時下界太鬆，索引反而比全表掃描慢，直接用 get_close_matches
+    """
+
+    MIN_CUTOFF = 0.75
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.grams = [_bigrams(key) for key in self.keys]
+        self.by_len = defaultdict(list)       # 長度 → key id
+        self.postings = defaultdict(list)     # bigram → key id
+        for k, key in enumerate(self.keys):
+            self.by_len[len(key)].append(k)
+            for g in self.grams[k]:
+                self.postings[g].append(k)
+
+    @staticmethod
+    def _min_match(total: int, cutoff: float) -> int:
+        """達到 cutoff 所需的最少匹配字元數（與 difflib 相同的浮點運算）"""
+        m = max(0, math.ceil(cutoff * total / 2))
+        while m > 0 and 2.0 * (m - 1) / total >= cutoff:
+            m -= 1
+        while 2.0 * m / total < cutoff:
+            m += 1
+        return m
+
+    def candidates(self, word: str, cutoff: float):
+        lb = len(word)
+        need, scan = {}, []
+        for la, ids in self.by_len.items():
+            total = la + lb
+            m = self._min_match(total, cutoff)
+            if m > min(la, lb):
+                continue  # 長度差太大
+            shared = 3 * m - total - 1
+            if shared <= 0:
+                scan.extend(ids)  # bigram 下界無效，整桶都要算
+            else:
+                need[la] = shared
+        if not need:
+            return scan
+
+        query = _bigrams(word)
+        q = sum(query.values())
+        t = min(need.values())
+        if t > q:
+            return scan
+
+        # 由最稀有的 bigram 起取，累計次數到 q − t + 1 為止
+        probe, covered = [], 0
+        for g in sorted(query, key=lambda g: len(self.postings.get(g, ()))):
+            probe.append(g)
+            covered += query[g]
+            if covered >= q - t + 1:
+                break
+
+        found = set()
+        for g in probe:
+            found.update(self.postings.get(g, ()))
+        keys, grams = self.keys, self.grams
+        out = scan
+        for k in found:
+            n = need.get(len(keys[k]))
+            if n is not None and sum(min(c, grams[k][g]) for g, c in query.items()) >= n:
+                out.append(k)
+        return out
+
+    def best(self, word: str, cutoff: float):
+        """最接近的 key；同分取字串較大者（同 get_close_matches 的 heapq.nlargest）"""
+        if cutoff < self.MIN_CUTOFF:
+            match = get_close_matches(word, self.keys, n=1, cutoff=cutoff)
+            return match[0] if match else None
+        s = SequenceMatcher()
+        s.set_seq2(word)
+        best = None
+        for k in self.candidates(word, cutoff):
+            x = self.keys[k]
+            s.set_seq1(x)
+            if s.real_quick_ratio() >= cutoff and s.quick_ratio() >= cutoff:
+                r = s.ratio()
+                if r >= cutoff and (best is None or (r, x) > best):
+                    best = (r, x)
+        return best[1] if best else None
+
+# 子行程各自持有一份索引（initializer 傳入一次，不必每批都 pickle）
+_worker_index = None
+
+def _init_worker(index: FuzzyIndex):
+    global _worker_index
+    _worker_index = index
+
+def _best_many(words, cutoff):
+    return [_worker_index.best(w, cutoff) for w in words]
+
+def fuzzy_match_all(index: FuzzyIndex, words, cutoff: float, workers: int = 1, on_progress=None) -> dict:
+    """words 去重後逐一找最佳 key → {word: key 或 None}；workers > 1 時分批交給行程池"""
+    words = list(dict.fromkeys(words))
+    out = {}
+    if workers <= 1 or len(words) < 2 * workers:
+        for j, w in enumerate(words, start=1):
+            out[w] = index.best(w, cutoff)
+            if on_progress:
+                on_progress(j, len(words))
+        return out
+
+    size = max(1, math.ceil(len(words) / (workers * 8)))
+    chunks = [words[i:i + size] for i in range(0, len(words), size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index,)) as pool:
+        done = 0
+        for chunk, res in zip(chunks, pool.map(_best_many, chunks, [cutoff] * len(chunks))):
+            out.update(zip(chunk, res))
+            done += len(chunk)
+            if on_progress:
+                on_progress(done, len(words))
+    return out
+
 def progress_bar(done, total, width=20):
     percent = int((done / total) * 100) if total else 100
     filled = percent // (100 // width)
@@ -49,19 +185,24 @@ def progress_bar(done, total, width=20):
 def main():
     ap = argparse.ArgumentParser(description="合併 data/ 下的屬性與價格 JSON，補上 price 並顯示進度。")
     ap.add_argument("--attr", default=ATTR_FILE, help=f"屬性 JSON 路徑（預設 {ATTR_FILE}）")
-    ap.add_argument("--price", default=PRICE_FILE, help=f"價格 JSON 路徑（預設 {PRICE_FILE}）")
+    ap.add_argument("--price", nargs="+", default=[PRICE_FILE],
+                    help=f"價格 JSON 路徑，可給多個（各區價目表）一起合併（預設 {PRICE_FILE}）")
     ap.add_argument("--out", default=OUT_FILE, help=f"輸出檔路徑（預設 {OUT_FILE}）")
     ap.add_argument("--cutoff", type=float, default=0.87, help="模糊比對門檻（0~1，預設 0.87）")
     ap.add_argument("--no_fuzzy", action="store_true", help="只做精準對齊，不做模糊比對")
+    ap.add_argument("--workers", type=int, default=1, help="模糊比對的行程數（預設 1，不開行程池）")
+    ap.add_argument("--check_baseline", action="store_true",
+                    help="另跑一次 difflib.get_close_matches 全表掃描，逐筆確認結果相同並比較耗時")
     args = ap.parse_args()
 
     if not os.path.isfile(args.attr):
         raise SystemExit(f"❌ 找不到屬性檔：{args.attr}")
-    if not os.path.isfile(args.price):
-        raise SystemExit(f"❌ 找不到價格檔：{args.price}")
+    for path in args.price:
+        if not os.path.isfile(path):
+            raise SystemExit(f"❌ 找不到價格檔：{path}")
 
     attrs = load_json(args.attr)
-    prices = load_json(args.price)
+    prices = [p for path in args.price for p in load_json(path)]
 
     # 建立價格索引（精準）：canon(model) -> price
     price_map = {}
@@ -107,18 +248,34 @@ def main():
         no_price_indices = [idx for idx, it in enumerate(attrs) if "price" not in it or it["price"] in (0, "", None)]
         n_total = len(no_price_indices)
         print(f"\n🌀 進入模糊比對：待補 {n_total} 筆；cutoff={args.cutoff}\n")
-        for j, idx in enumerate(no_price_indices, start=1):
+        t0 = time.perf_counter()
+        index = FuzzyIndex(price_keys)
+        words = [cm for cm in (canon_model(attrs[idx].get("model", "")) for idx in no_price_indices) if cm]
+
+        def report(j, n):
+            if j % max(1, n // 20) == 0 or j == n:
+                print(f"  • 模糊對齊進度 {progress_bar(j, n)}", flush=True)
+
+        matches = fuzzy_match_all(index, words, args.cutoff, args.workers, report)
+        print(f"  ⏱️ 模糊比對 {len(matches)} 個型號，耗時 {time.perf_counter() - t0:.2f} 秒")
+
+        for idx in no_price_indices:
             it = attrs[idx]
-            cm = canon_model(it.get("model", ""))
-            if not cm:
-                continue
-            match = get_close_matches(cm, price_keys, n=1, cutoff=args.cutoff)
+            match = matches.get(canon_model(it.get("model", "")))
             if match:
-                it["price"] = price_map[match[0]]
+                it["price"] = price_map[match]
                 it["price_from"] = "fuzzy"
                 fuzzy_upd += 1
-            if j % max(1, n_total // 20) == 0 or j == n_total:
-                print(f"  • 模糊對齊進度 {progress_bar(j, n_total)}", flush=True)
+
+        if args.check_baseline:
+            t0 = time.perf_counter()
+            diff = 0
+            for w, got in matches.items():
+                base = get_close_matches(w, price_keys, n=1, cutoff=args.cutoff)
+                if (base[0] if base else None) != got:
+                    diff += 1
+                    print(f"  ❗ 結果不同：{w} → 索引 {got} / difflib {base[0] if base else None}")
+            print(f"  🔍 difflib 基準：耗時 {time.perf_counter() - t0:.2f} 秒；不一致 {diff}/{len(matches)}")
 
     # 統計仍無價格
     for it in attrs:
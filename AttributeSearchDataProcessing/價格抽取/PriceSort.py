@@ -9,19 +9,59 @@ price_from_images_folder_simple.py
   python price_from_images_folder_simple.py
   python price_from_images_folder_simple.py --out prices.json
   python price_from_images_folder_simple.py --drop_timeprice
+  python price_from_images_folder_simple.py --workers 8 --checkpoint price_checkpoint.jsonl
+
+多張圖片併發抽取（RPM/TPM 限流）；每張結果寫入檢查點 JSONL，以圖片內容 hash 為 key。
+重跑時：檔案內容完全相同（sha256）的圖片直接沿用，不再送 API。
+畫面相近（dHash）不能當作同一張：只改幾格價格的新版價目表 dHash 幾乎不變，沿用就會拿到舊價格。
+--dhash_dist 可選擇性地把本次資料夾內畫面幾乎相同的圖視為重複（只影響去重，不沿用檢查點）。
 """
 
-import os, io, re, json, time, base64, argparse, sys
+import os, io, re, json, time, base64, hashlib, argparse, sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIError
+
+# 共用的 OpenAI client（連線池、逾時、退避重試、併發上限）在專案根目錄 llm_client.py
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+from llm_client import DeadlineExceeded, TokenBucket, shared_client
 
 # -------------------- API Key --------------------
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise SystemExit("❌ 找不到 OPENAI_API_KEY，請在環境或 .env 設定。")
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+# 併發與限流：依 API tier 設定（與 attribute.py 相同的環境變數）
+MAX_WORKERS = int(os.getenv("PRICE_MAX_WORKERS", "6"))
+RPM_LIMIT = float(os.getenv("OPENAI_RPM_LIMIT", "500"))
+TPM_LIMIT = float(os.getenv("OPENAI_TPM_LIMIT", "30000"))
+client = shared_client(
+    api_key=OPENAI_API_KEY, timeout=90, max_concurrency=MAX_WORKERS, requests_per_s=RPM_LIMIT / 60
+)
+tpm_bucket = TokenBucket(TPM_LIMIT / 60, capacity=TPM_LIMIT)
+
+# 檢查點與去重
+CHECKPOINT_FILE = os.getenv("PRICE_CHECKPOINT", "price_checkpoint.jsonl")
+DHASH_SIZE = 16       # 16x16 = 256 bit
+# 預設關閉（-1）：實測改 3/6/10/20 列價格，dHash 只差 0/1/0/3 bit，分不出「重截」和「改價」
+DHASH_MAX_DIST = -1
+MAX_OUTPUT_TOKENS = 1600
+
+SYSTEM_PROMPT = (
+    "你是燈具價格表抽取助手。請從圖片中抽取所有『型號』與『價格』的配對；"
+    "表頭可能為『型號』『牌價』『售價』『價格』等，需辨識同義欄位；"
+    "若同一張圖有多個表格（左右欄或分區），要全部抽出合併；"
+    "對於價格：移除貨幣符號與千分位逗號，輸出純數字；"
+    "若價格標示『時價』『面議』『洽詢』等，請輸出 price='時價'；"
+    "只輸出 JSON 陣列，不能有任何解釋文字；"
+    "範例："
+    '[{"model":"LED-1234","price":1999},{"model":"LED-5678","price":"時價"}]'
+)
+USER_PROMPT = "請抽取所有表格中的型號與對應價格；若無資料請輸出 []。"
 
 # -------------------- Helpers --------------------
 def _to_number_or_none(x):
@@ -61,6 +101,37 @@ def _find_json(blob: str):
     except Exception:
         return None
 
+def _image_tokens(w: int, h: int) -> int:
+    """OpenAI high-detail 圖片計費：縮到 2048 內、短邊 768，每 512px tile 170 token + 85"""
+    scale = min(1.0, 2048 / max(w, h))
+    w, h = w * scale, h * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * (-(-int(w) // 512)) * (-(-int(h) // 512))
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _dhash(img: Image.Image, size=DHASH_SIZE) -> int:
+    """差異雜湊：灰階縮成 (size+1)×size，比較左右相鄰像素。對重新截圖、縮放、轉檔不敏感"""
+    px = img.convert("L").resize((size + 1, size), Image.LANCZOS).tobytes()
+    bits = 0
+    for r in range(size):
+        row = px[r * (size + 1):(r + 1) * (size + 1)]
+        for c in range(size):
+            bits = (bits << 1) | (row[c] > row[c + 1])
+    return bits
+
+def _extract_version(model: str) -> str:
+    """模型或提示詞一改，舊檢查點就不再沿用"""
+    return hashlib.sha256(
+        "\n".join([model, SYSTEM_PROMPT, USER_PROMPT, str(MAX_OUTPUT_TOKENS)]).encode("utf-8")
+    ).hexdigest()[:12]
+
 def _image_to_data_url(path: str, max_w=2000, quality=90) -> str:
     img = Image.open(path).convert("RGB")
     if img.width > max_w:
@@ -72,39 +143,35 @@ def _image_to_data_url(path: str, max_w=2000, quality=90) -> str:
     return f"data:image/jpeg;base64,{b64}"
 
 # -------------------- VLM Call --------------------
-def extract_prices_from_image(path: str, model="gpt-4o", retries=2, keep_non_numeric=True):
+def extract_prices_from_image(path: str, model="gpt-4o", retries=2, keep_non_numeric=True, deadline=180):
     """
     從單張圖片抽出 [{model, price}]。
     - 支援不同表頭（型號/牌價/售價/價格）
     - 支援一張圖多個表格
     - 允許輸出 '時價'
     - 不回傳來源欄位（無 image/page）
+    - 連線/限流錯誤由 client 退避重試；retries 只用在輸出無法解析時重問
+    - 失敗回傳 None（不寫入檢查點，下次重跑再試）；圖中沒有資料回傳 []
     """
     data_url = _image_to_data_url(path)
-    system = (
-        "你是燈具價格表抽取助手。請從圖片中抽取所有『型號』與『價格』的配對；"
-        "表頭可能為『型號』『牌價』『售價』『價格』等，需辨識同義欄位；"
-        "若同一張圖有多個表格（左右欄或分區），要全部抽出合併；"
-        "對於價格：移除貨幣符號與千分位逗號，輸出純數字；"
-        "若價格標示『時價』『面議』『洽詢』等，請輸出 price='時價'；"
-        "只輸出 JSON 陣列，不能有任何解釋文字；"
-        "範例："
-        '[{"model":"LED-1234","price":1999},{"model":"LED-5678","price":"時價"}]'
-    )
+    with Image.open(path) as img:
+        est_tokens = _image_tokens(*img.size) + MAX_OUTPUT_TOKENS
     user = [
-        {"type": "text", "text": "請抽取所有表格中的型號與對應價格；若無資料請輸出 []。"},
+        {"type": "text", "text": USER_PROMPT},
         {"type": "image_url", "image_url": {"url": data_url}},
     ]
 
     last_err = None
     for _ in range(retries + 1):
         try:
+            tpm_bucket.acquire(est_tokens)
             resp = client.chat.completions.create(
                 model=model,
-                messages=[{"role": "system", "content": system},
+                messages=[{"role": "system", "content": SYSTEM_PROMPT},
                           {"role": "user", "content": user}],
                 temperature=0.1,
-                max_tokens=1600,
+                max_tokens=MAX_OUTPUT_TOKENS,
+                deadline=deadline,
             )
             out = (resp.choices[0].message.content or "").strip()
             js = _find_json(out) or json.loads(out)
@@ -132,13 +199,46 @@ def extract_prices_from_image(path: str, model="gpt-4o", retries=2, keep_non_num
 
             return cleaned
 
+        except (APIError, DeadlineExceeded) as e:
+            # client 已重試過，不再重問
+            last_err = e
+            break
         except Exception as e:
             last_err = e
-            time.sleep(0.8)
 
     if last_err:
         print(f"  ⚠️ 解析失敗：{os.path.basename(path)} -> {last_err}", file=sys.stderr)
-    return []
+    return None
+
+# -------------------- Checkpoint --------------------
+def load_checkpoint(path: str, version: str):
+    """讀取檢查點 → sha256 → items；只收同一抽取版本，寫一半的行略過"""
+    by_sha = {}
+    if not os.path.exists(path):
+        return by_sha
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                if rec["version"] != version:
+                    continue
+                by_sha[rec["sha256"]] = rec["items"]
+            except (ValueError, KeyError, TypeError):
+                continue
+    return by_sha
+
+def _near(dhash: int, aspect: float, entries, max_dist: int):
+    """找畫面幾乎相同（dHash 距離 ≤ max_dist、寬高比差 < 3%）的項目；max_dist < 0 表示關閉"""
+    if max_dist < 0:
+        return None
+    best = None
+    for other, other_aspect, value in entries:
+        if abs(other_aspect - aspect) > 0.03 * aspect:
+            continue
+        d = bin(dhash ^ other).count("1")
+        if d <= max_dist and (best is None or d < best[0]):
+            best = (d, value)
+    return best
 
 # -------------------- Main --------------------
 def main():
@@ -147,10 +247,20 @@ def main():
     ap.add_argument("--model", default="gpt-4o", help="OpenAI 模型（預設 gpt-4o）")
     ap.add_argument("--out", default="products_price.json", help="輸出檔名（預設 products_price.json）")
     ap.add_argument("--drop_timeprice", action="store_true", help="丟棄『時價/面議』等非數字價格（預設保留為 '時價'）")
+    ap.add_argument("--workers", type=int, default=MAX_WORKERS,
+                    help=f"同時處理張數（預設與上限 {MAX_WORKERS}，即 client 併發上限；要更多請設 PRICE_MAX_WORKERS）")
+    ap.add_argument("--checkpoint", default=CHECKPOINT_FILE, help=f"逐張檢查點 JSONL（預設 {CHECKPOINT_FILE}）")
+    ap.add_argument("--dhash_dist", type=int, default=DHASH_MAX_DIST,
+                    help="本次資料夾內 dHash 距離 ≤ 此值的圖視為重複、只抽一次（預設 -1 關閉，只認完全相同的檔案；"
+                         "改過價格的截圖 dHash 也很接近，開啟前請確認資料夾內沒有新舊兩版價目表）")
     args = ap.parse_args()
 
     if not os.path.isdir(args.folder):
         raise SystemExit(f"❌ 找不到資料夾：{args.folder}")
+    if args.workers > MAX_WORKERS:
+        # client 在載入模組時就以 MAX_WORKERS 建立，多的執行緒只會卡在它的併發上限
+        print(f"⚠️ --workers {args.workers} 超過 client 併發上限 {MAX_WORKERS}，改用 {MAX_WORKERS}（可設 PRICE_MAX_WORKERS）")
+        args.workers = MAX_WORKERS
 
     exts = (".png", ".jpg", ".jpeg", ".webp")
     imgs = [os.path.join(args.folder, f) for f in sorted(os.listdir(args.folder)) if f.lower().endswith(exts)]
@@ -159,16 +269,77 @@ def main():
 
     total = len(imgs)
     print(f"💰 從資料夾 {args.folder} 讀取 {total} 張圖片...\n")
+    t0 = time.perf_counter()
+
+    # 先算 hash，決定哪些圖要送 API：與本次較前面的圖相同 → 重複（不計入輸出）；命中檢查點 → 沿用；其餘才送
+    # 檢查點只認 sha256；dHash 只在 --dhash_dist ≥ 0 時用於本次去重，關閉時不解碼圖片
+    version = _extract_version(args.model)
+    by_sha = load_checkpoint(args.checkpoint, version)
+    info, results, dup_of, todo = {}, {}, {}, []
+    seen_sha, seen_dhash = {}, []
+    for path in imgs:
+        if args.dhash_dist >= 0:
+            with Image.open(path) as img:
+                info[path] = (_file_sha256(path), _dhash(img), img.width / img.height)
+        else:
+            info[path] = (_file_sha256(path), None, None)
+        sha, dh, aspect = info[path]
+        name = os.path.basename(path)
+
+        near = None if sha in seen_sha else _near(dh, aspect, seen_dhash, args.dhash_dist)
+        twin = seen_sha.get(sha) or (near[1] if near else None)
+        if twin:
+            dup_of[path] = twin
+            how = f"畫面相近，dHash 差 {near[0]} bit" if near else "內容相同"
+            print(f"🔁 {name}：與 {os.path.basename(twin)} 重複（{how}），略過")
+            continue
+        seen_sha[sha] = path
+        if dh is not None:
+            seen_dhash.append((dh, aspect, path))
+
+        if sha in by_sha:
+            results[path] = by_sha[sha]
+            print(f"♻️  {name}：沿用檢查點（內容相同）")
+            continue
+        todo.append(path)
+
+    reused = len(results)
+    print(f"\n📋 沿用 {reused} 張 / 重複 {len(dup_of)} 張 / 需抽取 {len(todo)} 張（{args.workers} 併發）\n")
+
+    failed = 0
+    with open(args.checkpoint, "a", encoding="utf-8") as ckpt, ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(extract_prices_from_image, path, model=args.model, retries=2, keep_non_numeric=True): path
+            for path in todo
+        }
+        for done, fut in enumerate(as_completed(futures), start=1):
+            path = futures[fut]
+            try:
+                items = fut.result()
+            except Exception as e:
+                print(f"  ⚠️ {os.path.basename(path)} 發生錯誤：{e}", file=sys.stderr)
+                items = None
+            if items is None:
+                failed += 1
+            else:
+                results[path] = items
+                sha, dh, aspect = info[path]
+                ckpt.write(json.dumps({
+                    "sha256": sha, "dhash": None if dh is None else f"{dh:064x}", "aspect": aspect, "version": version,
+                    "file": os.path.basename(path), "items": items, "ts": time.time(),
+                }, ensure_ascii=False) + "\n")
+                ckpt.flush()
+            print(f"🖼️  {done}/{len(todo)} -> {os.path.basename(path)} ... "
+                  f"{'✅ ' + str(len(items)) + ' 筆' if items else '⚠️ 無效'}")
 
+    # 依檔名順序彙整（重複的圖不重複計入）；時價在輸出時才過濾，檢查點保留完整結果
     all_prices = []
-    for idx, path in enumerate(imgs, start=1):
-        print(f"🖼️  {idx}/{total} -> {os.path.basename(path)} ... ", end="")
-        sys.stdout.flush()
-        items = extract_prices_from_image(
-            path, model=args.model, retries=2, keep_non_numeric=(not args.drop_timeprice)
-        )
-        all_prices.extend(items)
-        print(f"{'✅ ' + str(len(items)) + ' 筆' if items else '⚠️ 無效'}")
+    for path in imgs:
+        for it in results.get(path) or []:
+            if args.drop_timeprice and not isinstance(it["price"], (int, float)):
+                continue
+            all_prices.append(it)
+    print(f"\n⏱️ 共 {total} 張，API {len(todo)} 張（失敗 {failed}），耗時 {time.perf_counter() - t0:.1f} 秒")
 
     # 單一檔案輸出（不產生逐張稽核）
     try:
@@ -1,19 +1,84 @@
 # attribute.py
 # Lighting Spec Finder v4.2 — GPT-4o 自動抽取 + JSON 快取（載入/儲存）+ 屬性篩選
 
-import os, io, re, json, time, base64
-import gradio as gr
+import os, re, json, sys, time, base64, hashlib, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import fitz                          # PyMuPDF：讀 PDF
-from PIL import Image                # 圖片處理
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIError
+
+# 共用的 OpenAI client（連線池、逾時、退避重試、併發上限）在專案根目錄 llm_client.py
+# 頁面文字 / 渲染圖與 RAG 共用專案根目錄 page_store.py 的頁面庫（以頁面內容 hash 存放）
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+from llm_client import DeadlineExceeded, TokenBucket, shared_client
+from page_store import Edition, PageStore, render_jpeg
 
 # ===== 基本設定 =====
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     print("⚠️ 找不到 OPENAI_API_KEY，請在 .env 中設定。")
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+# 併發與限流：依 API tier 設定（預設為 gpt-4o tier 1：500 RPM / 30k TPM）
+MAX_WORKERS = int(os.getenv("ATTR_MAX_WORKERS", "8"))      # 同時進行的頁數
+RPM_LIMIT = float(os.getenv("OPENAI_RPM_LIMIT", "500"))
+TPM_LIMIT = float(os.getenv("OPENAI_TPM_LIMIT", "30000"))
+
+client = shared_client(
+    api_key=OPENAI_API_KEY, timeout=90, max_concurrency=MAX_WORKERS, requests_per_s=RPM_LIMIT / 60
+)
+tpm_bucket = TokenBucket(TPM_LIMIT / 60, capacity=TPM_LIMIT)  # 每次請求預扣估計 token 數
+LLM_DEADLINE = 180  # 單頁抽取（含重試）最多等幾秒
+IMAGE_TOKENS = 1100  # 1280px 高解析圖片約略 token 數
+
+# 圖片渲染：子行程池預先轉檔，結果存進頁面庫（PAGE_STORE_DIR），重跑不再渲染
+RASTER_WORKERS = int(os.getenv("ATTR_RASTER_WORKERS", str(min(4, os.cpu_count() or 1))))
+IMAGE_MAX_W = 1280      # 與 IMAGE_QUALITY 都算進 EXTRACT_VERSION，改動會讓抽取快取失效
+IMAGE_QUALITY = 80
+
+# ===== 抽取設定（任何一項改動都會讓舊快取失效）=====
+MODEL = "gpt-4o"
+SYSTEM_PROMPT = (
+    "你是燈具規格抽取助手。"
+    "只輸出 JSON，不要任何解釋。"
+    "如果沒有產品，請輸出空陣列 []。"
+)
+SPEC_SCHEMA = (
+    "[{\"model\":\"...\",\"watt\":數字,\"cct\":數字,\"beam\":數字,"
+    "\"lumen\":數字,\"cri\":數字或字串,\"ip\":\"...\",\"voltage\":\"...\",\"price\":數字或字串}]"
+)
+# 文字頁打包：連續的短頁合併成一次請求，模型逐頁回傳、再拆回各頁
+PAGES_INSTRUCTION = (
+    "以下有一或多頁型錄內容，每頁以【第 N 頁】開頭。請逐頁抽取產品規格，"
+    "輸出 JSON 物件 {\"pages\":[{\"page\":頁碼,\"items\":產品陣列}]}，"
+    "每一頁都要列出（沒有產品的頁 items 為 []），產品陣列格式："
+)
+# 圖片備援（無文字或純表格頁）的使用者提示
+IMAGE_INSTRUCTION = "從圖片中讀取燈具規格，輸出 JSON 陣列："
+MAX_OUTPUT_TOKENS = 1200        # 每頁
+BATCH_MAX_OUTPUT_TOKENS = 4096  # 每次請求
+EXTRACT_VERSION = hashlib.sha256(
+    # 圖片解析度 / JPEG 品質會改變模型看到的內容，也算進版本（IMAGE_TOKENS 只是限速估計，不算）
+    "\n".join([
+        MODEL, SYSTEM_PROMPT, PAGES_INSTRUCTION, SPEC_SCHEMA, IMAGE_INSTRUCTION,
+        str(MAX_OUTPUT_TOKENS), str(IMAGE_MAX_W), str(IMAGE_QUALITY),
+    ]).encode("utf-8")
+).hexdigest()[:12]
+BATCH_TOKENS = int(os.getenv("ATTR_BATCH_TOKENS", "3000"))  # 每次請求最多塞多少頁面文字 token
+BATCH_MAX_PAGES = int(os.getenv("ATTR_BATCH_PAGES", "6"))
+
+# 逐頁檢查點：每頁抽完立即追加一行 JSON，以「頁面內容 hash + 抽取版本」為 key
+CHECKPOINT_FILE = os.getenv("ATTR_CHECKPOINT", "extract_checkpoint.jsonl")
+
+# 頁面分流（純 CPU）：封面、目錄、情境照等非規格頁不送 GPT-4o；設 ATTR_TRIAGE=0 可關閉
+TRIAGE = os.getenv("ATTR_TRIAGE", "1") != "0"
+MODEL_CODE_RE = re.compile(r"\b[A-Z]{1,4}-[A-Z0-9]{2,}[A-Z0-9\-]*")   # 例：D-FXTR7N、D-T5BA1
+SPEC_VALUE_RE = re.compile(r"\d+(?:\.\d+)?\s*(?:W|K|lm|mm|V)\b|\d+\s*°|IP\s?\d{2}|Ra\s*\d+|CRI", re.I)
+TRIAGE_MIN_CHARS = 20       # 少於此字數視為無文字頁
+TRIAGE_MIN_DRAWINGS = 15    # 無文字頁至少要有這麼多向量線段（表格、尺寸圖）才送圖片辨識
+TRIAGE_IMAGE_COVERAGE = 0.3 # 有型號但無規格值、且圖片覆蓋超過此比例 → 規格可能在圖片裡
 
 # 全域資料
 products = []                          # 解析或載入後的所有產品
@@ -37,17 +102,59 @@ def _find_json(s: str):
     except:
         return None
 
-def _jpeg_data_url_from_page(page: fitz.Page, max_w=1280, quality=80) -> str:
-    """把 PDF 頁面轉成 JPEG Data URL，提供給 VLM"""
-    pix = page.get_pixmap(matrix=fitz.Matrix(1.5, 1.5))
-    img = Image.open(io.BytesIO(pix.tobytes("png"))).convert("RGB")
-    if img.width > max_w:
-        h = int(img.height * (max_w / img.width))
-        img = img.resize((max_w, h), Image.LANCZOS)
-    buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=quality, optimize=True)
-    b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-    return f"data:image/jpeg;base64,{b64}"
+class PageRasterizer:
+    """
+    提供 VLM 用的 JPEG Data URL：
+    - 子行程池渲染（不佔 API 執行緒、不受 GIL 影響），prefetch() 可在 API 呼叫前先排入
+    - 存在頁面庫：頁面內容 hash + 尺寸 + 品質；命中就直接讀檔
+    """
+
+    def __init__(self, edition: Edition, workers: int = RASTER_WORKERS):
+        self.pdf_path = edition.pdf_path
+        self.edition = edition
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.rendered, self.cache_hits = 0, 0
+
+    def _path(self, page_no: int) -> str:
+        return self.edition.jpeg_path(page_no, IMAGE_MAX_W, IMAGE_QUALITY)
+
+    def prefetch(self, page_no: int):
+        with self._lock:
+            if page_no in self._futures or os.path.exists(self._path(page_no)):
+                return
+            self._futures[page_no] = self.pool.submit(
+                render_jpeg, self.pdf_path, page_no, self._path(page_no), max_w=IMAGE_MAX_W, quality=IMAGE_QUALITY
+            )
+
+    def data_url(self, page_no: int) -> str:
+        self.prefetch(page_no)  # 文字失敗才改用圖的頁，這時才排入
+        with self._lock:
+            fut = self._futures.pop(page_no, None)
+        if fut is not None:
+            data = fut.result()
+            self.rendered += 1
+        else:
+            with open(self._path(page_no), "rb") as f:
+                data = f.read()
+            self.cache_hits += 1
+        return "data:image/jpeg;base64," + base64.b64encode(data).decode("ascii")
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    # with PageRasterizer(...) as raster：例外或 Ctrl-C 也會關掉子行程池
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _estimate_tokens(text: str) -> int:
+    """粗估 token：中文約一字一 token，英數約 4 字元一 token"""
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk) // 4
 
 def _to_number(x):
     """字串數字 → float（去逗號、抓第一個數字片段）"""
@@ -62,79 +169,113 @@ def _to_number(x):
 # =========================
 # GPT-4o 一般規格抽取（一頁）
 # =========================
-def _gpt_json_from_text(text: str, page_no: int, retries=2):
+def _split_pages(js, wanted: set):
+    """把模型回傳拆回 {頁碼: items}；只收要求的頁，格式不對回傳 None"""
+    if js == [] or (isinstance(js, dict) and js.get("pages") == []):
+        # 合法回覆：要求的頁都沒有產品（SYSTEM_PROMPT 要求無產品時回 []），不是解析失敗
+        return {n: [] for n in wanted}
+    if isinstance(js, dict) and isinstance(js.get("pages"), list):
+        entries = js["pages"]
+    elif isinstance(js, list) and all(isinstance(e, dict) and "items" in e for e in js):
+        entries = js  # _find_json 可能只抓到內層的 pages 陣列
+    elif len(wanted) == 1 and isinstance(js, (list, dict)):
+        # 單頁時容許舊格式：直接回產品陣列 / {"items": [...]}
+        items = js.get("items", [js]) if isinstance(js, dict) else js
+        return {next(iter(wanted)): items} if isinstance(items, list) else None
+    else:
+        return None
+
+    found = {}
+    for e in entries:
+        if not isinstance(e, dict):
+            continue
+        try:
+            page_no = int(e.get("page"))
+        except (TypeError, ValueError):
+            continue
+        items = e.get("items", [])
+        if isinstance(items, dict):
+            items = [items]
+        if page_no in wanted and isinstance(items, list):
+            found[page_no] = items
+    return found or None
+
+def _gpt_json_from_text(pages, retries=2) -> dict:
     """
-    只用文字訊息請 gpt-4o 產生 JSON。
+    只用文字訊息請 gpt-4o 產生 JSON。pages = [(頁碼, 文字), ...]，多頁一次送出。
     用 response_format 強制回 JSON；仍備援用 _find_json 解析。
+    回傳 {頁碼: items}；模型漏掉的頁或 API 失敗時不在結果裡，由呼叫端改單頁/圖片重試。
     """
-    system = (
-        "你是燈具規格抽取助手。"
-        "只輸出 JSON，不要任何解釋。"
-        "如果沒有產品，請輸出空陣列 []。"
-    )
-    user = (
-        f"請從以下文字中抽取產品規格，輸出 JSON 陣列：\n"
-        f"[{{\"model\":\"...\",\"watt\":數字,\"cct\":數字,\"beam\":數字,"
-        f"\"lumen\":數字,\"cri\":數字或字串,\"ip\":\"...\",\"voltage\":\"...\",\"price\":數字或字串}}]\n\n"
-        f"第 {page_no} 頁內容：\n{text[:8000]}"  # 避免超長
-    )
+    system = SYSTEM_PROMPT
+    body = "\n\n".join(f"【第 {n} 頁】\n{text[:8000]}" for n, text in pages)  # 單頁仍避免超長
+    user = f"{PAGES_INSTRUCTION}\n{SPEC_SCHEMA}\n\n{body}"
+    max_tokens = min(BATCH_MAX_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS * len(pages))
+    wanted = {n for n, _ in pages}
+    label = "、".join(str(n) for n in sorted(wanted))
     for _ in range(retries+1):
         try:
+            tpm_bucket.acquire(_estimate_tokens(system + user) + max_tokens)
             resp = client.chat.completions.create(
-                model="gpt-4o",
+                model=MODEL,
                 messages=[{"role":"system","content":system},{"role":"user","content":user}],
                 temperature=0.2,
                 response_format={"type": "json_object"},  # 盡量讓它只回 JSON
-                max_tokens=1200,
+                max_tokens=max_tokens,
+                deadline=LLM_DEADLINE,
             )
             out = resp.choices[0].message.content or ""
-            js = _find_json(out)
-            if js is None:
-                try:
-                    js = json.loads(out)  # 有些情況直接是合法 JSON
-                except:
-                    js = None
-            if js is None:
+            try:
+                js = json.loads(out)
+            except ValueError:
+                js = _find_json(out)  # 前後夾雜文字時盡力抓
+            found = _split_pages(js, wanted)
+            if found is None:
                 continue
-            if isinstance(js, dict):
-                if "items" in js and isinstance(js["items"], list):
-                    return js["items"]
-                else:
-                    return [js]
-            if isinstance(js, list):
-                return js
+            return found
+        except (APIError, DeadlineExceeded) as e:
+            # 連線/限流錯誤 client 已退避重試過，這裡不再重問
+            print(f"⚠️ 第 {label} 頁 API 失敗：{e}")
+            return {}
         except Exception:
-            time.sleep(1.2)
-    return None
-
-def _gpt_json_from_image(page: fitz.Page, page_no: int, retries=2):
+            continue
+    return {}
+
+def _pack_pages(pages, texts):
+    """依頁序把文字頁打包：每包文字 token 不超過 BATCH_TOKENS、頁數不超過 BATCH_MAX_PAGES；長頁單獨一包"""
+    batches, cur, cur_tokens = [], [], 0
+    for i in pages:
+        tokens = _estimate_tokens(texts[i - 1][:8000])
+        if cur and (cur_tokens + tokens > BATCH_TOKENS or len(cur) >= BATCH_MAX_PAGES):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(i)
+        cur_tokens += tokens
+    if cur:
+        batches.append(cur)
+    return batches
+
+def _gpt_json_from_image(raster: PageRasterizer, page_no: int, retries=2):
     """
     用圖片（VLM）請 gpt-4o 產生 JSON。作為無文字或純表格頁的備援。
     """
-    system = (
-        "你是燈具規格抽取助手。"
-        "只輸出 JSON，不要任何解釋。"
-        "如果沒有產品，請輸出空陣列 []。"
-    )
-    data_url = _jpeg_data_url_from_page(page)
+    system = SYSTEM_PROMPT
+    data_url = raster.data_url(page_no)
     user_content = [
-        {"type": "text", "text": (
-            "從圖片中讀取燈具規格，輸出 JSON 陣列："
-            "[{\"model\":\"...\",\"watt\":數字,\"cct\":數字,\"beam\":數字,"
-            "\"lumen\":數字,\"cri\":數字或字串,\"ip\":\"...\",\"voltage\":\"...\",\"price\":數字或字串}]"
-        )},
+        {"type": "text", "text": IMAGE_INSTRUCTION + SPEC_SCHEMA},
         {"type": "image_url", "image_url": {"url": data_url}},
     ]
     for _ in range(retries+1):
         try:
+            tpm_bucket.acquire(IMAGE_TOKENS + MAX_OUTPUT_TOKENS)
             resp = client.chat.completions.create(
-                model="gpt-4o",
+                model=MODEL,
                 messages=[
                     {"role":"system","content":system},
                     {"role":"user","content":user_content}
                 ],
                 temperature=0.2,
-                max_tokens=1200
+                max_tokens=MAX_OUTPUT_TOKENS,
+                deadline=LLM_DEADLINE,
             )
             out = resp.choices[0].message.content or ""
             js = _find_json(out)
@@ -149,19 +290,143 @@ def _gpt_json_from_image(page: fitz.Page, page_no: int, retries=2):
                 return [js]
             if isinstance(js, list):
                 return js
+        except (APIError, DeadlineExceeded) as e:
+            # 連線/限流錯誤 client 已退避重試過，這裡不再重問
+            print(f"⚠️ 第 {page_no} 頁 API 失敗：{e}")
+            return None
         except Exception:
-            time.sleep(1.2)
+            continue
     return None
 
 
 # =========================
 # PDF 全文抽取（→ products；同時輸出 JSON）
 # =========================
-def parse_pdf_with_gpt4o(pdf_input):
+def _normalize_items(items):
+    """正規化欄位型態，避免後續篩選時出錯"""
+    normed = []
+    for it in items:
+        if not isinstance(it, dict):
+            continue
+        d = dict(it)
+        for k in ["watt","cct","beam","lumen","price","cri"]:
+            if k in d:
+                d[k] = _to_number(d[k])
+        normed.append(d)
+    return normed
+
+def _extract_batch(raster: PageRasterizer, pages, texts, kind: str = "spec"):
+    """一包頁面：文字（多頁一次）→JSON；漏掉的頁改單頁文字；仍失敗或分流為圖片頁→圖片→JSON。在工作執行緒執行
+    回傳 {頁碼: items}；None 表示抽取失敗（不寫入檢查點）；[] 表示模型確認此頁沒有產品"""
+    found = {}
+    if kind == "spec":  # 先試文字
+        found = _gpt_json_from_text([(i, texts[i - 1]) for i in pages], retries=2)
+        if len(pages) > 1:
+            for i in pages:
+                if i not in found:
+                    found.update(_gpt_json_from_text([(i, texts[i - 1])], retries=1))
+
+    results = {}
+    for i in pages:
+        items = found.get(i)
+        # 分流開啟時，文字頁只有在解析失敗時才改用圖（模型回空陣列就是沒有產品）
+        if items is None or (not items and not TRIAGE):
+            items = _gpt_json_from_image(raster, i, retries=2)
+        results[i] = _normalize_items(items) if items is not None else None
+    return results
+
+
+# =========================
+# 頁面分流（CPU，不呼叫 API）
+# =========================
+def _has_table(page) -> bool:
+    if not hasattr(page, "find_tables"):  # PyMuPDF < 1.23
+        return False
+    try:
+        return len(page.find_tables().tables) > 0
+    except Exception:
+        return False
+
+def _image_coverage(page) -> float:
+    area = abs(page.rect) or 1.0
+    covered = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    return min(1.0, covered / area)
+
+def _triage_page(page, text: str):
+    """
+    依文字密度、型號命中、規格值命中、數字比例、表格偵測，把頁面分成：
+    - "spec"：有文字規格 → 文字抽取
+    - "image"：規格只在圖裡（無文字表格、線稿）→ 圖片抽取
+    - "skip"：封面、目錄、情境照等沒有產品訊號（無型號）的頁 → 不送 API
+    有型號的頁一律不略過（型號/價目表、規格沒寫單位的頁都可能有產品）
+    回傳 (分類, 原因)
+    """
+    chars = len(re.sub(r"\s", "", text))
+    codes = len(MODEL_CODE_RE.findall(text))
+    values = len(SPEC_VALUE_RE.findall(text))
+    if chars >= TRIAGE_MIN_CHARS:
+        digit_ratio = sum(ch.isdigit() for ch in text) / chars
+        if values >= 2 and (codes or digit_ratio >= 0.15 or _has_table(page)):
+            return "spec", f"型號 {codes}、規格值 {values}"
+    else:
+        digit_ratio = 0.0
+        if _has_table(page) or len(page.get_drawings()) >= TRIAGE_MIN_DRAWINGS:
+            return "image", "無文字但有表格/線稿"
+
+    if codes and _image_coverage(page) >= TRIAGE_IMAGE_COVERAGE:
+        return "image", f"型號 {codes} 但規格值不足，圖片覆蓋高"
+    if codes:
+        return "spec", f"型號 {codes}、規格值 {values}（可能是型號/價目表）"
+    if chars < TRIAGE_MIN_CHARS:
+        return "skip", "無文字且無表格"
+    return "skip", f"型號 {codes}、規格值 {values}、數字比 {digit_ratio:.0%}"
+
+def _old_flow_tokens(text: str) -> int:
+    """未分流時此頁至少會花的輸入 token：有文字 → 文字呼叫；無文字 → 直接圖片呼叫。
+    文字呼叫回空後的圖片重試無法事先得知，不計入（所以是下限）"""
+    return _estimate_tokens(SYSTEM_PROMPT + SPEC_SCHEMA + text[:8000]) if text else IMAGE_TOKENS
+
+
+# =========================
+# 逐頁檢查點（append-only JSONL）
+# =========================
+def _checkpoint_key(page_hash: str) -> str:
+    # page_hash = 頁面庫的頁面 key（文字 + 繪圖指令 + 內嵌圖片），與頁碼無關，
+    # 新版型錄插頁/換頁後，內容沒變的頁仍會命中
+    return f"{EXTRACT_VERSION}:{page_hash}"
+
+def load_checkpoint(path: str = CHECKPOINT_FILE) -> dict:
+    """讀取檢查點 → {key: items}。同一 key 以最後一行為準；中斷時寫一半的行直接略過"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                done[rec["key"]] = rec["items"]
+            except (ValueError, KeyError, TypeError):
+                continue
+    return done
+
+def _append_checkpoint(f, key: str, page_no: int, items: list):
+    f.write(json.dumps(
+        {"key": key, "version": EXTRACT_VERSION, "page": page_no, "items": items, "ts": time.time()},
+        ensure_ascii=False,
+    ) + "\n")
+    f.flush()  # 每頁落盤，當掉最多損失進行中的頁
+
+def parse_pdf_with_gpt4o(pdf_input, max_workers: int = MAX_WORKERS, checkpoint: str = CHECKPOINT_FILE, out: str = DEFAULT_JSON):
     """
-    - 逐頁：文字→JSON；失敗→圖片→JSON
-    - 每頁印出成功/失敗
-    - 結束後把 products 存成 merged_products.json
+    - 多頁併發：最多 max_workers 頁同時呼叫 GPT-4o，RPM/TPM 由 token bucket 限流
+    - 先在本機分流：非規格頁不送 API，無文字的規格頁直接走圖片
+    - 連續的短文字頁打包成一次請求（BATCH_TOKENS / BATCH_MAX_PAGES），結果拆回各頁
+    - 頁面文字與渲染圖取自共用頁面庫（page_store.py）：同一版型錄只解析一次，RAG 也讀同一份
+    - 圖片頁在子行程池預先渲染成 JPEG（存進頁面庫），API 執行緒不做影像處理
+    - 每頁：文字→JSON；失敗→圖片→JSON
+    - 每頁完成立即追加到檢查點；重跑時內容與抽取版本都沒變的頁直接沿用（中斷可續跑、改版只付差異頁）
+    - 依頁序輸出結果與進度（先完成的頁會等前面的頁）
+    - 結束後把 products 存成 out（預設 merged_products.json）
     """
     global products
     products = []
@@ -169,48 +434,113 @@ def parse_pdf_with_gpt4o(pdf_input):
     # gr.File 會傳入一個物件，取 name；也支援直接傳字串路徑
     pdf_path = pdf_input if isinstance(pdf_input, str) else pdf_input.name
 
-    doc = fitz.open(pdf_path)
-    total = len(doc)
-    ok, fail = 0, 0
-
-    for i, page in enumerate(doc, start=1):
-        text = (page.get_text("text") or "").strip()
-
-        items = None
-        if text:  # 先試文字
-            items = _gpt_json_from_text(text, i, retries=2)
-
-        if not items:  # 文字失敗 → 用圖
-            items = _gpt_json_from_image(page, i, retries=2)
-
-        if items:
-            # 正規化欄位型態，避免後續篩選時出錯
-            normed = []
-            for it in items:
-                if not isinstance(it, dict):
-                    continue
-                d = dict(it)
-                for k in ["watt","cct","beam","lumen","price","cri"]:
-                    if k in d:
-                        d[k] = _to_number(d[k])
-                normed.append(d)
-
-            products.extend(normed)
-            ok += 1
-            print(f"✅ 第 {i}/{total} 頁解析成功：新增 {len(normed)} 筆（累計 {len(products)}）")
-        else:
-            fail += 1
-            print(f"⚠️ 第 {i}/{total} 頁解析失敗")
+    store = PageStore()
+    edition = store.ingest(pdf_path)
+    total = len(edition)
+    texts = [edition.text(i) for i in range(1, total + 1)]
+    keys = [_checkpoint_key(h) for h in edition.keys]
+    print(f"📚 頁面庫：{store.root}（{total} 頁，版本 {edition.sha256[:12]}）")
+    cached = load_checkpoint(checkpoint)
+    ok, empty, fail, reused, skipped = 0, 0, 0, 0, 0
+    t0 = time.perf_counter()
+
+    # 命中檢查點的頁不再呼叫 API
+    results, next_page = {}, 1
+    for i, key in enumerate(keys, start=1):
+        if key in cached:
+            results[i] = cached[key]
+            reused += 1
+    todo = [i for i in range(1, total + 1) if i not in results]
+    print(f"♻️ 檢查點命中 {reused}/{total} 頁，需抽取 {len(todo)} 頁（抽取版本 {EXTRACT_VERSION}）")
+
+    # 未命中的頁先分流；略過的頁不寫檢查點（分流免費，規則調整後可重判）
+    # 分流要看版面（表格、線稿、圖片覆蓋），只有還有頁要抽時才開 PDF
+    kinds, reasons = {}, {}
+    t_triage = time.perf_counter()
+    doc = fitz.open(pdf_path) if TRIAGE and todo else None
+    for i in todo:
+        kinds[i], reasons[i] = _triage_page(doc[i - 1], texts[i - 1]) if doc else ("spec", "")
+    if doc:
+        doc.close()
+    t_triage = time.perf_counter() - t_triage
+    skip_pages = [i for i in todo if kinds[i] == "skip"]
+    for i in skip_pages:
+        results[i] = []
+    todo = [i for i in todo if kinds[i] != "skip"]
+    if TRIAGE:
+        n_image = sum(1 for i in todo if kinds[i] == "image")
+        print(f"🧹 分流（{t_triage:.1f} 秒）：文字規格 {len(todo) - n_image} 頁 / 圖片規格 {n_image} 頁 / 略過 {len(skip_pages)} 頁")
+
+    def emit_ready(done):
+        # 依頁序輸出已完成的連續頁
+        nonlocal next_page, ok, empty, fail, skipped
+        while next_page in results:
+            items = results.pop(next_page)
+            if kinds.get(next_page) == "skip":
+                skipped += 1
+                print(f"⏭️ 第 {next_page}/{total} 頁略過：{reasons[next_page]}")
+            elif items:
+                products.extend(items)
+                ok += 1
+                print(f"✅ 第 {next_page}/{total} 頁解析成功：新增 {len(items)} 筆（累計 {len(products)}，已完成 {done}/{total}）")
+            elif items is not None:
+                empty += 1
+                print(f"➖ 第 {next_page}/{total} 頁沒有產品（已完成 {done}/{total}）")
+            else:
+                fail += 1
+                print(f"⚠️ 第 {next_page}/{total} 頁解析失敗（已完成 {done}/{total}）")
+            next_page += 1
+
+    emit_ready(reused + len(skip_pages))
+    with PageRasterizer(edition) as raster:
+        for i in todo:  # 確定走圖片的頁先排入渲染，依頁序、跑在 API 呼叫前面
+            if kinds[i] == "image" or not texts[i - 1]:
+                raster.prefetch(i)
+        text_pages = [i for i in todo if kinds[i] == "spec" and texts[i - 1]]
+        batches = [("spec", b) for b in _pack_pages(text_pages, texts)]
+        batches += [("image", [i]) for i in sorted(set(todo) - set(text_pages))]
+        batches.sort(key=lambda kb: kb[1][0])
+        if text_pages:
+            print(f"📦 打包：{len(text_pages)} 頁文字 → {sum(1 for k, _ in batches if k == 'spec')} 次請求")
+
+        done = reused + len(skip_pages)
+        t_llm = time.perf_counter()
+        with open(checkpoint, "a", encoding="utf-8") as ckpt, ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(_extract_batch, raster, pages, texts, kind): pages for kind, pages in batches}
+            for fut in as_completed(futures):
+                try:
+                    results.update(fut.result())
+                except Exception as e:
+                    print(f"⚠️ 第 {'、'.join(map(str, futures[fut]))} 頁發生錯誤：{e}")
+                    results.update({i: None for i in futures[fut]})
+                for i in futures[fut]:
+                    if results[i] is not None:  # 失敗的頁不記錄，下次重跑會再試
+                        _append_checkpoint(ckpt, keys[i - 1], i, results[i])
+                done += len(futures[fut])
+                emit_ready(done)
+
+        t_llm = time.perf_counter() - t_llm
+    print(f"⏱️ 共 {total} 頁（沿用 {reused} 頁），耗時 {time.perf_counter() - t0:.1f} 秒（{max_workers} 併發）")
+    if raster.rendered or raster.cache_hits:
+        print(f"🖼️ 圖片：新渲染 {raster.rendered} 頁 / 快取 {raster.cache_hits} 頁（{store.root}）")
+    if skip_pages:
+        # 省下的時間以本次每頁平均 API 時間估算；沒有實際呼叫就無從估起
+        saved_tokens = sum(_old_flow_tokens(texts[i - 1]) for i in skip_pages)
+        saved_s = f"約 {t_llm / len(todo) * len(skip_pages):.1f} 秒" if todo else "（本次無 API 呼叫可估算時間）"
+        print(f"💰 分流略過 {len(skip_pages)} 頁：至少省下約 {saved_tokens} 輸入 token、{saved_s}")
 
     # 存 JSON 快取
     try:
-        with open(DEFAULT_JSON, "w", encoding="utf-8") as f:
+        with open(out, "w", encoding="utf-8") as f:
             json.dump(products, f, ensure_ascii=False, indent=2)
-        save_msg = f"✅ 已輸出 {DEFAULT_JSON}（{len(products)} 筆）"
+        save_msg = f"✅ 已輸出 {out}（{len(products)} 筆）"
     except Exception as e:
         save_msg = f"❌ 輸出 JSON 失敗：{e}"
 
-    return f"完成：成功 {ok} 頁 / 失敗 {fail} 頁；共解析 {len(products)} 筆。\n{save_msg}"
+    return (
+        f"完成：成功 {ok} 頁 / 無產品 {empty} 頁 / 略過 {skipped} 頁 / 失敗 {fail} 頁（其中 {reused} 頁沿用檢查點）；"
+        f"共解析 {len(products)} 筆。\n{save_msg}"
+    )
 
 
 # =========================
@@ -333,7 +663,8 @@ def classify_query_with_llm(user_query: str) -> str:
                 {"role":"system","content":"你是一個燈具資料分類助手，只回答 'series' 或 'model'。"},
                 {"role":"user","content":f"判斷以下輸入屬於燈具『系列名』還是『型號名』：{user_query}"}
             ],
-            temperature=0
+            temperature=0,
+            deadline=15,
         )
         ans = resp.choices[0].message.content.strip().lower()
         if "series" in ans:
@@ -384,63 +715,84 @@ def load_products_from_uploaded_json(file_obj):
 # =========================
 # Gradio UI
 # =========================
-with gr.Blocks(title="Lighting Spec Finder v4.2 — GPT-4o + JSON 快取") as demo:
-    gr.Markdown("# 💡 Lighting Spec Finder v4.2 — 解析後可存 JSON，重啟直接載入使用")
-
-    # A. 先載入 JSON（重啟後建議用）
-    gr.Markdown("## A. 載入現有 JSON（重啟後免重跑）")
-    with gr.Row():
-        btn_load_default = gr.Button("📂 載入 merged_products.json")
-        json_upload = gr.File(label="或上傳自訂 JSON（陣列格式）", file_types=[".json"])
-        btn_load_uploaded = gr.Button("📤 載入上傳 JSON")
-    status_load = gr.Markdown("（尚未載入）")
-    btn_load_default.click(lambda: load_products_from_json(DEFAULT_JSON), outputs=[status_load])
-    btn_load_uploaded.click(load_products_from_uploaded_json, inputs=[json_upload], outputs=[status_load])
-
-    # B. 重新解析 PDF（會自動存 JSON）
-    gr.Markdown("## B. 重新解析 PDF（GPT-4o 全抽取，完成後自動輸出 JSON）")
-    with gr.Row():
-        pdf_input = gr.File(label="上傳 catalog PDF", file_types=[".pdf"], scale=3)
-        btn_parse = gr.Button("🚀 開始解析（全文）", scale=1)
-    status_parse = gr.Markdown("（未開始）")
-    btn_parse.click(parse_pdf_with_gpt4o, inputs=pdf_input, outputs=status_parse)
-
-    # C. 查詢 / 篩選
-    gr.Markdown("## C. 查詢 / 篩選")
-    with gr.Row():
-        query_input = gr.Textbox(label="輸入型號或關鍵字（例如：D-FXTR7N 或 軌道燈）", placeholder="請先載入 JSON 或解析 PDF", scale=4)
-        btn_search = gr.Button("查詢", variant="primary", scale=1)
-    search_result = gr.Markdown("（尚未查詢）")
-    btn_search.click(ui_search, inputs=[query_input], outputs=[search_result])
-    
-    series_input = gr.Textbox(label="系列名稱（可選）", placeholder="例如：T5、D-T5BA1、OD 系列等，可留空")
-
-    gr.Markdown("### 屬性篩選（雙頭滑桿）")
-    with gr.Row():
-        watt_lo = gr.Slider(0,200,0,step=1,label="功率最小 W")
-        watt_hi = gr.Slider(0,200,200,step=1,label="功率最大 W")
-    with gr.Row():
-        cct_lo = gr.Slider(2000,7000,2700,step=50,label="色溫最小 K")
-        cct_hi = gr.Slider(2000,7000,6500,step=50,label="色溫最大 K")
-    with gr.Row():
-        beam_lo = gr.Slider(0,120,0,step=1,label="光束角最小 °")
-        beam_hi = gr.Slider(0,120,120,step=1,label="光束角最大 °")
-    with gr.Row():
-        lumen_lo = gr.Slider(0,10000,0,step=10,label="光通量最小 lm")
-        lumen_hi = gr.Slider(0,10000,10000,step=10,label="光通量最大 lm")
-    with gr.Row():
-        price_lo = gr.Slider(0,100000,0,step=100,label="價格最小")
-        price_hi = gr.Slider(0,100000,100000,step=100,label="價格最大")
-    with gr.Row():
-        topk = gr.Slider(1,20,10,step=1,label="最多顯示筆數")
-
-    btn_filter = gr.Button("開始篩選", variant="primary")
-    filter_result = gr.Markdown()
-    btn_filter.click(
-        ui_filter,
-        inputs=[series_input,watt_lo, watt_hi, cct_lo, cct_hi, beam_lo, beam_hi, lumen_lo, lumen_hi, price_lo, price_hi, topk],
-        outputs=[filter_result]
-    )
+def build_ui():
+    """建立 Gradio 介面。gradio 只在這裡 import：渲染子行程（spawn/forkserver）會把本檔當 __mp_main__ 重新 import，
+    介面放在模組層級就會在每個子行程各建一次"""
+    import gradio as gr
+
+    with gr.Blocks(title="Lighting Spec Finder v4.2 — GPT-4o + JSON 快取") as demo:
+        gr.Markdown("# 💡 Lighting Spec Finder v4.2 — 解析後可存 JSON，重啟直接載入使用")
+
+        # A. 先載入 JSON（重啟後建議用）
+        gr.Markdown("## A. 載入現有 JSON（重啟後免重跑）")
+        with gr.Row():
+            btn_load_default = gr.Button("📂 載入 merged_products.json")
+            json_upload = gr.File(label="或上傳自訂 JSON（陣列格式）", file_types=[".json"])
+            btn_load_uploaded = gr.Button("📤 載入上傳 JSON")
+        status_load = gr.Markdown("（尚未載入）")
+        btn_load_default.click(lambda: load_products_from_json(DEFAULT_JSON), outputs=[status_load])
+        btn_load_uploaded.click(load_products_from_uploaded_json, inputs=[json_upload], outputs=[status_load])
+
+        # B. 重新解析 PDF（會自動存 JSON）
+        gr.Markdown("## B. 重新解析 PDF（GPT-4o 全抽取，完成後自動輸出 JSON）")
+        with gr.Row():
+            pdf_input = gr.File(label="上傳 catalog PDF", file_types=[".pdf"], scale=3)
+            btn_parse = gr.Button("🚀 開始解析（全文）", scale=1)
+        status_parse = gr.Markdown("（未開始）")
+        btn_parse.click(parse_pdf_with_gpt4o, inputs=pdf_input, outputs=status_parse)
+
+        # C. 查詢 / 篩選
+        gr.Markdown("## C. 查詢 / 篩選")
+        with gr.Row():
+            query_input = gr.Textbox(label="輸入型號或關鍵字（例如：D-FXTR7N 或 軌道燈）", placeholder="請先載入 JSON 或解析 PDF", scale=4)
+            btn_search = gr.Button("查詢", variant="primary", scale=1)
+        search_result = gr.Markdown("（尚未查詢）")
+        btn_search.click(ui_search, inputs=[query_input], outputs=[search_result])
+        
+        series_input = gr.Textbox(label="系列名稱（可選）", placeholder="例如：T5、D-T5BA1、OD 系列等，可留空")
+
+        gr.Markdown("### 屬性篩選（雙頭滑桿）")
+        with gr.Row():
+            watt_lo = gr.Slider(0,200,0,step=1,label="功率最小 W")
+            watt_hi = gr.Slider(0,200,200,step=1,label="功率最大 W")
+        with gr.Row():
+            cct_lo = gr.Slider(2000,7000,2700,step=50,label="色溫最小 K")
+            cct_hi = gr.Slider(2000,7000,6500,step=50,label="色溫最大 K")
+        with gr.Row():
+            beam_lo = gr.Slider(0,120,0,step=1,label="光束角最小 °")
+            beam_hi = gr.Slider(0,120,120,step=1,label="光束角最大 °")
+        with gr.Row():
+            lumen_lo = gr.Slider(0,10000,0,step=10,label="光通量最小 lm")
+            lumen_hi = gr.Slider(0,10000,10000,step=10,label="光通量最大 lm")
+        with gr.Row():
+            price_lo = gr.Slider(0,100000,0,step=100,label="價格最小")
+            price_hi = gr.Slider(0,100000,100000,step=100,label="價格最大")
+        with gr.Row():
+            topk = gr.Slider(1,20,10,step=1,label="最多顯示筆數")
+
+        btn_filter = gr.Button("開始篩選", variant="primary")
+        filter_result = gr.Markdown()
+        btn_filter.click(
+            ui_filter,
+            inputs=[series_input,watt_lo, watt_hi, cct_lo, cct_hi, beam_lo, beam_hi, lumen_lo, lumen_hi, price_lo, price_hi, topk],
+            outputs=[filter_result]
+        )
+    return demo
+
 
 if __name__ == "__main__":
-    demo.launch()
+    import argparse
+    ap = argparse.ArgumentParser(description="燈具規格抽取：不帶參數啟動 Gradio 介面；指定 --pdf 則直接抽取並輸出 JSON")
+    ap.add_argument("--pdf", help="直接解析此 PDF（不開介面）")
+    ap.add_argument("--workers", type=int, default=MAX_WORKERS, help=f"同時處理頁數（預設 {MAX_WORKERS}）")
+    ap.add_argument("--checkpoint", default=CHECKPOINT_FILE, help=f"逐頁檢查點 JSONL（預設 {CHECKPOINT_FILE}）")
+    ap.add_argument("--no-triage", action="store_true", help="不做頁面分流，每頁都送 GPT-4o")
+    ap.add_argument("--out", default=DEFAULT_JSON, help=f"輸出 JSON（預設 {DEFAULT_JSON}）")
+    args = ap.parse_args()
+    if args.no_triage:
+        TRIAGE = False
+
+    if args.pdf:
+        print(parse_pdf_with_gpt4o(args.pdf, max_workers=args.workers, checkpoint=args.checkpoint, out=args.out))
+    else:
+        build_ui().launch()
@@ -1,5 +1,7 @@
 import os
 import json
+import time
+import argparse
 import pandas as pd
 
 # ==========================================
@@ -17,48 +19,75 @@ def find_excel_in_catalogs(folder="catalogs"):
 
 
 # ==========================================
-# 主要處理函式：Excel → JSON
+# 讀 Excel：只讀型號 / 品名兩欄，優先用 calamine（Rust）引擎
 # ==========================================
-def excel_to_json(excel_path, output_path):
-    print(f"📘 正在讀取 Excel：{excel_path}")
+MODEL_COLS = ["型號", "產品型號", "Product Code", "Model"]
+NAME_COLS = ["品名", "名稱", "Name"]
 
-    df = pd.read_excel(excel_path)
 
-    # 嘗試找欄位
-    possible_model_cols = ["型號", "產品型號", "Product Code", "Model"]
-    possible_name_cols = ["品名", "名稱", "Name"]
-
-    model_col = next((c for c in df.columns if c in possible_model_cols), None)
-    name_col = next((c for c in df.columns if c in possible_name_cols), None)
+def read_model_name(excel_path):
+    """回傳 (df, 型號欄, 品名欄)；df 只含這兩欄"""
+    wanted = set(MODEL_COLS) | set(NAME_COLS)
+    try:
+        df = pd.read_excel(excel_path, engine="calamine", usecols=lambda c: c in wanted)
+    except (ImportError, ValueError):
+        # 沒裝 python-calamine（或 pandas < 2.2 不認得 calamine）就退回 openpyxl
+        df = pd.read_excel(excel_path, engine="openpyxl", usecols=lambda c: c in wanted)
 
+    model_col = next((c for c in MODEL_COLS if c in df.columns), None)
+    name_col = next((c for c in NAME_COLS if c in df.columns), None)
     if not model_col or not name_col:
-        raise ValueError(f"Excel 必須包含：型號 / 品名 欄位，目前欄位為：{list(df.columns)}")
-
-    # --- 建立 series -> models 對照 ---
-    series_dict = {}
-
-    for _, row in df.iterrows():
-        model = str(row[model_col]).strip()
-        name = str(row[name_col]).strip()
-
-        if not model or model.lower() == "nan":
-            continue
-
-        # 系列名稱 = 品名空白前的中文字（依你 Excel 樣式）
-        # 例如：米開朗柔性軌道-12W投射排燈 → 系列：米開朗柔性軌道
-        series = name.split("-")[0].strip()
+        header = pd.read_excel(excel_path, nrows=0).columns
+        raise ValueError(f"Excel 必須包含：型號 / 品名 欄位，目前欄位為：{list(header)}")
+    return df, model_col, name_col
 
-        if series not in series_dict:
-            series_dict[series] = []
 
-        series_dict[series].append(model)
+# ==========================================
+# 主要處理函式：Excel → JSON
+# ==========================================
+def excel_to_json(excel_path, output_path, model_series_path=None):
+    print(f"📘 正在讀取 Excel：{excel_path}")
+    t0 = time.perf_counter()
+    df, model_col, name_col = read_model_name(excel_path)
+    t_read = time.perf_counter() - t0
+
+    # 與逐列 str(...).strip() 相同：空值變成 "nan"（pandas 3 的 astype(str) 會保留 NaN，所以先填）
+    model = df[model_col].fillna("nan").astype(str).str.strip()
+    name = df[name_col].fillna("nan").astype(str).str.strip()
+    keep = (model != "") & (model.str.lower() != "nan")
+    model, name = model[keep], name[keep]
+
+    # 系列名稱 = 品名第一個 "-" 前的文字（依你 Excel 樣式）
+    # 例如：米開朗柔性軌道-12W投射排燈 → 系列：米開朗柔性軌道
+    series = name.str.split("-", n=1).str[0].str.strip()
+
+    # --- 建立 series -> models 對照（系列依首次出現順序，型號保留原列順序）---
+    series_dict = model.groupby(series, sort=False).agg(list).to_dict()
+
+    # --- model -> series：同型號出現在多個系列時取第一個系列（依系列順序，同 merged-products 的反查）---
+    order = pd.Series(pd.factorize(series)[0], index=series.index)
+    first = order.sort_values(kind="stable").index
+    by_model = pd.DataFrame({"model": model[first], "series": series[first]})
+    dup = by_model.duplicated("model", keep="first")
+    model_to_series = dict(zip(by_model["model"][~dup], by_model["series"][~dup]))
+    conflicts = by_model[dup].merge(by_model[~dup], on="model", suffixes=("", "_first"))
+    conflicts = conflicts[conflicts["series"] != conflicts["series_first"]]
 
     # --- 輸出 JSON ---
     print(f" 輸出 JSON：{output_path}")
     with open(output_path, "w", encoding="utf-8") as f:
         json.dump(series_dict, f, ensure_ascii=False, indent=2)
 
-    print(f"✅ 完成！共 {len(series_dict)} 個系列。")
+    model_series_path = model_series_path or os.path.join(os.path.dirname(output_path), "model_series.json")
+    print(f" 輸出 JSON：{model_series_path}")
+    with open(model_series_path, "w", encoding="utf-8") as f:
+        json.dump(model_to_series, f, ensure_ascii=False, indent=2)
+
+    print(f"✅ 完成！{len(df)} 列 → {len(series_dict)} 個系列、{len(model_to_series)} 個型號"
+          f"（讀檔 {t_read:.2f} 秒，總計 {time.perf_counter() - t0:.2f} 秒）")
+    if len(conflicts):
+        print(f"⚠️ {conflicts['model'].nunique()} 個型號同時出現在多個系列，沿用第一個，例如："
+              f"{conflicts['model'].iloc[0]}（{conflicts['series_first'].iloc[0]} / {conflicts['series'].iloc[0]}）")
     return output_path
 
 
@@ -66,9 +95,16 @@ def excel_to_json(excel_path, output_path):
 # 主程式：自動偵測 Excel → JSON
 # ==========================================
 if __name__ == "__main__":
-    print("🔍 自動搜尋 catalogs 資料夾中的 Excel...")
-
-    excel_path = find_excel_in_catalogs("catalogs")
-    output_path = os.path.join("catalogs", "series.json")
-
-    excel_to_json(excel_path, output_path)
+    ap = argparse.ArgumentParser(description="Excel（型號/品名）→ series.json（系列 → 型號列表）+ model_series.json（型號 → 系列）")
+    ap.add_argument("--excel", help="Excel 路徑（預設自動搜尋 catalogs/ 內的 .xlsx）")
+    ap.add_argument("--out", default=os.path.join("catalogs", "series.json"), help="輸出 JSON（預設 catalogs/series.json）")
+    ap.add_argument("--model_out", help="型號 → 系列 JSON（預設與 --out 同資料夾的 model_series.json）")
+    args = ap.parse_args()
+
+    if args.excel:
+        excel_path = args.excel
+    else:
+        print("🔍 自動搜尋 catalogs 資料夾中的 Excel...")
+        excel_path = find_excel_in_catalogs("catalogs")
+
+    excel_to_json(excel_path, args.out, args.model_out)
@@ -6,6 +6,7 @@
 import os
 import json
 import re
+import argparse
 
 # === 基本路徑：以這支 py 檔所在的資料夾為基準 ===
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -13,6 +14,7 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # 這三個檔案都放在同一個資料夾（例如 c:\DanceLight\merging）
 PRODUCTS_FILE = os.path.join(BASE_DIR, "final_attribute_products.json")           # 原本的產品 JSON
 SERIES_FILE   = os.path.join(BASE_DIR, "series.json")                    # Excel 轉出的系列對照
+MODEL_SERIES_FILE = os.path.join(BASE_DIR, "model_series.json")          # series-extract.py 一併輸出的 型號 → 系列
 OUTPUT_FILE   = os.path.join(BASE_DIR, "final.json")  # 輸出檔案
 
 
@@ -32,19 +34,12 @@ def load_json(path: str):
     return data
 
 
-def main():
-    # 1) 讀入兩個 JSON
-    print(f"📥 讀取產品資料：{PRODUCTS_FILE}")
-    products = load_json(PRODUCTS_FILE)
-    if not isinstance(products, list):
-        raise ValueError(" merged_products.json 格式錯誤，最外層應該是陣列(list)。")
-
-    print(f"📥 讀取系列對照：{SERIES_FILE}")
-    series_map = load_json(SERIES_FILE)   # 預期格式：{ "系列名": ["D-XXXX", "D-YYYY", ...], ... }
+def invert_series(series_map) -> dict:
+    """series.json（系列 → 型號列表）反轉成 型號 → 系列。"""
+    # 預期格式：{ "系列名": ["D-XXXX", "D-YYYY", ...], ... }
     if not isinstance(series_map, dict):
         raise ValueError("series.json 格式錯誤，最外層應該是物件(dict)，內容為 系列名 → 型號列表。")
 
-    # 2) 反轉成 model -> series 的查表
     model_to_series = {}
     for series_name, models in series_map.items():
         if not isinstance(models, (list, tuple)):
@@ -61,10 +56,40 @@ def main():
                 )
                 continue
             model_to_series[code] = series_name
+    return model_to_series
+
+
+def main():
+    ap = argparse.ArgumentParser(description="刪掉中文 model 的系列列，並依 series.json 寫回 series 欄位")
+    ap.add_argument("--products", default=PRODUCTS_FILE, help=f"產品 JSON（預設 {PRODUCTS_FILE}）")
+    ap.add_argument("--series", help=f"系列對照 JSON（預設 {SERIES_FILE}）；指定時直接反轉它，不讀預設的 model_series.json")
+    ap.add_argument("--model_series",
+                    help=f"型號 → 系列 JSON（未指定 --series 時預設 {MODEL_SERIES_FILE}；不存在時改由 series.json 反轉）")
+    ap.add_argument("--out", default=OUTPUT_FILE, help=f"輸出檔案（預設 {OUTPUT_FILE}）")
+    args = ap.parse_args()
+
+    # 1) 讀入產品資料與 model -> series 查表
+    print(f"📥 讀取產品資料：{args.products}")
+    products = load_json(args.products)
+    if not isinstance(products, list):
+        raise ValueError(" merged_products.json 格式錯誤，最外層應該是陣列(list)。")
+
+    # 明確指定的檔案優先；只指定 --series 時不能拿預設的 model_series.json（可能是別份 Excel 的）
+    model_series = args.model_series or (None if args.series else MODEL_SERIES_FILE)
+    if model_series and (args.model_series or os.path.exists(model_series)):
+        # series-extract.py 已輸出現成的查表（同型號多系列時已取第一個），直接用
+        print(f"📥 讀取型號 → 系列對照：{model_series}")
+        model_to_series = load_json(model_series)
+        if not isinstance(model_to_series, dict):
+            raise ValueError("model_series.json 格式錯誤，最外層應該是物件(dict)，內容為 型號 → 系列名。")
+    else:
+        series_file = args.series or SERIES_FILE
+        print(f"📥 讀取系列對照：{series_file}")
+        model_to_series = invert_series(load_json(series_file))
 
     print(f"🔗 已建立 model → series 對照，共 {len(model_to_series)} 筆型號。")
 
-    # 3) 清掉 model 是中文的資料，並加上 series 欄位
+    # 2) 清掉 model 是中文的資料，並加上 series 欄位
     cleaned = []
     removed = 0
     added_series = 0
@@ -92,15 +117,15 @@ def main():
 
         cleaned.append(item)
 
-    # 4) 輸出新的 JSON
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+    # 3) 輸出新的 JSON
+    with open(args.out, "w", encoding="utf-8") as f:
         json.dump(cleaned, f, ensure_ascii=False, indent=2)
 
     print("處理完成！")
     print(f"   原始資料：{len(products)} 筆")
     print(f"   移除 model 為中文的系列列：{removed} 筆")
     print(f"   成功寫入 series 名稱：{added_series} 筆")
-    print(f"輸出檔案：{OUTPUT_FILE}")
+    print(f"輸出檔案：{args.out}")
 
 
 if __name__ == "__main__":
@@ -1,27 +1,54 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-import torch
 from PyQt5 import QtCore, QtGui, QtWidgets
 
-# 導入 RAG 類別與配置
-from docling_rag_v5 import DoclingRAGSystem, DoclingRAGConfig
+# 設定 DANCELIGHT_RAG_URL（例如 http://127.0.0.1:8765）時改連 rag_service，
+# 本機不載入模型；未設定時在程序內建立 RAGSystem
+RAG_SERVICE_URL = os.environ.get("DANCELIGHT_RAG_URL")
 
 # ---------- 後台運算執行緒 ----------
 class RAGWorker(QtCore.QThread):
     """處理 AI 檢索與回答，避免介面卡頓"""
     answer_ready = QtCore.pyqtSignal(dict)
 
-    def __init__(self, rag_system, question):
+    def __init__(self, chat_session, question):
         super().__init__()
-        self.rag_system = rag_system
+        self.chat_session = chat_session
         self.question = question
 
     def run(self):
-        # 呼叫 docling_rag_v5 裡的 query 功能
-        result = self.rag_system.query(self.question)
+        # 呼叫 ChatSession 或 RemoteChatSession 的 ask（保留對話脈絡）
+        try:
+            result = self.chat_session.ask(self.question)
+        except Exception as e:
+            print(f"RAG 查詢失敗：{e}")
+            result = {}
         self.answer_ready.emit(result)
 
+class RAGInitWorker(QtCore.QThread):
+    """背景載入型錄索引；模型另在 RAGSystem 的執行緒載入並暖機"""
+    index_ready = QtCore.pyqtSignal(object)
+    models_ready = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(str)
+
+    def run(self):
+        try:
+            from docling_rag_v5 import RAGSystem, Config
+            config = Config(
+                pdf_path="2025舞光LED21st(單頁水印可搜尋).pdf",
+                enable_ocr=True,
+                enable_query_expansion=False
+            )
+            system = RAGSystem(config)
+            # 索引就緒即返回，模型暖機完成後再發 models_ready
+            system.initialize(wait_for_models=False, on_ready=self.models_ready.emit)
+        except Exception as e:
+            print(f"RAG 初始化失敗：{e}")
+            self.failed.emit(str(e))
+            return
+        self.index_ready.emit(system)
+
 # ---------- 介面佈局類別 ----------
 class Ui_AIChatWindow(object):
     def setupUi(self, AIChatWindow):
@@ -123,22 +150,39 @@ class AIChatPage(QtWidgets.QMainWindow):
 
     def init_rag_after_show(self):
         """初始化 RAG 系統"""
-        print("正在載入 RAG 系統與模型...")
-        config = DoclingRAGConfig(
-            pdf_path="2025舞光LED21st(單頁水印可搜尋).pdf",
-            enable_ocr=True,
-            enable_query_expansion=False
-        )
-        self.rag_system = DoclingRAGSystem(config)
-        self.rag_system.initialize()
-        
-        # 解鎖介面
+        if RAG_SERVICE_URL:
+            from rag_service import RAGClient, RemoteChatSession
+            print(f"連線 RAG 服務：{RAG_SERVICE_URL}")
+            self.rag_system = RAGClient(RAG_SERVICE_URL)
+            self.on_index_ready(RemoteChatSession(self.rag_system))
+        else:
+            print("正在載入 RAG 系統與模型...")
+            self.ui.input_text.setPlaceholderText("正在載入型錄...")
+            self.init_worker = RAGInitWorker()
+            self.init_worker.index_ready.connect(self.on_local_index_ready)
+            self.init_worker.models_ready.connect(lambda: print("模型暖機完成"))
+            self.init_worker.failed.connect(self.on_init_failed)
+            self.init_worker.start()
+
+    def on_local_index_ready(self, rag_system):
+        from docling_rag_v5 import ChatSession
+        self.rag_system = rag_system
+        self.on_index_ready(ChatSession(rag_system))
+
+    def on_index_ready(self, chat_session):
+        # 索引載入即解鎖介面；模型若仍在載入，第一個查詢會等待其完成
+        # 同一視窗共用一個對話：追問會沿用上一輪的候選頁，不必重新檢索
+        self.chat_session = chat_session
         self.ui.input_text.setEnabled(True)
         self.ui.send_button.setEnabled(True)
         self.ui.input_text.setPlaceholderText("請輸入訊息...")
         self.ai_reply("您好！我是舞光 LED 客服 AI。已經為您載入最新 2025 型錄，請問想找什麼燈具嗎？")
         print("系統就緒")
 
+    def on_init_failed(self, error):
+        self.ui.input_text.setPlaceholderText("RAG 系統載入失敗")
+        self.ai_reply(f"抱歉，型錄載入失敗：{error}")
+
     def send_message(self):
         msg = self.ui.input_text.text().strip()
         if msg:
@@ -148,7 +192,7 @@ class AIChatPage(QtWidgets.QMainWindow):
             self.ui.input_text.setPlaceholderText("AI 正在檢索 388 頁型錄中...")
 
             # 啟動背景執行緒
-            self.worker = RAGWorker(self.rag_system, msg)
+            self.worker = RAGWorker(self.chat_session, msg)
             self.worker.answer_ready.connect(self.handle_ai_response)
             self.worker.start()
 
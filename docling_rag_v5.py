@@ -1,22 +1,34 @@
 import os
+import re
 import json
 import pickle
 import hashlib
+import heapq
+import math
+import queue
 import shutil
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field, replace
 from datetime import datetime
-from typing import Optional
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Optional
 
-import fitz
 import numpy as np
-import torch
-from openai import OpenAI
-from sentence_transformers import SentenceTransformer, CrossEncoder
+import tiktoken
 from tqdm import tqdm
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import PdfPipelineOptions
+
+from llm_client import shared_client
+from page_store import DEFAULT_ROOT as PAGE_STORE_ROOT, PageStore
+from rag_metrics import MetricsExporter, MetricsRegistry, QueryTrace
+
+# torch / sentence_transformers load with Models, fitz / docling only when a
+# reparse is needed, so importing this module stays cheap
+if TYPE_CHECKING:
+    from docling.document_converter import DocumentConverter
 
 
 @dataclass
@@ -26,6 +38,27 @@ class Config:
     temp_dir: str = "temp_pages"
     force_reparse: bool = False
     
+    # Per-page text / Docling markdown, content-addressed and shared with the
+    # attribute extractor (page_store.py): a new edition only converts the
+    # pages whose content changed, force_reparse converts them all again
+    page_store_dir: str = PAGE_STORE_ROOT
+    
+    # Catalogs: each {"path", "doc_id", "year"} gets its own cached shard
+    # (pages, embeddings, lexical index). Empty means just pdf_path. The first
+    # one is the primary and keeps parsed_data.pkl.
+    catalogs: list[dict] = field(default_factory=list)
+    shard_workers: int = 4
+    
+    # Background re-index: versions live in cache_dir/versions/, CURRENT
+    # names the live one. A stale cache at startup is served while rebuilding.
+    reindex_stale_in_background: bool = True
+    index_keep_versions: int = 3
+    
+    # Hybrid first stage: share of the (per-shard max-normalised) BM25 score
+    hybrid_weight: float = 0.0
+    bm25_k1: float = 1.2
+    bm25_b: float = 0.75
+    
     # Docling
     enable_ocr: bool = True
     enable_table_structure: bool = True
@@ -36,80 +69,424 @@ class Config:
     embedding_candidates: int = 40
     final_pages: int = 20
     reranker_batch_size: int = 8
+    embed_batch_size: int = 16
+    
+    # Cascade rerank: dense score prunes, the cross-encoder scores the rest
+    # in chunks and exits early once the top final_pages are separated
+    enable_cascade: bool = False
+    cascade_prune_margin: float = 0.15
+    cascade_chunk: int = 8
+    cascade_exit_margin: float = 0.02
     
-    # Query expansion
+    # Cross-request micro-batching of embed / rerank calls (rag_service)
+    enable_micro_batching: bool = False
+    batch_window_ms: float = 5.0
+    max_batch_texts: int = 32
+    max_batch_pairs: int = 128
+    
+    # Batching (token budget = batch size x longest sequence in the batch)
+    embed_batch_tokens: int = 16384
+    rerank_batch_tokens: int = 8192
+    max_doc_tokens: int = 8192
+    
+    # Inference backend: "torch" (fp32), "onnx" (onnxruntime, CPU) or "int8"
+    # (PyTorch dynamic quantization, CPU). onnx needs sentence-transformers>=4
+    # with optimum[onnxruntime]; onnx_file picks a pre-exported graph.
+    inference_backend: str = "torch"
+    onnx_file: Optional[str] = None
+    
+    # Concurrency: forward passes allowed in parallel per model; torch
+    # intra-op threads default to cpu_count split across the CPU slots
+    embed_concurrency: int = 1
+    rerank_concurrency: int = 1
+    torch_threads: Optional[int] = None
+    torch_interop_threads: Optional[int] = None
+    mps_empty_cache: bool = False
+    
+    # Query expansion (best effort: skipped when it misses its deadline)
     enable_query_expansion: bool = True
     expansion_model: str = "gpt-4o-mini"
     max_keywords: int = 5
+    expansion_deadline: float = 3.0
     
-    # Generation
+    # Generation. The prompt is laid out stable-first (system prompt, context
+    # in page order, history, question) so providers can reuse cached prefixes.
     generation_model: str = "gpt-4o"
+    system_prompt: str = "根據型錄內容詳細統整所有產品及規格，引用頁碼。"
     max_tokens: int = 10000
     temperature: float = 0.1
+    generation_deadline: float = 120.0
+    
+    # LLM client (shared process-wide, see llm_client.py)
+    llm_timeout: float = 60.0
+    llm_max_retries: int = 4
+    llm_max_concurrency: int = 8
+    
+    # Chat sessions: follow-ups rescore the previous turn's candidates by
+    # dense score and only re-retrieve when their best score trails the
+    # corpus-wide best by more than the drift threshold. A reused turn
+    # cross-encodes its top followup_rerank_candidates, so its scores are on
+    # the same scale as a fresh retrieval's (context_min_score, UI)
+    chat_history_turns: int = 4
+    chat_history_answer_tokens: int = 400
+    followup_drift_threshold: float = 0.05
+    followup_rerank_candidates: int = 20
+    
+    # Context assembly
+    context_token_budget: int = 8000
+    context_min_page_tokens: int = 200
+    context_min_score: float = 0.0
+    # Lines emitted only once per context: full-line matches of these
+    # patterns (image placeholders), plus watermark glyph runs (unmapped
+    # CJK Ext-A / private-use characters, no digits) repeated on at least
+    # boilerplate_min_ratio of a catalog's pages. Frequent labels such as
+    # 時價 or 產品型號 are content and are never dropped.
+    boilerplate_patterns: list[str] = field(default_factory=lambda: [r"<!--.*-->"])
+    boilerplate_min_ratio: float = 0.05
+    
+    # Metrics
+    query_cache_size: int = 256
+    metrics_window: int = 1000
+    metrics_export_path: Optional[str] = None
+    metrics_export_format: str = "jsonl"  # jsonl | prometheus
 
 
 @dataclass
 class Page:
     page_no: int
     content: str
+    doc_id: str = ""
     
     def to_dict(self):
         return asdict(self)
     
     @classmethod
-    def from_dict(cls, d: dict):
-        return cls(page_no=d["page_no"], content=d["content"])
+    def from_dict(cls, d: dict, doc_id: str = ""):
+        return cls(page_no=d["page_no"], content=d["content"], doc_id=d.get("doc_id", doc_id))
+
+
+@dataclass
+class Catalog:
+    path: str
+    doc_id: str
+    year: Optional[int] = None
+    primary: bool = False
+    
+    def cache_name(self) -> str:
+        if self.primary:
+            return "parsed_data.pkl"
+        return re.sub(r'[\\/:*?"<>|\s]', "_", self.doc_id) + ".pkl"
+
+
+def active_cache_dir(config: Config) -> Path:
+    """versions/<CURRENT> once the background indexer has published one, else cache_dir."""
+    root = Path(config.cache_dir)
+    try:
+        version = (root / "CURRENT").read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return root
+    path = root / "versions" / version
+    return path if version and path.is_dir() else root
+
+
+def catalogs_from_config(config: Config) -> list[Catalog]:
+    entries = config.catalogs or [{"path": config.pdf_path}]
+    return [
+        Catalog(
+            path=e["path"],
+            doc_id=e.get("doc_id") or Path(e["path"]).stem,
+            year=e.get("year"),
+            primary=(i == 0),
+        )
+        for i, e in enumerate(entries)
+    ]
+
+
+_LEX_TOKEN = re.compile(r"[a-z0-9]+(?:[-./][a-z0-9]+)*|[\u3400-\u9fff]+")
+
+
+def _lex_terms(text: str) -> list[str]:
+    # ASCII runs (model codes like d-fxtr7n, 3000k) stay whole; CJK runs become bigrams
+    terms = []
+    for run in _LEX_TOKEN.findall(text.lower()):
+        if run.isascii() or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+class LexicalIndex:
+    """BM25 over character bigrams, stored as CSR postings so it pickles compactly."""
+    
+    def __init__(self, vocab: dict[str, int], indptr: np.ndarray, docs: np.ndarray, tfs: np.ndarray, doc_len: np.ndarray):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.avg_len = float(doc_len.mean()) if len(doc_len) else 0.0
+    
+    @classmethod
+    def build(cls, texts: list[str]) -> "LexicalIndex":
+        postings: dict[str, list[tuple[int, int]]] = {}
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for i, text in enumerate(texts):
+            counts = Counter(_lex_terms(text))
+            doc_len[i] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((i, tf))
+        
+        vocab, indptr, docs, tfs = {}, [0], [], []
+        for j, (term, plist) in enumerate(postings.items()):
+            vocab[term] = j
+            docs.extend(d for d, _ in plist)
+            tfs.extend(tf for _, tf in plist)
+            indptr.append(len(docs))
+        return cls(
+            vocab, np.array(indptr, dtype=np.int64), np.array(docs, dtype=np.int32),
+            np.array(tfs, dtype=np.float32), doc_len,
+        )
+    
+    def to_dict(self) -> dict:
+        return {"vocab": self.vocab, "indptr": self.indptr, "docs": self.docs, "tfs": self.tfs, "doc_len": self.doc_len}
+    
+    @classmethod
+    def from_dict(cls, d: dict) -> "LexicalIndex":
+        return cls(d["vocab"], d["indptr"], d["docs"], d["tfs"], d["doc_len"])
+    
+    def score(self, query: str, k1: float = 1.2, b: float = 0.75) -> np.ndarray:
+        n = len(self.doc_len)
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(_lex_terms(query)):
+            j = self.vocab.get(term)
+            if j is None:
+                continue
+            lo, hi = self.indptr[j], self.indptr[j + 1]
+            docs, tf = self.docs[lo:hi], self.tfs[lo:hi]
+            idf = math.log(1 + (n - (hi - lo) + 0.5) / ((hi - lo) + 0.5))
+            norm = k1 * (1 - b + b * self.doc_len[docs] / self.avg_len)
+            scores[docs] += idf * tf * (k1 + 1) / (tf + norm)
+        return scores
+
+
+def _token_batches(lengths: list[int], max_tokens: int, max_size: int) -> list[list[int]]:
+    """Group indices longest-first so each padded batch stays under max_tokens."""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches, batch = [], []
+    for i in order:
+        # Sorted descending, so the first item sets the padded length
+        if batch and (len(batch) >= max_size or (len(batch) + 1) * lengths[batch[0]] > max_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
 
 
 class Models:
-    """Lazy-loaded singleton for ML models."""
+    """Lazy-loaded, thread-safe singleton for ML models."""
     _instance = None
+    _lock = threading.Lock()
     
     def __new__(cls, config: Config):
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            cls._instance._init_models(config)
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._init_models(config)
+                    # Publish only once fully loaded
+                    cls._instance = instance
         return cls._instance
     
     def _init_models(self, config: Config):
-        self.reranker_device = "mps" if torch.backends.mps.is_available() else "cpu"
-        print(f"Devices: Embedding(cpu) / Reranker({self.reranker_device})")
+        import torch
+        from sentence_transformers import SentenceTransformer, CrossEncoder
         
-        self.embedder = SentenceTransformer(config.embedding_model, device="cpu")
-        self.reranker = CrossEncoder(config.reranker_model, device=self.reranker_device)
+        self.config = config
+        backend = config.inference_backend
+        if backend not in ("torch", "onnx", "int8"):
+            raise ValueError(f"Unknown inference_backend: {backend}")
+        
+        # onnx / int8 are CPU-only paths
+        use_mps = backend == "torch" and torch.backends.mps.is_available()
+        self.reranker_device = "mps" if use_mps else "cpu"
+        print(f"Devices: Embedding(cpu) / Reranker({self.reranker_device}) [{backend}]")
+        
+        # Bound concurrent forward passes per model and split the CPU between
+        # them, so parallel callers don't oversubscribe torch's thread pools
+        self._embed_slots = threading.BoundedSemaphore(config.embed_concurrency)
+        self._rerank_slots = threading.BoundedSemaphore(config.rerank_concurrency)
+        cpu_slots = config.embed_concurrency + (config.rerank_concurrency if not use_mps else 0)
+        threads = config.torch_threads or max(1, (os.cpu_count() or 1) // cpu_slots)
+        torch.set_num_threads(threads)
+        if config.torch_interop_threads:
+            try:
+                torch.set_num_interop_threads(config.torch_interop_threads)
+            except RuntimeError:
+                print("torch inter-op threads already fixed for this process; ignoring torch_interop_threads")
+        print(f"Torch threads: intra-op {torch.get_num_threads()} / inter-op {torch.get_num_interop_threads()}")
+        
+        kwargs = {}
+        if backend == "onnx":
+            kwargs["backend"] = "onnx"
+            if config.onnx_file:
+                kwargs["model_kwargs"] = {"file_name": config.onnx_file}
+        
+        self.embedder = SentenceTransformer(config.embedding_model, device="cpu", **kwargs)
+        self.embedder.max_seq_length = config.max_doc_tokens
+        self.reranker = CrossEncoder(
+            config.reranker_model, device=self.reranker_device, max_length=config.max_doc_tokens, **kwargs
+        )
+        
+        if backend == "int8":
+            for module in (self.embedder[0].auto_model, self.reranker.model):
+                torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
         
-        self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        self.client = shared_client(
+            timeout=config.llm_timeout,
+            max_retries=config.llm_max_retries,
+            max_concurrency=config.llm_max_concurrency,
+        )
+    
+    def warmup(self):
+        """One tiny forward pass per model so the first real query skips lazy init."""
+        self.embed(["warmup"])
+        self.rerank("warmup", ["warmup"], 1)
+    
+    def _token_lengths(self, tokenizer, texts: list[str]) -> list[int]:
+        ids = tokenizer(texts, truncation=True, max_length=self.config.max_doc_tokens)["input_ids"]
+        return [len(x) for x in ids]
     
     def embed(self, texts: list[str]) -> np.ndarray:
-        return self.embedder.encode(
-            texts, normalize_embeddings=True, show_progress_bar=True,
-            batch_size=16, convert_to_numpy=True
-        )
+        lengths = self._token_lengths(self.embedder.tokenizer, texts)
+        batches = _token_batches(lengths, self.config.embed_batch_tokens, self.config.embed_batch_size)
+        
+        out = np.zeros((len(texts), self.embedder.get_sentence_embedding_dimension()), dtype=np.float32)
+        for batch in tqdm(batches, desc="Embedding", disable=len(batches) < 2):
+            with self._embed_slots:
+                out[batch] = self.embedder.encode(
+                    [texts[i] for i in batch], normalize_embeddings=True, show_progress_bar=False,
+                    batch_size=len(batch), convert_to_numpy=True
+                )
+        return out
     
     def rerank(self, query: str, docs: list[str], batch_size: int) -> np.ndarray:
-        if self.reranker_device == "mps":
-            torch.mps.empty_cache()
+        return self.rerank_pairs([(query, doc) for doc in docs], batch_size)
+    
+    def rerank_pairs(self, pairs: list[tuple[str, str]], batch_size: int) -> np.ndarray:
+        """Score (query, doc) pairs, possibly from several queries at once."""
+        if not pairs:
+            return np.zeros(0, dtype=np.float32)
         
-        pairs = [(query, doc) for doc in docs]
-        scores = self.reranker.predict(pairs, batch_size=batch_size, show_progress_bar=True)
+        queries = list(dict.fromkeys(q for q, _ in pairs))
+        q_lens = dict(zip(queries, self._token_lengths(self.reranker.tokenizer, queries)))
+        doc_lens = self._token_lengths(self.reranker.tokenizer, [d for _, d in pairs])
+        lengths = [min(q_lens[q] + n, self.config.max_doc_tokens) for (q, _), n in zip(pairs, doc_lens)]
+        batches = _token_batches(lengths, self.config.rerank_batch_tokens, batch_size)
         
-        if self.reranker_device == "mps":
-            torch.mps.empty_cache()
+        scores = np.zeros(len(pairs), dtype=np.float32)
+        with self._rerank_slots:
+            for batch in batches:
+                scores[batch] = self.reranker.predict(
+                    [pairs[i] for i in batch], batch_size=len(batch), show_progress_bar=False
+                )
+            if self.reranker_device == "mps" and self.config.mps_empty_cache:
+                import torch
+                torch.mps.empty_cache()
         
-        return np.array(scores)
+        return scores
+
+
+class BatchScheduler:
+    """Coalesces concurrent embed / rerank calls into shared forward passes.
+    
+    Wraps Models with the same embed / rerank interface; calls that arrive
+    within batch_window_ms are packed together and answered through futures.
+    Everything else is delegated to the wrapped Models.
+    """
+    
+    def __init__(self, models: Models, config: Config):
+        self.models = models
+        self.config = config
+        self._window = config.batch_window_ms / 1000
+        self._embed_q: queue.Queue = queue.Queue()
+        self._rerank_q: queue.Queue = queue.Queue()
+        for args in (
+            (self._embed_q, config.max_batch_texts, self._run_embed),
+            (self._rerank_q, config.max_batch_pairs, self._run_rerank),
+        ):
+            threading.Thread(target=self._loop, args=args, daemon=True).start()
+    
+    def __getattr__(self, name):
+        return getattr(self.models, name)
+    
+    def embed(self, texts: list[str]) -> np.ndarray:
+        future = Future()
+        self._embed_q.put((texts, future))
+        return future.result()
+    
+    def rerank(self, query: str, docs: list[str], batch_size: int) -> np.ndarray:
+        future = Future()
+        self._rerank_q.put(([(query, doc) for doc in docs], future))
+        return future.result()
+    
+    def _loop(self, jobs: queue.Queue, limit: int, run: Callable):
+        while True:
+            batch = [jobs.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self._window
+            while size < limit:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    job = jobs.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(job)
+                size += len(job[0])
+            
+            items = [x for job, _ in batch for x in job]
+            try:
+                out = run(items)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            i = 0
+            for job, future in batch:
+                future.set_result(out[i:i + len(job)])
+                i += len(job)
+    
+    def _run_embed(self, texts: list[str]) -> np.ndarray:
+        return self.models.embed(texts)
+    
+    def _run_rerank(self, pairs: list[tuple[str, str]]) -> np.ndarray:
+        return self.models.rerank_pairs(pairs, self.config.reranker_batch_size)
 
 
 class PDFParser:
-    def __init__(self, config: Config, models: Models):
+    """Parses one catalog into its own cache file; other catalogs are untouched."""
+    
+    def __init__(self, config: Config, catalog: Catalog, cache_dir: Optional[Path] = None):
         self.config = config
-        self.models = models
-        self.cache_file = Path(config.cache_dir) / "parsed_data.pkl"
-        Path(config.cache_dir).mkdir(exist_ok=True)
+        self.catalog = catalog
+        cache_dir = Path(cache_dir or config.cache_dir)
+        self.cache_file = cache_dir / catalog.cache_name()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.store = PageStore(config.page_store_dir)
         self._converter = None
     
     @property
-    def converter(self) -> DocumentConverter:
+    def converter(self) -> "DocumentConverter":
         if self._converter is None:
+            from docling.document_converter import DocumentConverter, PdfFormatOption
+            from docling.datamodel.base_models import InputFormat
+            from docling.datamodel.pipeline_options import PdfPipelineOptions
+            
             opts = PdfPipelineOptions()
             opts.do_ocr = self.config.enable_ocr
             opts.do_table_structure = self.config.enable_table_structure
@@ -121,102 +498,638 @@ class PDFParser:
             )
         return self._converter
     
-    def parse(self) -> tuple[list[Page], np.ndarray]:
-        if self._cache_valid():
-            return self._load_cache()
+    def parse(self, models: Models) -> "Shard":
+        cached = self.load_cache()
+        if cached is not None:
+            return cached
         
         pages = self._extract_pages()
-        embeddings = self.models.embed([p.content for p in pages])
-        self._save_cache(pages, embeddings)
-        return pages, embeddings
+        embeddings = models.embed([p.content for p in pages])
+        lexical = LexicalIndex.build([p.content for p in pages])
+        self._save_cache(pages, embeddings, lexical)
+        return Shard(self.catalog, pages, embeddings, lexical)
     
-    def _cache_valid(self) -> bool:
+    def load_cache(self, check_hash: bool = True) -> Optional["Shard"]:
+        """The cached shard, or None if a reparse is needed.
+        
+        check_hash=False accepts a cache built from an older edition of the PDF.
+        """
         if self.config.force_reparse or not self.cache_file.exists():
-            return False
+            return None
         try:
             with open(self.cache_file, "rb") as f:
-                cached = pickle.load(f)
-            return cached.get("pdf_hash") == self._pdf_hash()
+                data = pickle.load(f)
         except Exception:
-            return False
+            return None
+        
+        if not Path(self.catalog.path).exists():
+            print(f"{self.catalog.path} not found; using cache as-is")
+        elif check_hash and data.get("pdf_hash") != self._pdf_hash():
+            return None
+        
+        pages = [Page.from_dict(p, self.catalog.doc_id) for p in data["pages"]]
+        # Caches written before lexical indexing get one built on load
+        lexical = (
+            LexicalIndex.from_dict(data["lexical"]) if "lexical" in data
+            else LexicalIndex.build([p.content for p in pages])
+        )
+        print(f"Loaded {len(pages)} pages of {self.catalog.doc_id} from cache")
+        return Shard(self.catalog, pages, data["embeddings"], lexical)
     
     def _pdf_hash(self) -> str:
-        with open(self.config.pdf_path, "rb") as f:
+        with open(self.catalog.path, "rb") as f:
             return hashlib.md5(f.read(1024 * 1024)).hexdigest()
     
+    def docling_variant(self) -> str:
+        """Page-store variant name: markdown depends on the Docling options."""
+        return f"ocr{int(self.config.enable_ocr)}-tables{int(self.config.enable_table_structure)}"
+    
     def _extract_pages(self) -> list[Page]:
-        temp_dir = Path(self.config.temp_dir)
-        temp_dir.mkdir(exist_ok=True)
-        
-        try:
-            pdf = fitz.open(self.config.pdf_path)
-            pages = []
-            
-            for i in tqdm(range(len(pdf)), desc="Parsing pages"):
-                page_path = temp_dir / f"page_{i+1:04d}.pdf"
-                
-                # Split single page
-                single = fitz.open()
-                single.insert_pdf(pdf, from_page=i, to_page=i)
-                single.save(str(page_path))
-                single.close()
-                
-                # Extract with Docling
-                result = self.converter.convert(str(page_path))
-                md = result.document.export_to_markdown().strip()
-                if md:
-                    pages.append(Page(page_no=i + 1, content=md))
-            
-            pdf.close()
-            return pages
-        finally:
-            if temp_dir.exists():
-                shutil.rmtree(temp_dir)
+        variant = self.docling_variant()
+        # Only pages missing from the store go through Docling (one page at a time)
+        edition = self.store.ingest(
+            self.catalog.path,
+            convert=lambda path: self.converter.convert(path),
+            variant=variant,
+            refresh=self.config.force_reparse,
+            temp_dir=self.config.temp_dir,
+            progress=lambda todo: tqdm(todo, desc=f"Parsing {self.catalog.doc_id}"),
+        )
+        pages = []
+        for page_no in range(1, len(edition) + 1):
+            md = edition.markdown(page_no, variant)
+            if md:
+                pages.append(Page(page_no=page_no, content=md, doc_id=self.catalog.doc_id))
+        return pages
     
-    def _save_cache(self, pages: list[Page], embeddings: np.ndarray):
+    def _save_cache(self, pages: list[Page], embeddings: np.ndarray, lexical: LexicalIndex):
         data = {
+            "pdf_path": self.catalog.path,
+            "doc_id": self.catalog.doc_id,
             "pdf_hash": self._pdf_hash(),
             "parsed_at": datetime.now().isoformat(),
             "pages": [p.to_dict() for p in pages],
             "embeddings": embeddings,
+            "lexical": lexical.to_dict(),
         }
         with open(self.cache_file, "wb") as f:
             pickle.dump(data, f)
-        print(f"Cached {len(pages)} pages")
+        print(f"Cached {len(pages)} pages of {self.catalog.doc_id}")
+
+
+class Shard:
+    """One catalog's pages, embeddings and lexical index."""
+    
+    def __init__(self, catalog: Catalog, pages: list[Page], embeddings: np.ndarray, lexical: LexicalIndex):
+        self.catalog = catalog
+        self.pages = pages
+        self.embeddings = embeddings
+        self.lexical = lexical
+    
+    def search(self, q_emb: np.ndarray, query: str, k: int, config: Config) -> list[tuple[Page, float]]:
+        scores = self.embeddings @ q_emb
+        if config.hybrid_weight > 0:
+            lex = self.lexical.score(query, config.bm25_k1, config.bm25_b)
+            if lex.max() > 0:
+                scores = (1 - config.hybrid_weight) * scores + config.hybrid_weight * lex / lex.max()
+        top_idx = np.argsort(-scores)[:k]
+        return [(self.pages[i], float(scores[i])) for i in top_idx]
+
+
+class CatalogIndex:
+    """All shards; a search fans out across the selected ones and merges the top-k."""
+    
+    def __init__(self, config: Config, shards: list[Shard], version: Optional[str] = None, stale: bool = False):
+        self.config = config
+        self.shards = shards
+        self.version = version
+        self.stale = stale
+        self.pages = [p for s in shards for p in s.pages]
+        self._rows = {id(p): (s, i) for s in shards for i, p in enumerate(s.pages)}
+        self._pool: Optional[ThreadPoolExecutor] = None
+    
+    @classmethod
+    def load(
+        cls, config: Config, models: Callable[[], Models],
+        cache_dir: Optional[Path] = None, allow_stale: bool = False,
+    ) -> "CatalogIndex":
+        """Cached shards load as-is; only catalogs without a valid cache are parsed.
+        
+        With allow_stale, a cache from an older edition is served instead of
+        blocking on a reparse, and the index is marked stale.
+        """
+        cache_dir = Path(cache_dir or active_cache_dir(config))
+        published = cache_dir.parent.name == "versions"
+        shards, stale = [], False
+        for catalog in catalogs_from_config(config):
+            parser = PDFParser(config, catalog, cache_dir)
+            shard = parser.load_cache()
+            if shard is None and allow_stale:
+                shard = parser.load_cache(check_hash=False)
+                stale = stale or shard is not None
+            if shard is None and published:
+                # Never parse into a published version: build the next one
+                # beside it (reusing its valid shards) and make that current
+                index = build_version(config, cache_dir, models)
+                publish_version(Path(config.cache_dir), index.version)
+                return index
+            shards.append(shard or parser.parse(models()))
+        
+        version = cache_dir.name if cache_dir.parent.name == "versions" else None
+        return cls(config, shards, version, stale)
+    
+    def vectors(self, pages: list[Page]) -> np.ndarray:
+        """Stored embeddings of pages taken from this index."""
+        return np.stack([self._rows[id(p)][0].embeddings[self._rows[id(p)][1]] for p in pages])
+    
+    def best_dense(
+        self, q_emb: np.ndarray, doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+    ) -> float:
+        return max((float((s.embeddings @ q_emb).max()) for s in self.select(doc_ids, years)), default=0.0)
+    
+    def select(self, doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None) -> list[Shard]:
+        return [
+            s for s in self.shards
+            if (not doc_ids or s.catalog.doc_id in doc_ids) and (not years or s.catalog.year in years)
+        ]
+    
+    def search(
+        self, q_emb: np.ndarray, query: str, k: int,
+        doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+    ) -> list[tuple[Page, float]]:
+        shards = self.select(doc_ids, years)
+        if len(shards) <= 1:
+            return shards[0].search(q_emb, query, k, self.config) if shards else []
+        
+        # numpy releases the GIL in the matmuls, so threads run shards in parallel
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.config.shard_workers, thread_name_prefix="rag-shard")
+        futures = [self._pool.submit(s.search, q_emb, query, k, self.config) for s in shards]
+        return heapq.nlargest(k, (hit for f in futures for hit in f.result()), key=lambda x: x[1])
+
+
+def publish_version(root: Path, version: str):
+    """Point root/CURRENT at versions/<version> atomically."""
+    tmp = root / "CURRENT.tmp"
+    tmp.write_text(version, encoding="utf-8")
+    os.replace(tmp, root / "CURRENT")
+
+
+def build_version(
+    config: Config, live: Path, models: Callable[[], Models],
+    verify: Optional[Callable[["CatalogIndex"], None]] = None,
+) -> "CatalogIndex":
+    """Build a new versions/<version>/ for config's catalogs; returns its index.
+    
+    Shards still valid in live are copied, the rest are parsed. Everything is
+    written under versions/<version>.partial and renamed into place only after
+    verify passes, so a published version is never modified. CURRENT is left
+    to the caller.
+    """
+    versions_dir = Path(config.cache_dir) / "versions"
+    version = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    staging = versions_dir / f"{version}.partial"
+    
+    shards = []
+    for catalog in catalogs_from_config(config):
+        previous = PDFParser(config, catalog, live)
+        parser = PDFParser(config, catalog, staging)
+        shard = previous.load_cache()
+        if shard is not None:
+            shutil.copy2(previous.cache_file, parser.cache_file)
+        else:
+            shard = parser.parse(models())
+        shards.append(shard)
+    
+    index = CatalogIndex(config, shards, version)
+    if verify is not None:
+        verify(index)
+    manifest = {
+        "version": version,
+        "created_at": datetime.now().isoformat(),
+        "catalogs": [{"path": c.path, "doc_id": c.doc_id, "year": c.year} for c in catalogs_from_config(config)],
+        "pages": {s.catalog.doc_id: len(s.pages) for s in shards},
+    }
+    (staging / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(staging, versions_dir / version)
+    return index
+
+
+class BackgroundIndexer:
+    """Rebuilds the corpus into a new versioned cache dir while the live index serves.
+    
+    cache_dir/versions/<version>/ holds one shard cache per catalog plus a
+    manifest.json; cache_dir/CURRENT names the live version. Catalogs whose
+    PDF is unchanged are copied from the live version instead of re-embedded.
+    After verification the new index is swapped into the RAGSystem; older
+    versions stay on disk for rollback().
+    """
+    
+    def __init__(self, system: "RAGSystem"):
+        self.system = system
+        self.root = Path(system.config.cache_dir)
+        self.versions_dir = self.root / "versions"
+        self.last_error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+    
+    def start(self, catalogs: Optional[list[dict]] = None) -> bool:
+        """Rebuild on a background thread; False if a rebuild is already running."""
+        if not self._lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._run, args=(catalogs,), name="rag-indexer", daemon=True).start()
+        return True
+    
+    def _run(self, catalogs: Optional[list[dict]]):
+        try:
+            self._rebuild(catalogs)
+        except Exception as e:
+            self.last_error = e
+            print(f"Re-index failed, still serving {self.system.index.version or 'the current index'}: {e}")
+        finally:
+            self._lock.release()
+    
+    def rebuild(self, catalogs: Optional[list[dict]] = None) -> str:
+        """Synchronous rebuild; returns the new version."""
+        with self._lock:
+            return self._rebuild(catalogs)
+    
+    def _rebuild(self, catalogs: Optional[list[dict]]) -> str:
+        config = self.system.config if catalogs is None else replace(self.system.config, catalogs=catalogs)
+        # Leftovers of a failed rebuild (we hold the lock, so none is running)
+        for d in self.versions_dir.glob("*.partial"):
+            shutil.rmtree(d, ignore_errors=True)
+        
+        t0 = time.perf_counter()
+        index = build_version(config, active_cache_dir(self.system.config), lambda: self.system.models, self._verify)
+        self.system.swap_index(index, config)
+        publish_version(self.root, index.version)
+        self._prune()
+        print(f"Index {index.version} live: {len(index.pages)} pages ({time.perf_counter() - t0:.1f}s)")
+        return index.version
+    
+    def _verify(self, index: CatalogIndex):
+        live = self.system.index.shards
+        dim = live[0].embeddings.shape[1] if live else None
+        for shard in index.shards:
+            n, doc = len(shard.pages), shard.catalog.doc_id
+            emb = shard.embeddings
+            if n == 0:
+                raise ValueError(f"{doc}: no pages")
+            if emb.ndim != 2 or emb.shape[0] != n or (dim and emb.shape[1] != dim):
+                raise ValueError(f"{doc}: embeddings {emb.shape} do not match {n} pages x {dim}")
+            if not np.isfinite(emb).all() or not np.allclose(np.linalg.norm(emb, axis=1), 1.0, atol=1e-2):
+                raise ValueError(f"{doc}: embeddings are not finite unit vectors")
+            if len(shard.lexical.doc_len) != n:
+                raise ValueError(f"{doc}: lexical index covers {len(shard.lexical.doc_len)} of {n} pages")
+    
+    def versions(self) -> list[str]:
+        if not self.versions_dir.exists():
+            return []
+        return sorted(
+            d.name for d in self.versions_dir.iterdir()
+            if d.is_dir() and not d.name.endswith(".partial") and (d / "manifest.json").exists()
+        )
+    
+    def _prune(self):
+        keep = max(2, self.system.config.index_keep_versions)
+        for version in self.versions()[:-keep]:
+            shutil.rmtree(self.versions_dir / version, ignore_errors=True)
+    
+    def rollback(self) -> str:
+        """Swap back to the version before the live one; returns it."""
+        with self._lock:
+            versions = self.versions()
+            current = self.system.index.version
+            if current is None:
+                raise RuntimeError("The live index is not a published version; nothing to roll back from")
+            older = [v for v in versions if v < current]
+            if not older:
+                raise RuntimeError("No earlier index version to roll back to")
+            version = older[-1]
+            
+            path = self.versions_dir / version
+            manifest = json.loads((path / "manifest.json").read_text(encoding="utf-8"))
+            config = replace(self.system.config, catalogs=manifest["catalogs"])
+            shards = []
+            for catalog in catalogs_from_config(config):
+                shard = PDFParser(config, catalog, path).load_cache(check_hash=False)
+                if shard is None:
+                    raise RuntimeError(f"Version {version} is missing {catalog.doc_id}")
+                shards.append(shard)
+            
+            index = CatalogIndex(config, shards, version)
+            self._verify(index)
+            self.system.swap_index(index, config)
+            publish_version(self.root, version)
+            print(f"Rolled back to index {version}")
+            return version
+
+
+class _CharTokenizer:
+    """tiktoken stand-in: one token per non-ASCII character, one per 4 ASCII characters.
     
-    def _load_cache(self) -> tuple[list[Page], np.ndarray]:
-        with open(self.cache_file, "rb") as f:
-            data = pickle.load(f)
-        pages = [Page.from_dict(p) for p in data["pages"]]
-        print(f"Loaded {len(pages)} pages from cache")
-        return pages, data["embeddings"]
+    Close to o200k_base on the catalog's CJK text; token budgets stay
+    approximate but context packing and truncation keep working.
+    """
+    
+    _PIECE = re.compile(r"[\x00-\x7f]{1,4}|[^\x00-\x7f]", re.S)
+    
+    def encode(self, text: str, disallowed_special=()) -> list[str]:
+        return self._PIECE.findall(text)
+    
+    def decode(self, tokens: list[str]) -> str:
+        return "".join(tokens)
+
+
+@lru_cache(maxsize=None)
+def _load_tokenizer(model: str):
+    """tiktoken encoding for model, or _CharTokenizer when it cannot be loaded.
+    
+    tiktoken downloads its BPE files on first use; offline hosts need them in
+    TIKTOKEN_CACHE_DIR, otherwise token counts fall back to an estimate.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"tiktoken encoding unavailable ({type(e).__name__}: {e}); estimating tokens from characters")
+        return _CharTokenizer()
+
+
+class ContextBuilder:
+    """Packs ranked pages into a token-budgeted context block."""
+    
+    def __init__(self, config: Config):
+        self.config = config
+        self.boilerplate: set[str] = set()
+        self.tokenizer = _load_tokenizer(config.generation_model)
+    
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, disallowed_special=()))
+    
+    def truncate_tokens(self, text: str, max_tokens: int) -> str:
+        tokens = self.tokenizer.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else self.tokenizer.decode(tokens[:max_tokens])
+    
+    # Text from fonts without a Unicode map (the catalog watermark) decodes to
+    # rare CJK Extension A / private-use code points
+    _GLYPH_JUNK = re.compile(r"[\u3400-\u4dbf\ue000-\uf8ff]")
+    
+    def index(self, pages: list[Page]):
+        # Only explicit placeholders and repeated watermark glyph runs are
+        # boilerplate; repeated words are usually field labels (時價, 燈體材質)
+        # that the values on the page need.
+        patterns = [re.compile(p) for p in self.config.boilerplate_patterns]
+        by_doc: dict[str, list[Page]] = {}
+        for p in pages:
+            by_doc.setdefault(p.doc_id, []).append(p)
+        
+        boilerplate = set()
+        for doc_pages in by_doc.values():
+            counts = Counter()
+            for p in doc_pages:
+                counts.update({line.strip() for line in p.content.splitlines() if line.strip()})
+            min_pages = max(2, int(len(doc_pages) * self.config.boilerplate_min_ratio))
+            for line, n in counts.items():
+                if any(rx.fullmatch(line) for rx in patterns):
+                    boilerplate.add(line)
+                elif n >= min_pages and self._is_watermark(line):
+                    boilerplate.add(line)
+        self.boilerplate = boilerplate
+    
+    @classmethod
+    def _is_watermark(cls, line: str) -> bool:
+        return bool(cls._GLYPH_JUNK.search(line)) and not any(ch.isdigit() for ch in line)
+    
+    def build(self, pages: list[tuple[Page, float]]) -> tuple[str, list[tuple[Page, float]], int]:
+        """Fill the token budget in score order; returns (context, used pages, tokens).
+        
+        The chosen pages are laid out in catalog/page order without scores, so
+        the same or overlapping retrievals produce the same prompt prefix.
+        """
+        budget = self.config.context_token_budget
+        sep = self.count_tokens("\n\n")
+        seen: set[str] = set()
+        picked, used, total = [], [], 0
+        # Name the catalog only when pages come from more than one
+        multi_doc = len({p.doc_id for p, _ in pages}) > 1
+        
+        for page, score in sorted(pages, key=lambda x: x[1], reverse=True):
+            if score < self.config.context_min_score:
+                break
+            
+            text = self._dedupe(page.content, seen)
+            if not text:
+                continue
+            
+            n = self.count_tokens(self._block(page, text, multi_doc))
+            remaining = budget - total - (sep if picked else 0)
+            limit = None
+            if n > remaining:
+                if remaining < self.config.context_min_page_tokens:
+                    break
+                limit = n = remaining
+            
+            total += n + (sep if picked else 0)
+            picked.append((page, limit))
+            used.append((page, score))
+        
+        # Lay out in page order; repeated lines stay on the first page in that order
+        seen, blocks = set(), []
+        for page, limit in sorted(picked, key=lambda x: (x[0].doc_id, x[0].page_no)):
+            text = self._dedupe(page.content, seen)
+            if not text:
+                continue
+            block = self._block(page, text, multi_doc)
+            blocks.append(self.truncate_tokens(block, limit) if limit else block)
+        
+        context = "\n\n".join(blocks)
+        tokens = self.count_tokens(context)
+        if tokens > budget:
+            # Boilerplate moving between pages can shift a few tokens
+            context = self.truncate_tokens(context, budget)
+            tokens = self.count_tokens(context)
+        return context, used, tokens
+    
+    @staticmethod
+    def _block(page: Page, text: str, multi_doc: bool) -> str:
+        label = f"{page.doc_id} Page {page.page_no}" if multi_doc else f"Page {page.page_no}"
+        return f"【{label}】\n{text}"
+    
+    def _dedupe(self, content: str, seen: set[str]) -> str:
+        lines = []
+        for line in content.splitlines():
+            key = line.strip()
+            if key in self.boilerplate:
+                if key in seen:
+                    continue
+                seen.add(key)
+            lines.append(line)
+        return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
 
 
 class RAGSystem:
     def __init__(self, config: Config):
         self.config = config
-        self.models = Models(config)
-        self.parser = PDFParser(config, self.models)
-        self.pages: list[Page] = []
-        self.embeddings: Optional[np.ndarray] = None
+        self.context_builder = ContextBuilder(config)
+        self.index = CatalogIndex(config, [])
+        self.indexer = BackgroundIndexer(self)
+        
+        # Models load on a background thread; `models` blocks until ready
+        self._models = None
+        self._models_error: Optional[BaseException] = None
+        self._models_ready = threading.Event()
+        self._loader: Optional[threading.Thread] = None
+        self._loader_lock = threading.Lock()
+        
+        self.metrics = MetricsRegistry(config.metrics_window)
+        self.exporter = (
+            MetricsExporter(config.metrics_export_path, config.metrics_export_format)
+            if config.metrics_export_path else None
+        )
+        self._query_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+    
+    @property
+    def pages(self) -> list[Page]:
+        return self.index.pages
     
-    def initialize(self):
+    @property
+    def models(self):
+        if not self._models_ready.is_set():
+            self.load_models()
+            self._models_ready.wait()
+        if self._models_error is not None:
+            raise RuntimeError("Model loading failed") from self._models_error
+        return self._models
+    
+    @property
+    def models_ready(self) -> bool:
+        return self._models_ready.is_set()
+    
+    def load_models(self, warmup: bool = False, on_ready: Optional[Callable[[], None]] = None):
+        """Start loading models in the background; no-op if already started."""
+        with self._loader_lock:
+            if self._loader is None:
+                self._loader = threading.Thread(
+                    target=self._load_models, args=(warmup, on_ready), name="rag-models", daemon=True
+                )
+                self._loader.start()
+    
+    def _load_models(self, warmup: bool, on_ready: Optional[Callable[[], None]]):
+        try:
+            models = Models(self.config)
+            if self.config.enable_micro_batching:
+                models = BatchScheduler(models, self.config)
+            self._models = models
+        except BaseException as e:
+            self._models_error = e
+        finally:
+            self._models_ready.set()
+        
+        if self._models_error is None:
+            if warmup:
+                t0 = time.perf_counter()
+                self._models.warmup()
+                print(f"Models warm ({time.perf_counter() - t0:.1f}s)")
+            if on_ready:
+                on_ready()
+    
+    def initialize(self, wait_for_models: bool = True, on_ready: Optional[Callable[[], None]] = None):
+        """Load the index while models load in parallel.
+        
+        With wait_for_models=False this returns as soon as the index is ready;
+        on_ready fires from the loader thread once the models are warm.
+        """
         print("Initializing...")
-        self.pages, self.embeddings = self.parser.parse()
-        print(f"Ready: {len(self.pages)} pages indexed")
+        self.load_models(warmup=True, on_ready=on_ready)
+        
+        self.index = CatalogIndex.load(
+            self.config, lambda: self.models, allow_stale=self.config.reindex_stale_in_background
+        )
+        self.context_builder.index(self.pages)
+        print(f"Ready: {len(self.pages)} pages indexed across {len(self.index.shards)} catalog(s)")
+        if self.index.stale:
+            print("Cache is from an older catalog edition; re-indexing in the background")
+            self.indexer.start()
+        
+        if wait_for_models:
+            self.models
+    
+    def swap_index(self, index: CatalogIndex, config: Optional[Config] = None):
+        """Make `index` live. In-flight queries finish on the index they started with."""
+        builder = ContextBuilder(config or self.config)
+        builder.index(index.pages)
+        if config is not None:
+            self.config = config
+        # Single reference assignments; readers take one snapshot of each
+        self.context_builder = builder
+        self.index = index
     
-    def query(self, question: str) -> dict:
-        # Expand query
-        expanded = self._expand_query(question) if self.config.enable_query_expansion else question
+    def query(
+        self, question: str, on_token: Optional[Callable[[str], None]] = None,
+        doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+    ) -> dict:
+        trace = QueryTrace()
+        ranked = self.retrieve(question, trace, doc_ids, years)
+        return self.answer(question, ranked, trace, on_token)
+    
+    def expand(self, question: str, trace: QueryTrace) -> str:
+        """Query expansion: a network LLM call, so callers that bound CPU work
+        run it outside that bound and pass the result to retrieve()."""
+        with trace.stage("expansion"):
+            return self._expand_query(question, trace) if self.config.enable_query_expansion else question
+    
+    def retrieve(
+        self, question: str, trace: QueryTrace,
+        doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+        expanded: Optional[str] = None,
+    ) -> list[tuple[Page, float]]:
+        """Embedding filter and rerank, after expand() unless expanded is given.
+        
+        doc_ids / years restrict the search to matching catalogs.
+        """
+        return self._retrieve(question, trace, doc_ids, years, expanded)[1]
+    
+    def _retrieve(
+        self, question: str, trace: QueryTrace,
+        doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+        expanded: Optional[str] = None,
+    ) -> tuple[list[tuple[Page, float]], list[tuple[Page, float]]]:
+        """(embedding candidates, reranked pages)"""
+        if expanded is None:
+            expanded = self.expand(question, trace)
         
         # Two-stage retrieval
-        candidates = self._embedding_filter(expanded)
-        ranked = self._rerank(expanded, candidates)
+        candidates = self._embedding_filter(expanded, trace, doc_ids, years)
+        with trace.stage("rerank"):
+            return candidates, self._rerank(expanded, candidates, trace)
+    
+    def answer(
+        self, question: str, ranked: list[tuple[Page, float]], trace: QueryTrace,
+        on_token: Optional[Callable[[str], None]] = None,
+        history: Optional[list[dict]] = None,
+    ) -> dict:
+        """Generate from retrieved pages, streaming deltas to on_token, and record metrics.
+        
+        history: earlier chat turns as OpenAI messages, placed before the question.
+        """
+        result = self._generate(question, ranked, trace, on_token, history)
+        result["retrieved"] = [p.page_no for p, _ in ranked]
+        result["metrics"] = trace.to_dict()
         
-        # Generate
-        return self._generate(question, ranked)
+        self.metrics.record(trace)
+        if self.exporter:
+            self.exporter.export(self.metrics, trace)
+        return result
     
-    def _expand_query(self, query: str) -> str:
+    def _expand_query(self, query: str, trace: QueryTrace) -> str:
         try:
             resp = self.models.client.chat.completions.create(
                 model=self.config.expansion_model,
@@ -227,68 +1140,262 @@ class RAGSystem:
                 temperature=0.3,
                 max_tokens=100,
                 response_format={"type": "json_object"},
+                deadline=self.config.expansion_deadline,
             )
             kw = json.loads(resp.choices[0].message.content).get("keywords", [])
             return f"{query} {' '.join(kw)}" if kw else query
-        except Exception:
+        except Exception as e:
+            print(f"Query expansion skipped: {type(e).__name__}: {e}")
+            trace.count("expansion_fallbacks")
             return query
     
-    def _embedding_filter(self, query: str) -> list[Page]:
-        if len(self.pages) <= self.config.embedding_candidates:
-            return self.pages
+    def _embed_query(self, query: str, trace: QueryTrace) -> np.ndarray:
+        with self._query_cache_lock:
+            cached = self._query_cache.get(query)
+            if cached is not None:
+                self._query_cache.move_to_end(query)
+                trace.count("query_cache_hits")
+                return cached
         
         q_emb = self.models.embed([query])[0]
-        scores = self.embeddings @ q_emb
-        top_idx = np.argsort(-scores)[: self.config.embedding_candidates]
-        return [self.pages[i] for i in top_idx]
+        with self._query_cache_lock:
+            self._query_cache[query] = q_emb
+            while len(self._query_cache) > self.config.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return q_emb
     
-    def _rerank(self, query: str, candidates: list[Page]) -> list[tuple[Page, float]]:
-        scores = self.models.rerank(query, [p.content for p in candidates], self.config.reranker_batch_size)
-        ranked = sorted(zip(candidates, scores), key=lambda x: x[1], reverse=True)
+    def _embedding_filter(
+        self, query: str, trace: QueryTrace,
+        doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+    ) -> list[tuple[Page, float]]:
+        with trace.stage("query_embed"):
+            q_emb = self._embed_query(query, trace)
+        with trace.stage("vector_search"):
+            candidates = self.index.search(q_emb, query, self.config.embedding_candidates, doc_ids, years)
+        trace.count("candidates", len(candidates))
+        return candidates
+    
+    def _rerank(self, query: str, candidates: list[tuple[Page, float]], trace: QueryTrace) -> list[tuple[Page, float]]:
+        if self.config.enable_cascade:
+            return self._cascade_rerank(query, candidates, trace)
+        
+        trace.count("reranked", len(candidates))
+        pages = [p for p, _ in candidates]
+        scores = self.models.rerank(query, [p.content for p in pages], self.config.reranker_batch_size)
+        ranked = sorted(zip(pages, scores), key=lambda x: x[1], reverse=True)
         return ranked[: self.config.final_pages]
     
-    def _generate(self, question: str, pages: list[tuple[Page, float]]) -> dict:
+    def _cascade_rerank(self, query: str, candidates: list[tuple[Page, float]], trace: QueryTrace) -> list[tuple[Page, float]]:
+        k = self.config.final_pages
+        if not candidates:
+            return []
+        
+        # Stage 1: dense cosine prunes the tail that cannot realistically make the cut
+        best = candidates[0][1]
+        keep = [
+            p for i, (p, s) in enumerate(candidates)
+            if i < k or s >= best - self.config.cascade_prune_margin
+        ]
+        
+        # Stage 2: cross-encoder in dense order; stop once a whole chunk lands
+        # clearly below the current k-th best score
+        scored: list[tuple[Page, float]] = []
+        step = self.config.cascade_chunk
+        for start in range(0, len(keep), step):
+            chunk = keep[start:start + step]
+            scores = self.models.rerank(query, [p.content for p in chunk], self.config.reranker_batch_size)
+            scored.extend(zip(chunk, scores))
+            trace.count("reranked", len(chunk))
+            
+            if len(scored) > k and start + step < len(keep):
+                kth = sorted((s for _, s in scored), reverse=True)[k - 1]
+                if max(scores) < kth - self.config.cascade_exit_margin:
+                    break
+        
+        ranked = sorted(scored, key=lambda x: x[1], reverse=True)
+        return ranked[:k]
+    
+    def _generate(
+        self, question: str, pages: list[tuple[Page, float]], trace: QueryTrace,
+        on_token: Optional[Callable[[str], None]] = None,
+        history: Optional[list[dict]] = None,
+    ) -> dict:
         if not pages:
-            return {"answer": "未找到相關內容", "pages": []}
+            return {"answer": "未找到相關內容", "pages": [], "sources": [], "tokens": 0}
         
-        context = "\n\n".join(
-            f"【Page {p.page_no}】(score: {s:.3f})\n{p.content}"
-            for p, s in pages
-        )
+        with trace.stage("prompt_build"):
+            context, pages, context_tokens = self.context_builder.build(pages)
+            # Most stable first: fixed instructions, then context, history, question
+            messages = [
+                {"role": "system", "content": self.config.system_prompt},
+                {"role": "user", "content": f"型錄內容：\n{context}"},
+                *(history or []),
+                {"role": "user", "content": f"問題：{question}"},
+            ]
+        trace.count("context_tokens", context_tokens)
         
-        resp = self.models.client.chat.completions.create(
+        t0 = time.perf_counter()
+        stream = self.models.client.chat.completions.create(
             model=self.config.generation_model,
-            messages=[
-                {"role": "system", "content": "根據型錄內容詳細統整所有產品及規格，引用頁碼。"},
-                {"role": "user", "content": f"問題：{question}\n\n型錄內容：\n{context}"},
-            ],
+            messages=messages,
             max_tokens=self.config.max_tokens,
             temperature=self.config.temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+            deadline=self.config.generation_deadline,
         )
         
+        parts, usage = [], None
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                if not parts:
+                    trace.mark("ttft", since=t0)
+                parts.append(delta)
+                if on_token:
+                    on_token(delta)
+        trace.mark("generation", since=t0)
+        
+        cached_tokens = 0
+        if usage:
+            trace.count("prompt_tokens", usage.prompt_tokens)
+            trace.count("completion_tokens", usage.completion_tokens)
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+            trace.count("cached_tokens", cached_tokens)
+            trace.count("prompt_cache_hits", 1 if cached_tokens else 0)
+        
         return {
-            "answer": resp.choices[0].message.content,
+            "answer": "".join(parts),
             "pages": [p.page_no for p, _ in pages],
-            "tokens": resp.usage.total_tokens,
+            "sources": [{"doc_id": p.doc_id, "page_no": p.page_no} for p, _ in pages],
+            "tokens": usage.total_tokens if usage else 0,
+            "cached_tokens": cached_tokens,
+            "context_tokens": context_tokens,
         }
 
 
+class ChatSession:
+    """One conversation over a RAGSystem: recent turns plus the last retrieval's candidates.
+    
+    A follow-up is embedded together with the previous question and scored
+    against the cached candidates (one query embed + a dot product); the best
+    of those are reranked like a fresh retrieval. Only if the best cached
+    score trails the best score over the whole corpus by more than
+    Config.followup_drift_threshold does it run a full retrieval.
+    Mirrors RAGSystem.retrieve / answer so rag_service can drive either.
+    The lock only guards the session state, never a retrieval.
+    """
+    
+    def __init__(self, system: RAGSystem):
+        self.system = system
+        self.turns: list[tuple[str, str]] = []
+        self._candidates: list[tuple[Page, float]] = []
+        self._vectors: Optional[np.ndarray] = None
+        self._index: Optional[CatalogIndex] = None
+        self._filters: tuple = (None, None)
+        self._generation = 0  # bumped by reset(); a retrieval started before it is not published
+        self._lock = threading.Lock()
+    
+    def reset(self):
+        with self._lock:
+            self.turns.clear()
+            self._candidates, self._vectors, self._index = [], None, None
+            self._generation += 1
+    
+    def ask(self, question: str, on_token: Optional[Callable[[str], None]] = None, **filters) -> dict:
+        trace = QueryTrace()
+        ranked = self.retrieve(question, trace, **filters)
+        return self.answer(question, ranked, trace, on_token)
+    
+    def _reusable(self, index: CatalogIndex, filters: tuple) -> bool:
+        return bool(self.turns and self._candidates and self._index is index and self._filters == filters)
+    
+    def may_reuse(self, doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None) -> bool:
+        """Whether retrieve() may answer from the last candidates (and then
+        needs no query expansion)."""
+        with self._lock:
+            return self._reusable(self.system.index, (doc_ids, years))
+    
+    def retrieve(
+        self, question: str, trace: QueryTrace,
+        doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+        expanded: Optional[str] = None,
+    ) -> list[tuple[Page, float]]:
+        config, index = self.system.config, self.system.index
+        filters = (doc_ids, years)
+        # Snapshot under the lock; embedding / rerank run outside it
+        with self._lock:
+            reusable = self._reusable(index, filters)
+            generation = self._generation
+            if reusable:
+                previous, candidates, vectors = self.turns[-1][0], self._candidates, self._vectors
+        
+        if reusable:
+            query = f"{previous} {question}"
+            with trace.stage("query_embed"):
+                q_emb = self.system._embed_query(query, trace)
+            with trace.stage("followup_rescore"):
+                scores = vectors @ q_emb
+                drift = index.best_dense(q_emb, doc_ids, years) - float(scores.max())
+            trace.count("followup_drift", drift)
+            if drift <= config.followup_drift_threshold:
+                trace.count("session_reuse")
+                order = np.argsort(-scores)[: max(config.followup_rerank_candidates, 1)]
+                shortlist = [(candidates[i][0], float(scores[i])) for i in order]
+                with trace.stage("rerank"):
+                    return self.system._rerank(query, shortlist, trace)
+        
+        trace.count("session_retrieval")
+        candidates, ranked = self.system._retrieve(question, trace, doc_ids, years, expanded)
+        vectors = index.vectors([p for p, _ in candidates]) if candidates else None
+        with self._lock:
+            if self._generation == generation:
+                self._candidates, self._vectors = candidates, vectors
+                self._index, self._filters = index, filters
+        return ranked
+    
+    def answer(
+        self, question: str, ranked: list[tuple[Page, float]], trace: QueryTrace,
+        on_token: Optional[Callable[[str], None]] = None,
+    ) -> dict:
+        result = self.system.answer(question, ranked, trace, on_token, self._history())
+        with self._lock:
+            self.turns.append((question, result.get("answer", "")))
+            del self.turns[: -self.system.config.chat_history_turns or None]
+        return result
+    
+    def _history(self) -> list[dict]:
+        builder, limit = self.system.context_builder, self.system.config.chat_history_answer_tokens
+        messages = []
+        for q, a in self.turns:
+            messages.append({"role": "user", "content": q})
+            messages.append({"role": "assistant", "content": builder.truncate_tokens(a, limit)})
+        return messages
+
+
 def main():
     config = Config()
     system = RAGSystem(config)
     system.initialize()
+    session = ChatSession(system)
     
-    print("\n輸入 'q' 退出\n")
+    print("\n輸入 'q' 退出，'new' 開始新對話\n")
     while True:
         q = input("Question > ").strip()
         if q.lower() in ("q", "quit", "exit"):
             break
         if not q:
             continue
+        if q.lower() == "new":
+            session.reset()
+            continue
         
-        result = system.query(q)
+        result = session.ask(q)
         print(f"\n{result['answer']}")
-        print(f"\n[Pages: {result['pages']}, Tokens: {result['tokens']}]\n")
+        print(f"\n[Pages: {result['pages']}, Tokens: {result['tokens']}, {result['metrics']['total_s']:.2f}s]\n")
 
 
 if __name__ == "__main__":
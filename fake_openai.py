@@ -0,0 +1,182 @@
+"""
+Local stand-in for the OpenAI chat-completions endpoint, for offline benchmarks.
+
+    with FakeOpenAIServer(ttft=0.3, tokens_per_s=60, completion_tokens=200) as server:
+        client = OpenAI(base_url=server.base_url, api_key="offline")
+
+Latency and token counts are configurable; responses are filler text.
+JSON-mode requests (query expansion) get a fixed keyword list back.
+
+Prompt caching is modelled on the OpenAI rules: prompts of at least 1024
+tokens are cached in 128-token blocks, and usage.prompt_tokens_details
+.cached_tokens reports the longest previously seen prefix (0 below 1024).
+"""
+
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# One CJK character (3 UTF-8 bytes) is roughly one token; ASCII text, at
+# ~4 bytes per real token, comes out slightly high
+BYTES_PER_TOKEN = 3
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text.encode("utf-8")) // BYTES_PER_TOKEN)
+
+
+class FakeOpenAIServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        ttft: float = 0.3,
+        tokens_per_s: float = 60.0,
+        completion_tokens: int = 200,
+        keywords: tuple[str, ...] = ("規格", "型號", "燈具"),
+        prompt_cache: bool = True,
+    ):
+        self.ttft = ttft
+        self.tokens_per_s = tokens_per_s
+        self.completion_tokens = completion_tokens
+        self.keywords = list(keywords)
+        self.prompt_cache = prompt_cache
+        self._prefixes: set[bytes] = set()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _cached_tokens(self, messages: list[dict]) -> int:
+        """Longest already-seen 128-token-block prefix; remembers this prompt's blocks."""
+        data = "".join(
+            m.get("role", "") + json.dumps(m.get("content", ""), ensure_ascii=False) for m in messages
+        ).encode("utf-8")
+        block = CACHE_BLOCK_TOKENS * BYTES_PER_TOKEN
+        if len(data) < CACHE_MIN_TOKENS * BYTES_PER_TOKEN:
+            return 0
+
+        digest, keys = hashlib.sha256(), []
+        for start in range(0, len(data) - block + 1, block):
+            digest.update(data[start:start + block])
+            keys.append(digest.copy().digest())
+        with self._lock:
+            hits = 0
+            for key in keys:
+                if key not in self._prefixes:
+                    break
+                hits += 1
+            self._prefixes.update(keys)
+        cached = hits * CACHE_BLOCK_TOKENS
+        return cached if cached >= CACHE_MIN_TOKENS else 0
+
+    def _usage(self, messages: list[dict], completion: int) -> dict:
+        prompt = sum(estimate_tokens(json.dumps(m.get("content", ""), ensure_ascii=False)) for m in messages)
+        cached = min(prompt, self._cached_tokens(messages)) if self.prompt_cache else 0
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with server._lock:
+                    server.requests += 1
+
+                if (body.get("response_format") or {}).get("type") == "json_object":
+                    self._complete(body, json.dumps({"keywords": server.keywords}, ensure_ascii=False), 20)
+                elif body.get("stream"):
+                    self._stream(body)
+                else:
+                    self._complete(body, "型錄" * server.completion_tokens, server.completion_tokens)
+
+            def _complete(self, body: dict, content: str, completion: int):
+                time.sleep(server.ttft + completion / server.tokens_per_s)
+                payload = {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "fake"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": server._usage(body.get("messages", []), completion),
+                }
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, body: dict):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+
+                base = {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "fake"),
+                }
+                time.sleep(server.ttft)
+                for _ in range(server.completion_tokens):
+                    self._event({**base, "choices": [{"index": 0, "delta": {"content": "型錄"}, "finish_reason": None}]})
+                    time.sleep(1 / server.tokens_per_s)
+                self._event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage = server._usage(body.get("messages", []), server.completion_tokens)
+                    self._event({**base, "choices": [], "usage": usage})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+            def _event(self, payload: dict):
+                self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+        return Handler
@@ -0,0 +1,292 @@
+"""
+Shared OpenAI client with pooling, deadlines, retries and a concurrency cap.
+
+    from llm_client import shared_client
+    client = shared_client()
+    resp = client.chat.completions.create(model="gpt-4o", messages=[...], deadline=30)
+
+`chat.completions.create` takes the usual OpenAI arguments plus `deadline`
+(seconds for the whole call, retries and waiting for a slot included).
+Connections are kept alive in one httpx pool; transient failures (429, 5xx,
+timeouts, connection errors) are retried with jittered exponential backoff,
+waiting at least as long as the server's retry-after / rate-limit reset
+headers ask. Every attempt is recorded in `client.metrics` (llm_* series).
+"""
+
+import os
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+import openai
+from openai import OpenAI
+
+from rag_metrics import MetricsRegistry
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class TokenBucket:
+    """Blocking rate limiter: `rate` acquisitions per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1, deadline: Optional[float] = None):
+        n = min(n, self.capacity)  # larger requests would never fit
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                wait = (n - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise DeadlineExceeded("rate limiter wait exceeds deadline")
+            time.sleep(wait)
+
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _reset_seconds(value: str) -> Optional[float]:
+    # x-ratelimit-reset-* use Go-style durations: "20ms", "1.5s", "6m0s"
+    parts = _DURATION.findall(value)
+    return sum(float(n) * _UNITS[u] for n, u in parts) if parts else None
+
+
+def retry_after(headers) -> Optional[float]:
+    """Seconds the server asked us to wait, from the standard and OpenAI headers."""
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    resets = [
+        _reset_seconds(headers[h])
+        for h in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if headers.get(h)
+    ]
+    resets = [r for r in resets if r is not None]
+    return max(resets) if resets else None
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, openai.APIConnectionError):  # includes APITimeoutError
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+
+class LLMClient:
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        max_concurrency: int = 8,
+        timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        max_connections: int = 32,
+        requests_per_s: Optional[float] = None,
+        metrics: Optional[MetricsRegistry] = None,
+    ):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = metrics or MetricsRegistry()
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.bucket = TokenBucket(requests_per_s) if requests_per_s else None
+
+        self.http = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+        # Retries are ours (deadline- and header-aware), not the SDK's
+        self.openai = OpenAI(
+            api_key=api_key or os.environ.get("OPENAI_API_KEY"),
+            base_url=base_url,
+            http_client=self.http,
+            max_retries=0,
+        )
+        self.chat = _Chat(self)
+
+    def create(self, deadline: Optional[float] = None, **kwargs):
+        """chat.completions.create with deadline, retries and the concurrency cap.
+
+        Streams hold their slot until consumed, closed or garbage-collected.
+        """
+        end = time.monotonic() + deadline if deadline else None
+        stream = bool(kwargs.get("stream"))
+
+        for attempt in range(self.max_retries + 1):
+            self._acquire(end)
+            t0 = time.perf_counter()
+            try:
+                per_call = self.timeout if end is None else min(self.timeout, self._remaining(end))
+                resp = self.openai.chat.completions.create(
+                    **kwargs, timeout=httpx.Timeout(per_call, connect=min(self.connect_timeout, per_call))
+                )
+            except Exception as e:
+                self.slots.release()
+                self.metrics.observe("llm_attempt_seconds", time.perf_counter() - t0)
+                self.metrics.inc("llm_errors")
+                if isinstance(e, openai.RateLimitError):
+                    self.metrics.inc("llm_rate_limited")
+                if not _retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, getattr(e, "response", None))
+                if end is not None and time.monotonic() + delay >= end:
+                    raise DeadlineExceeded(f"LLM call gave up after {attempt + 1} attempts") from e
+                self.metrics.inc("llm_retries")
+                time.sleep(delay)
+                continue
+
+            self.metrics.inc("llm_requests")
+            if stream:
+                return _Stream(self, resp, t0, end)
+            self.slots.release()
+            self.metrics.observe("llm_seconds", time.perf_counter() - t0)
+            return resp
+
+    def _acquire(self, end: Optional[float]):
+        if self.bucket:
+            self.bucket.acquire(deadline=end)
+        if not self.slots.acquire(timeout=None if end is None else self._remaining(end)):
+            raise DeadlineExceeded("no LLM slot free before the deadline")
+
+    def _backoff(self, attempt: int, response) -> float:
+        # Full jitter, but never sooner than the server asked
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        hinted = retry_after(response.headers) if response is not None else None
+        return max(delay, hinted + random.uniform(0, 0.1 * hinted + 0.05)) if hinted is not None else delay
+
+    @staticmethod
+    def _remaining(end: float) -> float:
+        left = end - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceeded("LLM call deadline exceeded")
+        return left
+
+    def close(self):
+        self.http.close()
+
+
+class _Stream:
+    """A streaming response that holds its client's slot.
+
+    The slot is released exactly once: when the stream is exhausted, fails,
+    is closed (close() or leaving a with block), or is garbage-collected
+    without ever being iterated.
+    """
+
+    def __init__(self, client: LLMClient, resp, t0: float, end: Optional[float]):
+        self.client = client
+        self.resp = resp
+        self.t0 = t0
+        self.end = end
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            for chunk in self.resp:
+                if self.end is not None and time.monotonic() > self.end:
+                    self.client.metrics.inc("llm_errors")
+                    raise DeadlineExceeded("LLM stream exceeded its deadline")
+                yield chunk
+            self.client.metrics.observe("llm_seconds", time.perf_counter() - self.t0)
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        try:
+            self.resp.close()
+        finally:
+            self.client.slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __getattr__(self, name):
+        # response, etc. of the underlying openai Stream
+        if name.startswith("_") or name == "resp":
+            raise AttributeError(name)
+        return getattr(self.resp, name)
+
+
+class _Completions:
+    def __init__(self, client: LLMClient):
+        self.create = client.create
+
+
+class _Chat:
+    def __init__(self, client: LLMClient):
+        self.completions = _Completions(client)
+
+
+_shared: Optional[LLMClient] = None
+_shared_lock = threading.Lock()
+
+
+def shared_client(**kwargs) -> LLMClient:
+    """Process-wide client, so every caller shares one pool and one concurrency cap.
+
+    kwargs only apply on first use.
+    """
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = LLMClient(**kwargs)
+    return _shared
+
+
+def set_shared_client(client: Optional[LLMClient]):
+    """Install client as the process-wide one (None: build it on next use).
+
+    Lets offline harnesses point every later shared_client() caller at a
+    fake server without an API key.
+    """
+    global _shared
+    with _shared_lock:
+        _shared = client
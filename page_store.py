@@ -0,0 +1,260 @@
+"""
+Content-addressed page store shared by the RAG index and the attribute extractor.
+
+    from page_store import PageStore
+    store = PageStore()
+    edition = store.ingest("catalog.pdf")                          # text + page keys
+    edition = store.ingest("catalog.pdf", convert=converter.convert)  # + Docling markdown / tables
+    edition.text(3), edition.markdown(3), edition.tables(3), edition.jpeg_path(3)
+
+A page's key is the sha256 of its text, drawing commands and embedded image
+data, so it does not depend on the page number: a new edition with inserted
+or reordered pages only pays Docling / rendering for pages whose content
+changed. Each edition (sha256 of the PDF) gets a manifest with its page keys,
+so once one consumer has ingested it the others never reopen the PDF for text.
+
+Artifacts live in <root>/pages/<key[:2]>/<key>/:
+
+    text.txt                        page.get_text("text"), stripped
+    docling-<variant>.md            Docling markdown of the single page
+    docling-<variant>.tables.json   its tables, one markdown string each
+    <max_w>_q<quality>.jpg          rendered page (render_jpeg)
+
+Every write is a temp file + os.replace, so threads, render subprocesses and
+separate programs can share one store.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime
+from typing import Callable, Iterable, Optional
+
+DEFAULT_ROOT = os.environ.get("PAGE_STORE_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "page_store"
+)
+MANIFEST_FORMAT = 1
+
+
+def page_key(doc, page, text: str) -> str:
+    """Content hash of one page: text + content stream + raw embedded images."""
+    h = hashlib.sha256(text.encode("utf-8"))
+    h.update(page.read_contents())
+    for img in page.get_images(full=True):
+        h.update(doc.xref_stream_raw(img[0]) or b"")
+    return h.hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+_docs = {}  # render_jpeg: one open document per PDF per process
+
+
+def render_jpeg(pdf_path: str, page_no: int, out_path: str, max_w=1280, max_zoom=1.5, quality=80) -> bytes:
+    """Render a page straight at the target width and encode the pixmap as JPEG.
+
+    Writes out_path atomically and returns the bytes. Module-level so a
+    process pool can pickle it. Spawn/forkserver workers still re-import
+    the parent's __main__ as __mp_main__, so the calling script must keep
+    heavy setup (UI, servers) under `if __name__ == "__main__"`.
+    """
+    import fitz
+
+    doc = _docs.get(pdf_path)
+    if doc is None:
+        doc = _docs[pdf_path] = fitz.open(pdf_path)
+    page = doc[page_no - 1]
+    zoom = min(max_zoom, max_w / page.rect.width)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+    try:
+        data = pix.tobytes("jpeg", jpg_quality=quality)
+    except TypeError:  # PyMuPDF without jpg_quality: encode the samples with PIL
+        import io
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.frombytes("RGB", (pix.width, pix.height), pix.samples).save(buf, format="JPEG", quality=quality)
+        data = buf.getvalue()
+    write_atomic(out_path, data)
+    return data
+
+
+def _tables_markdown(document) -> list:
+    tables = []
+    for table in getattr(document, "tables", []):
+        try:
+            tables.append(table.export_to_markdown(doc=document))
+        except TypeError:  # docling < 2.x: no doc argument
+            tables.append(table.export_to_markdown())
+    return tables
+
+
+class Edition:
+    """One PDF edition: page keys in page order and readers for their artifacts."""
+
+    def __init__(self, store: "PageStore", pdf_path: str, sha256: str, keys: list):
+        self.store = store
+        self.pdf_path = pdf_path
+        self.sha256 = sha256
+        self.keys = keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def key(self, page_no: int) -> str:
+        return self.keys[page_no - 1]
+
+    def text(self, page_no: int) -> str:
+        return self.store.read(self.key(page_no), "text.txt") or ""
+
+    def markdown(self, page_no: int, variant: str = "default") -> Optional[str]:
+        """Docling markdown, or None if this page was never converted with variant."""
+        return self.store.read(self.key(page_no), f"docling-{variant}.md")
+
+    def tables(self, page_no: int, variant: str = "default") -> Optional[list]:
+        data = self.store.read(self.key(page_no), f"docling-{variant}.tables.json")
+        return json.loads(data) if data is not None else None
+
+    def jpeg_path(self, page_no: int, max_w: int = 1280, quality: int = 80) -> str:
+        """Where render_jpeg output for this page lives (it may not exist yet)."""
+        return self.store.path(self.key(page_no), f"{max_w}_q{quality}.jpg")
+
+
+class PageStore:
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or DEFAULT_ROOT
+        os.makedirs(os.path.join(self.root, "editions"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "pages"), exist_ok=True)
+
+    def path(self, key: str, name: str) -> str:
+        folder = os.path.join(self.root, "pages", key[:2], key)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, name)
+
+    def has(self, key: str, name: str) -> bool:
+        return os.path.exists(os.path.join(self.root, "pages", key[:2], key, name))
+
+    def read(self, key: str, name: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self.root, "pages", key[:2], key, name), "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key: str, name: str, text: str):
+        write_atomic(self.path(key, name), text.encode("utf-8"))
+
+    def ingest(
+        self,
+        pdf_path: str,
+        convert: Optional[Callable] = None,
+        variant: str = "default",
+        refresh: bool = False,
+        temp_dir: Optional[str] = None,
+        progress: Callable[[Iterable], Iterable] = lambda it: it,
+    ) -> Edition:
+        """Make sure every page of pdf_path has its text in the store, and with
+        convert also its Docling markdown and tables for variant.
+
+        convert(single_page_pdf) must return a Docling ConversionResult. It is
+        called once per distinct page content missing that variant (every page
+        with refresh). The PDF is opened at most once, and not at all when the
+        edition is already fully ingested.
+        """
+        sha = file_sha256(pdf_path)
+        keys = self._load_manifest(sha)
+        if keys is not None and not all(self.has(k, "text.txt") for k in keys):
+            keys = None  # pages were pruned from the store
+        md_name = f"docling-{variant}.md"
+        todo = []
+        if keys is not None and convert is not None:
+            todo = self._docling_todo(keys, md_name, refresh)
+        if keys is not None and not todo:
+            return Edition(self, pdf_path, sha, keys)
+
+        import fitz
+
+        doc = fitz.open(pdf_path)
+        try:
+            if keys is None:
+                keys = []
+                for page in doc:
+                    text = (page.get_text("text") or "").strip()
+                    key = page_key(doc, page, text)
+                    if not self.has(key, "text.txt"):
+                        self.write(key, "text.txt", text)
+                    keys.append(key)
+                self._save_manifest(sha, pdf_path, keys)
+                if convert is not None:
+                    todo = self._docling_todo(keys, md_name, refresh)
+
+            if todo:
+                if temp_dir:
+                    os.makedirs(temp_dir, exist_ok=True)
+                with tempfile.TemporaryDirectory(dir=temp_dir) as tmp:
+                    for i in progress(todo):
+                        single_path = os.path.join(tmp, f"page_{i + 1:04d}.pdf")
+                        single = fitz.open()
+                        single.insert_pdf(doc, from_page=i, to_page=i)
+                        single.save(single_path)
+                        single.close()
+
+                        result = convert(single_path)
+                        md = result.document.export_to_markdown().strip()
+                        # Tables first: the markdown file marks the page as done
+                        tables = _tables_markdown(result.document)
+                        self.write(keys[i], f"docling-{variant}.tables.json", json.dumps(tables, ensure_ascii=False))
+                        self.write(keys[i], md_name, md)
+                        os.remove(single_path)
+        finally:
+            doc.close()
+        return Edition(self, pdf_path, sha, keys)
+
+    def _docling_todo(self, keys: list, md_name: str, refresh: bool) -> list:
+        """0-based page indexes to convert; pages with identical content only once."""
+        todo, seen = [], set()
+        for i, key in enumerate(keys):
+            if key in seen or (not refresh and self.has(key, md_name)):
+                continue
+            seen.add(key)
+            todo.append(i)
+        return todo
+
+    def _manifest_path(self, sha: str) -> str:
+        return os.path.join(self.root, "editions", f"{sha}.json")
+
+    def _load_manifest(self, sha: str) -> Optional[list]:
+        try:
+            with open(self._manifest_path(sha), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("format") != MANIFEST_FORMAT or data.get("pdf_sha256") != sha:
+            return None
+        return data.get("keys")
+
+    def _save_manifest(self, sha: str, pdf_path: str, keys: list):
+        data = {
+            "format": MANIFEST_FORMAT,
+            "pdf_sha256": sha,
+            "pdf_path": os.path.abspath(pdf_path),
+            "pages": len(keys),
+            "distinct_pages": len(set(keys)),
+            "created_at": datetime.now().isoformat(),
+            "keys": keys,
+        }
+        write_atomic(self._manifest_path(sha), json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
@@ -0,0 +1,408 @@
+"""
+Benchmarks for docling_rag_v5 over the cached catalog pages.
+
+Usage:
+  python rag_benchmark.py batching
+  python rag_benchmark.py batching --docs 40 --repeat 3 --out bench_batching.json
+  python rag_benchmark.py backend --backend int8
+  python rag_benchmark.py backend --backend onnx --min-overlap 0.9
+  python rag_benchmark.py rag --users 1 4 8 --baseline bench_results/rag-<commit>.json
+  python rag_benchmark.py import --modules docling_rag_v5 ai_chat_page
+  python rag_benchmark.py context --labels 時價 產品型號
+
+No benchmark needs an API key: the shared LLM client is replaced before
+Models loads. The rag harness points it at a local fake_openai server and
+replays the golden set in rag_golden_questions.json through RAGSystem.query. Reports go to bench_results/ by default.
+Token counts use tiktoken, which downloads its encoding on first use; offline,
+point TIKTOKEN_CACHE_DIR at a pre-fetched cache or ContextBuilder falls back
+to a character estimate (and token figures are approximate).
+"""
+
+import argparse
+import json
+import pickle
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from docling_rag_v5 import (
+    CatalogIndex, Config, ContextBuilder, LexicalIndex, Models, Page, RAGSystem, Shard, catalogs_from_config,
+)
+from fake_openai import FakeOpenAIServer
+from llm_client import LLMClient, set_shared_client
+from rag_metrics import MetricsRegistry
+
+
+def load_cached_pages(config: Config) -> tuple[list[Page], np.ndarray]:
+    primary = catalogs_from_config(config)[0]
+    with open(Path(config.cache_dir) / primary.cache_name(), "rb") as f:
+        data = pickle.load(f)
+    return [Page.from_dict(p, primary.doc_id) for p in data["pages"]], data["embeddings"]
+
+
+def timed(fn, repeat: int) -> tuple[float, object]:
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def bench_batching(args) -> dict:
+    """Fixed-count batches in input order vs. length-bucketed token-budget batches."""
+    config = Config()
+    set_shared_client(LLMClient(api_key="offline"))  # Models wants a client; this bench never calls it
+    models = Models(config)
+    pages, embeddings = load_cached_pages(config)
+    texts = [p.content for p in pages]
+
+    # Reranker input: the embedding-stage candidates for a typical query
+    query = args.query
+    q_emb = models.embed([query])[0]
+    top = np.argsort(-(embeddings @ q_emb))[: args.docs]
+    docs = [texts[i] for i in top]
+
+    def embed_fixed():
+        return models.embedder.encode(
+            texts, normalize_embeddings=True, show_progress_bar=False,
+            batch_size=config.embed_batch_size, convert_to_numpy=True
+        )
+
+    def rerank_fixed():
+        pairs = [(query, d) for d in docs]
+        return np.array(models.reranker.predict(pairs, batch_size=config.reranker_batch_size, show_progress_bar=False))
+
+    embed_base, emb_a = timed(embed_fixed, args.repeat)
+    embed_new, emb_b = timed(lambda: models.embed(texts), args.repeat)
+    rerank_base, rr_a = timed(rerank_fixed, args.repeat)
+    rerank_new, rr_b = timed(lambda: models.rerank(query, docs, config.reranker_batch_size), args.repeat)
+
+    return {
+        "devices": {"embedding": "cpu", "reranker": models.reranker_device},
+        "pages": len(texts),
+        "rerank_docs": len(docs),
+        "embed": {
+            "fixed_s": embed_base,
+            "bucketed_s": embed_new,
+            "speedup": embed_base / embed_new,
+            "max_abs_diff": float(np.abs(emb_a - emb_b).max()),
+        },
+        "rerank": {
+            "fixed_s": rerank_base,
+            "bucketed_s": rerank_new,
+            "speedup": rerank_base / rerank_new,
+            "max_abs_diff": float(np.abs(rr_a - rr_b).max()),
+        },
+    }
+
+
+PARITY_QUERIES = [
+    "浴室防水燈 IP65",
+    "軌道燈 3000K 高演色",
+    "T5 層板燈規格",
+    "崁燈 15cm 開孔",
+    "戶外投光燈 100W",
+]
+
+
+def load_models(backend: str) -> Models:
+    # Bypass the singleton so fp32 and the candidate backend can coexist
+    models = object.__new__(Models)
+    models._init_models(Config(inference_backend=backend))
+    return models
+
+
+def bench_backend(args) -> dict:
+    """Accuracy parity and latency of an alternative backend against fp32 torch."""
+    config = Config()
+    set_shared_client(LLMClient(api_key="offline"))  # Models wants a client; this bench never calls it
+    pages, embeddings = load_cached_pages(config)
+    texts = [p.content for p in pages]
+    k = config.final_pages
+
+    base = load_models("torch")
+    cand = load_models(args.backend)
+
+    sample = texts[: args.embed_pages]
+    embed_base, emb_a = timed(lambda: base.embed(sample), args.repeat)
+    embed_cand, emb_b = timed(lambda: cand.embed(sample), args.repeat)
+    cosine = np.sum(emb_a * emb_b, axis=1)
+
+    rerank = []
+    for query in PARITY_QUERIES:
+        q_emb = base.embed([query])[0]
+        top = np.argsort(-(embeddings @ q_emb))[: config.embedding_candidates]
+        docs = [texts[i] for i in top]
+
+        t_base, s_a = timed(lambda: base.rerank(query, docs, config.reranker_batch_size), args.repeat)
+        t_cand, s_b = timed(lambda: cand.rerank(query, docs, config.reranker_batch_size), args.repeat)
+        overlap = len(set(np.argsort(-s_a)[:k]) & set(np.argsort(-s_b)[:k])) / k
+        rerank.append({
+            "query": query,
+            "fp32_s": t_base,
+            "backend_s": t_cand,
+            "max_abs_diff": float(np.abs(s_a - s_b).max()),
+            "top_k_overlap": overlap,
+        })
+
+    min_overlap = min(r["top_k_overlap"] for r in rerank)
+    return {
+        "backend": args.backend,
+        "embed": {
+            "pages": len(sample),
+            "fp32_s": embed_base,
+            "backend_s": embed_cand,
+            "speedup": embed_base / embed_cand,
+            "min_cosine": float(cosine.min()),
+        },
+        "rerank": {
+            "fp32_s": sum(r["fp32_s"] for r in rerank) / len(rerank),
+            "backend_s": sum(r["backend_s"] for r in rerank) / len(rerank),
+            "min_top_k_overlap": min_overlap,
+            "queries": rerank,
+        },
+        "parity_ok": min_overlap >= args.min_overlap and float(cosine.min()) >= args.min_cosine,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except Exception:
+        return None
+
+
+def offline_system(config: Config, server: FakeOpenAIServer) -> RAGSystem:
+    """RAGSystem over the cached pages, talking to the fake LLM server.
+
+    The fake-server client is installed as the shared client before Models
+    loads, so no OPENAI_API_KEY is needed.
+    """
+    set_shared_client(LLMClient(
+        api_key="offline", base_url=server.base_url, max_concurrency=config.llm_max_concurrency
+    ))
+    system = RAGSystem(config)
+    pages, embeddings = load_cached_pages(config)
+    lexical = LexicalIndex.build([p.content for p in pages])
+    system.index = CatalogIndex(config, [Shard(catalogs_from_config(config)[0], pages, embeddings, lexical)])
+    system.context_builder.index(system.pages)
+    return system
+
+
+def recall_at(results: list[dict], golden: list[dict], key: str, k: Optional[int] = None) -> float:
+    scores = []
+    for res, g in zip(results, golden):
+        got = set(res[key][:k] if k else res[key])
+        scores.append(len(got & set(g["pages"])) / len(g["pages"]))
+    return sum(scores) / len(scores)
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    def pct(new, old):
+        return (new - old) / old * 100 if old else None
+
+    out = {"baseline_commit": baseline.get("commit"), "levels": [], "recall": {}}
+    old_levels = {lv["users"]: lv for lv in baseline.get("levels", [])}
+    for lv in report["levels"]:
+        old = old_levels.get(lv["users"])
+        if old:
+            out["levels"].append({
+                "users": lv["users"],
+                "qps_pct": pct(lv["qps"], old["qps"]),
+                "p95_query_s_pct": pct(lv["latency"]["query_seconds"]["p95"], old["latency"]["query_seconds"]["p95"]),
+            })
+    for k, v in report["recall"].items():
+        if k in baseline.get("recall", {}):
+            out["recall"][k] = v - baseline["recall"][k]
+    return out
+
+
+def bench_rag(args) -> dict:
+    """Replay the golden set offline: per-stage latency, throughput at N users, recall@k."""
+    golden = json.loads(Path(args.golden).read_text(encoding="utf-8"))
+    questions = [g["question"] for g in golden]
+    config = Config(
+        enable_query_expansion=args.expansion,
+        query_cache_size=256 if args.query_cache else 0,
+        hybrid_weight=args.hybrid_weight,
+    )
+
+    fake = {
+        "ttft": args.ttft,
+        "tokens_per_s": args.tokens_per_s,
+        "completion_tokens": args.completion_tokens,
+        "prompt_cache": not args.no_prompt_cache,
+    }
+    with FakeOpenAIServer(**fake) as server:
+        system = offline_system(config, server)
+        system.query(questions[0])  # warm-up
+
+        levels, first = [], None
+        for users in args.users:
+            system.metrics = MetricsRegistry(config.metrics_window)
+            jobs = questions * args.repeat
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(users) as pool:
+                results = list(pool.map(system.query, jobs))
+            wall = time.perf_counter() - t0
+
+            first = first or results[: len(questions)]
+            totals = system.metrics.summary()["totals"]
+            levels.append({
+                "users": users,
+                "queries": len(jobs),
+                "wall_s": wall,
+                "qps": len(jobs) / wall,
+                "latency": system.metrics.summary()["series"],
+                "prompt_cache_hit_rate": totals.get("prompt_cache_hits", 0) / len(jobs),
+                "cached_token_ratio": totals.get("cached_tokens", 0) / max(1, totals.get("prompt_tokens", 0)),
+            })
+
+    recall = {f"recall@{k}": recall_at(first, golden, "retrieved", k) for k in args.k}
+    recall["context_recall"] = recall_at(first, golden, "pages")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "config": asdict(config),
+        "fake_llm": fake,
+        "questions": len(questions),
+        "levels": levels,
+        "recall": recall,
+    }
+    if args.baseline:
+        report["vs_baseline"] = compare(report, json.loads(Path(args.baseline).read_text(encoding="utf-8")))
+    if not args.out:
+        Path("bench_results").mkdir(exist_ok=True)
+        args.out = f"bench_results/rag-{report['commit'] or 'nogit'}-{datetime.now():%Y%m%d-%H%M%S}.json"
+    return report
+
+
+def bench_context(args) -> dict:
+    """ContextBuilder over the cached pages: what is deduped, and that field labels survive build()."""
+    config = Config(context_token_budget=10 ** 9)
+    pages, _ = load_cached_pages(config)
+    builder = ContextBuilder(config)
+    builder.index(pages)
+
+    labels = {}
+    for label in args.labels:
+        having = [p for p in pages if label in p.content]
+        context, _, tokens = builder.build([(p, 1.0 - i * 1e-6) for i, p in enumerate(having)])
+        blocks = context.split("\n\n【")
+        labels[label] = {
+            "pages": len(having),
+            "kept": sum(label in b for b in blocks) if having else 0,
+            "context_tokens": tokens,
+        }
+
+    raw = sum(builder.count_tokens(p.content) for p in pages)
+    deduped = builder.count_tokens(builder.build([(p, 1.0) for p in pages])[0])
+    return {
+        "pages": len(pages),
+        "boilerplate": sorted(builder.boilerplate),
+        "tokens_all_pages": raw,
+        "tokens_all_pages_deduped": deduped,
+        "labels": labels,
+        "parity_ok": all(v["kept"] == v["pages"] for v in labels.values()),
+    }
+
+
+HEAVY_MODULES = ("torch", "sentence_transformers", "docling", "fitz", "transformers")
+
+IMPORT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{"import_s": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def bench_import(args) -> dict:
+    """Cold import time of each module in a fresh interpreter, and which heavy deps it drags in."""
+    results = {}
+    for module in args.modules:
+        runs = []
+        for _ in range(args.repeat):
+            code = IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+            if out.returncode != 0:
+                results[module] = {"error": out.stderr.strip().splitlines()[-1:]}
+                break
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        else:
+            results[module] = {
+                "import_s": min(r["import_s"] for r in runs),
+                "heavy_loaded": runs[0]["heavy"],
+            }
+    return {"python": sys.version.split()[0], "modules": results}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="docling_rag_v5 benchmarks over docling_cache/parsed_data.pkl")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("batching", help="fixed vs. length-bucketed batching in Models.embed / Models.rerank")
+    p.add_argument("--query", default="浴室防水燈 IP65")
+    p.add_argument("--docs", type=int, default=40, help="rerank candidates (default 40)")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_batching)
+
+    p = sub.add_parser("backend", help="parity + latency of Config.inference_backend vs. fp32 torch")
+    p.add_argument("--backend", choices=["onnx", "int8"], default="int8")
+    p.add_argument("--embed-pages", type=int, default=64)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--min-overlap", type=float, default=0.9, help="required top-k overlap with fp32 rerank")
+    p.add_argument("--min-cosine", type=float, default=0.99, help="required cosine with fp32 embeddings")
+    p.set_defaults(fn=bench_backend)
+
+    p = sub.add_parser("rag", help="offline end-to-end harness with a fake LLM and the golden question set")
+    p.add_argument("--golden", default="rag_golden_questions.json")
+    p.add_argument("--users", type=int, nargs="+", default=[1, 4, 8], help="concurrency levels")
+    p.add_argument("--repeat", type=int, default=2, help="passes over the golden set per level")
+    p.add_argument("--k", type=int, nargs="+", default=[5, 10, 20])
+    p.add_argument("--ttft", type=float, default=0.3, help="fake LLM time-to-first-token (s)")
+    p.add_argument("--tokens-per-s", type=float, default=60.0)
+    p.add_argument("--completion-tokens", type=int, default=200)
+    p.add_argument("--no-prompt-cache", action="store_true", help="fake LLM reports no cached prompt tokens")
+    p.add_argument("--expansion", action="store_true", help="enable query expansion (served by the fake LLM)")
+    p.add_argument("--query-cache", action="store_true", help="keep the query-embedding cache on across repeats")
+    p.add_argument("--hybrid-weight", type=float, default=0.0, help="BM25 share of the first-stage score")
+    p.add_argument("--baseline", help="earlier rag report to diff against")
+    p.set_defaults(fn=bench_rag)
+
+    p = sub.add_parser("context", help="boilerplate dedupe in ContextBuilder keeps spec/price labels")
+    p.add_argument("--labels", nargs="+", default=["時價", "產品型號", "燈體材質", "lm/W", "光型示意", "## 配光曲線與照度圖"])
+    p.set_defaults(fn=bench_context)
+
+    p = sub.add_parser("import", help="cold import time of the app modules in a fresh interpreter")
+    p.add_argument("--modules", nargs="+", default=["docling_rag_v5", "ai_chat_page", "rag_service"])
+    p.add_argument("--repeat", type=int, default=3, help="fresh interpreters per module (best is reported)")
+    p.set_defaults(fn=bench_import)
+
+    for p in sub.choices.values():
+        p.add_argument("--out", help="also write the JSON report to this path")
+
+    args = ap.parse_args()
+    report = args.fn(args)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text, encoding="utf-8")
+    if report.get("parity_ok") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
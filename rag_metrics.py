@@ -0,0 +1,146 @@
+"""Per-query traces, a rolling metrics registry and exporters for docling_rag_v5."""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    idx = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class QueryTrace:
+    """Stage timings (seconds) and counters collected while answering one query."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.timings: dict[str, float] = {}
+        self.counters: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - t0
+
+    def mark(self, name: str, since: Optional[float] = None):
+        """Record elapsed time from `since` (default: trace start), e.g. time-to-first-token."""
+        self.timings[name] = time.perf_counter() - (self.start if since is None else since)
+
+    def count(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self) -> dict:
+        return {
+            "total_s": time.perf_counter() - self.start,
+            "stages_s": dict(self.timings),
+            "counters": dict(self.counters),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+class MetricsRegistry:
+    """Rolling window of recent observations per metric, plus running totals."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._series: dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self._totals: dict[str, float] = defaultdict(float)
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self._series[name].append(value)
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._totals[name] += value
+
+    def record(self, trace: QueryTrace):
+        data = trace.to_dict()
+        self.inc("queries")
+        self.observe("query_seconds", data["total_s"])
+        for stage, seconds in data["stages_s"].items():
+            self.observe(f"{stage}_seconds", seconds)
+        for name, value in data["counters"].items():
+            self.observe(name, value)
+            self.inc(name, value)
+        if data["peak_rss_mb"] is not None:
+            self.observe("peak_rss_mb", data["peak_rss_mb"])
+
+    def summary(self) -> dict:
+        with self._lock:
+            series = {k: sorted(v) for k, v in self._series.items() if v}
+            totals = dict(self._totals)
+        return {
+            "totals": totals,
+            "series": {
+                name: {
+                    "count": len(vals),
+                    "mean": sum(vals) / len(vals),
+                    "p50": _percentile(vals, 0.50),
+                    "p95": _percentile(vals, 0.95),
+                    "p99": _percentile(vals, 0.99),
+                }
+                for name, vals in series.items()
+            },
+        }
+
+    def to_prometheus(self, prefix: str = "rag") -> str:
+        summary = self.summary()
+        lines = []
+        for name, stats in sorted(summary["series"].items()):
+            metric = f"{prefix}_{name}"
+            lines.append(f"# TYPE {metric} summary")
+            for q in ("p50", "p95", "p99"):
+                lines.append(f'{metric}{{quantile="0.{q[1:]}"}} {stats[q]:.6g}')
+            lines.append(f"{metric}_count {stats['count']}")
+        for name, total in sorted(summary["totals"].items()):
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {total:.6g}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """Appends each trace as a JSONL line, or rewrites a Prometheus textfile snapshot."""
+
+    def __init__(self, path: str, fmt: str = "jsonl"):
+        if fmt not in ("jsonl", "prometheus"):
+            raise ValueError(f"Unknown metrics format: {fmt}")
+        self.path = Path(path)
+        self.fmt = fmt
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def export(self, registry: MetricsRegistry, trace: QueryTrace):
+        with self._lock:
+            if self.fmt == "jsonl":
+                record = {"ts": time.time(), **trace.to_dict()}
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            else:
+                tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+                tmp.write_text(registry.to_prometheus(), encoding="utf-8")
+                os.replace(tmp, self.path)
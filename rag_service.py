@@ -0,0 +1,290 @@
+"""
+Headless HTTP/JSON service around RAGSystem.query.
+
+Models and the page index are loaded once per process. Query expansion (an
+LLM call) runs on the request thread before admission; retrieval (embed +
+rerank, CPU-bound) runs on a bounded worker pool behind a bounded queue; when
+both are full new requests get 503 + Retry-After. Generation streams from the request thread
+as NDJSON.
+
+Usage:
+  python rag_service.py --port 8765 --cpu-workers 2 --max-pending 16
+
+  POST /query   {"question": "...", "stream": true, "doc_ids": [...], "years": [...], "session_id": "..."}
+  GET  /health
+  POST /admin/reindex  {"catalogs": [{"path": "...", "doc_id": "...", "year": 2026}]}  (optional body)
+  POST /admin/rollback
+  GET  /metrics (Prometheus text)
+
+Clients: RAGClient / RemoteChatSession below (used by ai_chat_page when
+DANCELIGHT_RAG_URL is set).
+"""
+
+import argparse
+import json
+import threading
+import time
+import urllib.request
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from rag_metrics import QueryTrace
+
+
+class Overloaded(Exception):
+    pass
+
+
+class RAGService:
+    def __init__(self, system, cpu_workers: int = 2, max_pending: int = 16, max_sessions: int = 1000):
+        self.system = system
+        self.pool = ThreadPoolExecutor(cpu_workers, thread_name_prefix="rag-cpu")
+        # In-flight + queued retrievals; beyond this we shed load
+        self.slots = threading.BoundedSemaphore(cpu_workers + max_pending)
+        # Chat sessions by id, least recently used evicted first
+        self.max_sessions = max_sessions
+        self.sessions: OrderedDict = OrderedDict()
+        self._sessions_lock = threading.Lock()
+
+    def session(self, session_id: str):
+        from docling_rag_v5 import ChatSession
+
+        with self._sessions_lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = ChatSession(self.system)
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            self.sessions.move_to_end(session_id)
+            return session
+
+    def query(
+        self, question: str, on_token: Optional[Callable[[str], None]] = None,
+        doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+        session_id: Optional[str] = None,
+    ) -> dict:
+        # A session has the same retrieve/answer split as the system itself
+        target = self.session(session_id) if session_id else self.system
+        trace = QueryTrace()
+        # Expansion is a network call: run it here, not on a CPU worker, and
+        # before taking a slot, so slow expansions never count as CPU load
+        # (the LLM client's concurrency cap and deadline bound them).
+        # A session follow-up that may reuse its candidates skips it
+        # (retrieve() expands itself if it has to re-retrieve after all).
+        reuse = session_id and target.may_reuse(doc_ids, years)
+        expanded = None if reuse else self.system.expand(question, trace)
+        if not self.slots.acquire(blocking=False):
+            raise Overloaded()
+        try:
+            submitted = time.perf_counter()
+
+            def run():
+                trace.mark("queue_wait", since=submitted)
+                return target.retrieve(question, trace, doc_ids, years, expanded)
+
+            ranked = self.pool.submit(run).result()
+        finally:
+            self.slots.release()
+        result = target.answer(question, ranked, trace, on_token)
+        return {**result, "session_id": session_id} if session_id else result
+
+    def serve(self, host: str = "127.0.0.1", port: int = 8765):
+        httpd = ThreadingHTTPServer((host, port), make_handler(self))
+        httpd.daemon_threads = True
+        print(f"RAG service on http://{host}:{port}")
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+            self.pool.shutdown()
+
+
+def make_handler(service: RAGService):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _json(self, code: int, payload: dict, headers: Optional[dict] = None):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._json(200, {
+                    "status": "ok",
+                    "pages": len(service.system.pages),
+                    "models_ready": service.system.models_ready,
+                    "index_version": service.system.index.version,
+                    "reindexing": service.system.indexer.running,
+                })
+            elif self.path == "/metrics":
+                text = service.system.metrics.to_prometheus()
+                if service.system.models_ready:
+                    text += service.system.models.client.metrics.to_prometheus()
+                data = text.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path == "/admin/reindex":
+                self._reindex()
+                return
+            if self.path == "/admin/rollback":
+                try:
+                    self._json(200, {"index_version": service.system.indexer.rollback()})
+                except (RuntimeError, ValueError) as e:
+                    self._json(409, {"error": str(e)})
+                return
+            if self.path != "/query":
+                self._json(404, {"error": "not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                question = str(body["question"]).strip()
+            except (ValueError, KeyError):
+                self._json(400, {"error": "expected JSON body with 'question'"})
+                return
+            filters = {
+                "doc_ids": body.get("doc_ids"),
+                "years": body.get("years"),
+                "session_id": body.get("session_id"),
+            }
+
+            if body.get("stream"):
+                self._stream(question, filters)
+                return
+            try:
+                self._json(200, service.query(question, **filters))
+            except Overloaded:
+                self._json(503, {"error": "overloaded"}, {"Retry-After": "1"})
+            except Exception as e:
+                self._json(500, {"error": str(e)})
+
+        def _reindex(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError:
+                self._json(400, {"error": "expected JSON body"})
+                return
+            if service.system.indexer.start(body.get("catalogs")):
+                self._json(202, {"started": True, "index_version": service.system.index.version})
+            else:
+                self._json(409, {"error": "re-index already running"})
+
+        def _stream(self, question: str, filters: dict):
+            started = False
+
+            def emit(event: dict):
+                nonlocal started
+                if not started:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    started = True
+                self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+            try:
+                result = service.query(question, on_token=lambda t: emit({"token": t}), **filters)
+                emit({"done": True, **result})
+            except Overloaded:
+                self._json(503, {"error": "overloaded"}, {"Retry-After": "1"})
+            except Exception as e:
+                if started:
+                    emit({"error": str(e)})
+                else:
+                    self._json(500, {"error": str(e)})
+
+    return Handler
+
+
+class RAGClient:
+    """Thin client with the same query() interface as RAGSystem."""
+
+    def __init__(self, url: str = "http://127.0.0.1:8765", timeout: float = 180):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def query(
+        self, question: str, on_token: Optional[Callable[[str], None]] = None,
+        doc_ids: Optional[list[str]] = None, years: Optional[list[int]] = None,
+        session_id: Optional[str] = None,
+    ) -> dict:
+        payload = {
+            "question": question,
+            "stream": on_token is not None,
+            "doc_ids": doc_ids,
+            "years": years,
+            "session_id": session_id,
+        }
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        req = urllib.request.Request(
+            f"{self.url}/query", data=data, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            if on_token is None:
+                return json.load(resp)
+
+            result = {}
+            for line in resp:
+                event = json.loads(line)
+                if "token" in event:
+                    on_token(event["token"])
+                elif "error" in event:
+                    raise RuntimeError(event["error"])
+                elif event.get("done"):
+                    result = event
+            return result
+
+
+class RemoteChatSession:
+    """ChatSession counterpart backed by rag_service; the history lives server-side."""
+
+    def __init__(self, client: RAGClient):
+        self.client = client
+        self.session_id = uuid.uuid4().hex
+
+    def ask(self, question: str, on_token: Optional[Callable[[str], None]] = None, **filters) -> dict:
+        return self.client.query(question, on_token, session_id=self.session_id, **filters)
+
+    def reset(self):
+        self.session_id = uuid.uuid4().hex
+
+
+def main():
+    from docling_rag_v5 import Config, RAGSystem
+
+    ap = argparse.ArgumentParser(description="Serve RAGSystem.query over HTTP/JSON")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--cpu-workers", type=int, default=2, help="concurrent retrievals (embed + rerank)")
+    ap.add_argument("--max-pending", type=int, default=16, help="queued retrievals before returning 503")
+    ap.add_argument("--batch-window-ms", type=float, default=5.0,
+                    help="coalesce embed/rerank calls arriving within this window (0 disables)")
+    args = ap.parse_args()
+
+    system = RAGSystem(Config(
+        enable_micro_batching=args.batch_window_ms > 0,
+        batch_window_ms=args.batch_window_ms,
+    ))
+    system.initialize()
+    RAGService(system, args.cpu_workers, args.max_pending).serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()